@@ -0,0 +1,435 @@
+'''
+GenesetCache.py - columnar cache of a GTF geneset
+==================================================
+
+Parsing a whole-genome GTF file takes minutes. This module parses it
+once into a directory of NumPy arrays that every task needing the
+annotations can load in a fraction of a second.
+
+The cache lives in a directory named after the SHA1 digest of the
+GTF file, so it is rebuilt only when the annotations change. Each
+non-comment line of the GTF is one row:
+
+``contig.npy``, ``source.npy``, ``feature.npy``, ``gene.npy``, ``transcript.npy``
+   int32 codes into the name lists below.
+
+``start.npy``, ``end.npy``
+   int64 coordinates, 0-based half-open.
+
+``strand.npy``
+   int8, 1 for ``+``, -1 for ``-`` and 0 otherwise.
+
+``contigs.tsv``, ``sources.tsv``, ``features.tsv``, ``genes.tsv``, ``transcripts.tsv``
+   the interned names, one per line, in code order.
+
+Rows are kept in file order, so a boolean mask over the rows selects
+lines of the original GTF file (see :func:`writeLines`).
+
+'''
+
+import os
+import re
+import shutil
+import hashlib
+import array
+import collections
+import numpy
+from CGAT import IOTools
+
+COLUMNS = ("contig", "source", "feature", "gene", "transcript")
+STRANDS = {"+": 1, "-": -1}
+
+RE_GENE_ID = re.compile('gene_id "([^"]*)"')
+RE_TRANSCRIPT_ID = re.compile('transcript_id "([^"]*)"')
+
+
+def hashFile(filename, blocksize=1 << 20):
+    '''return the SHA1 digest of the content of *filename*.'''
+    digest = hashlib.sha1()
+    with open(filename, "rb") as inf:
+        while True:
+            block = inf.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Interner(object):
+    '''map names to consecutive integer codes.'''
+
+    def __init__(self):
+        self.codes = collections.OrderedDict()
+
+    def __call__(self, name):
+        try:
+            return self.codes[name]
+        except KeyError:
+            code = self.codes[name] = len(self.codes)
+            return code
+
+    def names(self):
+        return list(self.codes.keys())
+
+
+def iterateLines(infile):
+    '''iterate over the non-comment lines of *infile*.'''
+    for line in infile:
+        if line.startswith("#") or not line.strip():
+            continue
+        yield line
+
+
+def iterateGTF(infile):
+    '''iterate over the non-comment lines of *infile* as field lists.'''
+    for line in iterateLines(infile):
+        yield line.rstrip("\r\n").split("\t")
+
+
+def build(gtffile, cachedir):
+    '''build the cache for *gtffile* in *cachedir* unless it exists.
+
+    Returns the directory of the cache.
+    '''
+    path = os.path.join(cachedir, hashFile(gtffile))
+    if os.path.exists(path):
+        return path
+
+    interners = dict((column, Interner()) for column in COLUMNS)
+    values = dict((column, array.array("i")) for column in COLUMNS)
+    starts, ends = array.array("l"), array.array("l")
+    strands = array.array("b")
+
+    for fields in iterateGTF(IOTools.openFile(gtffile)):
+        attributes = fields[8]
+        match = RE_GENE_ID.search(attributes)
+        gene_id = match.group(1) if match else ""
+        match = RE_TRANSCRIPT_ID.search(attributes)
+        transcript_id = match.group(1) if match else ""
+        for column, name in zip(COLUMNS, (fields[0], fields[1], fields[2],
+                                          gene_id, transcript_id)):
+            values[column].append(interners[column](name))
+        starts.append(int(fields[3]) - 1)
+        ends.append(int(fields[4]))
+        strands.append(STRANDS.get(fields[6], 0))
+
+    # build in a temporary directory so that an interrupted build is
+    # never mistaken for a complete cache
+    tmpdir = path + ".tmp"
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    for column in COLUMNS:
+        numpy.save(os.path.join(tmpdir, column + ".npy"),
+                   numpy.frombuffer(values[column], dtype=numpy.intc)
+                   .astype(numpy.int32))
+        IOTools.writeLines(os.path.join(tmpdir, column + "s.tsv"),
+                           [[name] for name in interners[column].names()],
+                           header=None)
+    numpy.save(os.path.join(tmpdir, "start.npy"),
+               numpy.array(starts, dtype=numpy.int64))
+    numpy.save(os.path.join(tmpdir, "end.npy"),
+               numpy.array(ends, dtype=numpy.int64))
+    numpy.save(os.path.join(tmpdir, "strand.npy"),
+               numpy.frombuffer(strands, dtype=numpy.int8))
+    os.rename(tmpdir, path)
+    return path
+
+
+class Geneset(object):
+    '''a geneset loaded from the cache in *path*.
+
+    Columns are available as attributes (``contig``, ``start``,
+    ``end``, ``strand``, ``feature``, ``gene``, ...) and names as
+    ``contigs``, ``features``, ``genes``, ...
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        for column in COLUMNS:
+            setattr(self, column, self._load(column))
+            with open(os.path.join(path, column + "s.tsv")) as inf:
+                setattr(self, column + "s",
+                        [line.rstrip("\r\n") for line in inf])
+        self.start = self._load("start")
+        self.end = self._load("end")
+        self.strand = self._load("strand")
+
+    def _load(self, column):
+        return numpy.load(os.path.join(self.path, column + ".npy"),
+                          mmap_mode="r")
+
+    def __len__(self):
+        return len(self.start)
+
+    def getContigSizes(self):
+        '''return a list of (contig, largest end coordinate) in the
+        order in which contigs first appear.'''
+        max_end = numpy.zeros(len(self.contigs), dtype=numpy.int64)
+        numpy.maximum.at(max_end, self.contig, self.end)
+        return [(contig, int(end))
+                for contig, end in zip(self.contigs, max_end)]
+
+    def getGeneSpans(self, feature=None):
+        '''return per-gene arrays (gene, contig, start, end, strand)
+        spanning all rows of a gene, or only rows of *feature*.
+
+        Genes are sorted by contig and start.
+        '''
+        if feature is None:
+            rows = numpy.arange(len(self))
+        else:
+            rows = numpy.flatnonzero(
+                numpy.asarray(self.feature) == self.features.index(feature))
+        gene = numpy.asarray(self.gene)[rows]
+        ngenes = len(self.genes)
+        start = numpy.full(ngenes, numpy.iinfo(numpy.int64).max,
+                           dtype=numpy.int64)
+        end = numpy.zeros(ngenes, dtype=numpy.int64)
+        numpy.minimum.at(start, gene, numpy.asarray(self.start)[rows])
+        numpy.maximum.at(end, gene, numpy.asarray(self.end)[rows])
+        # int64, so that contig * span positions on a single axis over
+        # all contigs do not overflow
+        contig = numpy.zeros(ngenes, dtype=numpy.int64)
+        strand = numpy.zeros(ngenes, dtype=numpy.int8)
+        contig[gene] = numpy.asarray(self.contig)[rows]
+        strand[gene] = numpy.asarray(self.strand)[rows]
+
+        genes = numpy.unique(gene)
+        order = numpy.lexsort((start[genes], contig[genes]))
+        genes = genes[order]
+        return genes, contig[genes], start[genes], end[genes], strand[genes]
+
+
+def load(path):
+    '''load the geneset cache in *path*.
+
+    *path* can be the cache directory or a link to it.
+    '''
+    return Geneset(os.path.realpath(path))
+
+
+def formatGTF(contig, source, feature, start, end, strand, attributes):
+    '''return a GTF line for a 0-based half-open interval.'''
+    return "\t".join((contig, source, feature, str(start + 1), str(end),
+                      ".", {1: "+", -1: "-"}.get(strand, "."), ".",
+                      attributes)) + "\n"
+
+
+def mergeGenes(geneset, outfile, method="merge-transcripts"):
+    '''write one transcript per gene to *outfile* with the transcript
+    id set to the gene id.
+
+    merge-transcripts
+       a single exon spanning all exons of the gene, as
+       ``gtf2gtf --method=merge-transcripts``.
+
+    merge-exons
+       the union of all exons of the gene, overlapping and adjacent
+       exons merged, as ``gtf2gtf --method=merge-exons``.
+
+    Returns the number of lines written.
+    '''
+    exon = numpy.asarray(geneset.feature) == geneset.features.index("exon")
+    rows = numpy.flatnonzero(exon)
+    gene = numpy.asarray(geneset.gene)[rows]
+    start = numpy.asarray(geneset.start)[rows]
+    end = numpy.asarray(geneset.end)[rows]
+
+    if method == "merge-transcripts":
+        genes, contig, start, end, strand = geneset.getGeneSpans("exon")
+        source = numpy.zeros(len(geneset.genes), dtype=numpy.int32)
+        source[gene] = numpy.asarray(geneset.source)[rows]
+        source = source[genes]
+    elif method == "merge-exons":
+        # sort exons by gene and start, then start a new block
+        # wherever an exon begins after all previous exons of the
+        # gene have ended
+        order = numpy.lexsort((start, gene))
+        rows, gene = rows[order], gene[order]
+        start, end = start[order], end[order]
+        newgene = numpy.ones(len(rows), dtype=bool)
+        newgene[1:] = gene[1:] != gene[:-1]
+        # running maximum of the exon ends within each gene: offset
+        # each gene above the previous one so that a single
+        # accumulate never carries an end over into the next gene
+        offset = (numpy.cumsum(newgene) - 1) * (int(end.max()) + 1 if
+                                                len(end) else 0)
+        running_end = numpy.maximum.accumulate(end + offset) - offset
+        newblock = newgene.copy()
+        newblock[1:] |= start[1:] > running_end[:-1]
+        block = numpy.cumsum(newblock) - 1
+        first = numpy.flatnonzero(newblock)
+        genes = gene[first]
+        start = start[first]
+        end = numpy.zeros(len(first), dtype=numpy.int64)
+        numpy.maximum.at(end, block, running_end)
+        contig = numpy.asarray(geneset.contig)[rows[first]]
+        strand = numpy.asarray(geneset.strand)[rows[first]]
+        source = numpy.asarray(geneset.source)[rows[first]]
+        order = numpy.lexsort((start, contig))
+        genes, contig, start, end, strand, source = [
+            x[order] for x in (genes, contig, start, end, strand, source)]
+    else:
+        raise ValueError("unknown merge method %s" % method)
+
+    nlines = 0
+    with IOTools.openFile(outfile, "w") as outf:
+        for g, c, s, e, st, src in zip(genes, contig, start, end,
+                                       strand, source):
+            gene_id = geneset.genes[g]
+            outf.write(formatGTF(
+                geneset.contigs[c], geneset.sources[src], "exon", s, e, st,
+                'gene_id "%s"; transcript_id "%s";' % (gene_id, gene_id)))
+            nlines += 1
+    return nlines
+
+
+def extendGenes(geneset, contig_sizes, extension_up, extension_down):
+    '''return per-gene arrays (gene, contig, start, end) of the gene
+    spans in *geneset* extended by *extension_up* bases upstream and
+    *extension_down* bases downstream (relative to their strand) and
+    clipped to *contig_sizes*.'''
+    genes, contig, start, end, strand = geneset.getGeneSpans()
+    contig = contig.astype(numpy.int64)
+    sizes = numpy.array([contig_sizes.get(name, numpy.iinfo(numpy.int64).max)
+                         for name in geneset.contigs], dtype=numpy.int64)
+
+    minus = strand == -1
+    start = numpy.maximum(
+        0, start - numpy.where(minus, extension_down, extension_up))
+    end = numpy.minimum(
+        sizes[contig], end + numpy.where(minus, extension_up, extension_down))
+    return genes, contig, start, end
+
+
+def mergeWindows(start, end):
+    '''merge overlapping and book-ended windows [*start*, *end*).
+
+    Returns the sorted start and end of the merged regions and the
+    number of windows in each.
+    '''
+    order = numpy.argsort(start, kind="mergesort")
+    start, end = start[order], end[order]
+
+    running_end = numpy.maximum.accumulate(end)
+    newregion = numpy.ones(len(start), dtype=bool)
+    newregion[1:] = start[1:] > running_end[:-1]
+    region = numpy.cumsum(newregion) - 1
+    counts = numpy.bincount(region)
+    first = numpy.flatnonzero(newregion)
+    last = numpy.append(first[1:], len(start)) - 1
+    return start[first], running_end[last], counts
+
+
+def getTargetRegions(geneset, mask, contig_sizes, extension_up,
+                     extension_down):
+    '''return a list of (contig, start, end) of the merged windows of
+    the genes with rows in *mask*, extended as in :func:`extendGenes`.
+    '''
+    genes, contig, start, end = extendGenes(geneset, contig_sizes,
+                                            extension_up, extension_down)
+    selected = numpy.isin(genes, numpy.asarray(geneset.gene)[mask])
+    contig, start, end = contig[selected], start[selected], end[selected]
+    if not len(start):
+        return []
+
+    span = int(end.max()) + 1
+    region_start, region_end, counts = mergeWindows(contig * span + start,
+                                                    contig * span + end)
+    region_contig = region_start // span
+    return [(geneset.contigs[x], int(y - x * span), int(z - x * span))
+            for x, y, z in zip(region_contig, region_start, region_end)]
+
+
+def findOverlappingGenes(geneset, contig_sizes, extension_up,
+                         extension_down):
+    '''return a boolean mask of the rows in *geneset* that overlap a
+    region where the extended windows of two or more genes meet.
+
+    Each gene is extended by *extension_up* bases upstream and
+    *extension_down* bases downstream (relative to its strand) and
+    clipped to *contig_sizes*. Overlapping and book-ended windows are
+    merged, regions made up of a single window are discarded, and
+    every row overlapping one of the remaining regions is flagged.
+    This is equivalent to::
+
+        gtf2gtf --method=merge-transcripts | gff2bed
+        | bedtools slop -s -l <up> -r <down> | sort
+        | bedtools merge -c 4 -o count | awk '$4>1'
+        | bedtools intersect -v -a <geneset> -b -
+
+    with the mask marking the rows removed by ``intersect -v``.
+    '''
+    genes, contig, start, end = extendGenes(geneset, contig_sizes,
+                                            extension_up, extension_down)
+
+    # place all contigs on a single axis so that one sort and one
+    # running maximum sweep over all contigs at once
+    span = int(max(end.max(), geneset.end.max())) + 1 if len(end) else 1
+    region_start, region_end, counts = mergeWindows(contig * span + start,
+                                                    contig * span + end)
+
+    shared = counts > 1
+    region_start = region_start[shared]
+    region_end = region_end[shared]
+
+    # regions are disjoint and sorted, so the first region ending after
+    # the start of a row is the only candidate for an overlap
+    row_start = numpy.asarray(geneset.contig, dtype=numpy.int64) * span + \
+        geneset.start
+    row_end = numpy.asarray(geneset.contig, dtype=numpy.int64) * span + \
+        geneset.end
+    candidate = numpy.searchsorted(region_end, row_start, side="right")
+    valid = candidate < len(region_start)
+    overlaps = numpy.zeros(len(row_start), dtype=bool)
+    overlaps[valid] = region_start[candidate[valid]] < row_end[valid]
+    return overlaps
+
+
+def writeLines(gtffile, mask, outfile):
+    '''write the lines of *gtffile* whose rows are True in *mask*.'''
+    nlines = 0
+    with IOTools.openFile(outfile, "w") as outf:
+        for keep, line in zip(mask, iterateLines(IOTools.openFile(gtffile))):
+            if keep:
+                outf.write(line)
+                nlines += 1
+    return nlines
+
+
+def splitGeneset(geneset, gtffile, outfiles):
+    '''split *gtffile* into ``len(outfiles)`` chunks of whole genes.
+
+    Genes are ordered by position in *geneset* and cut into runs of
+    consecutive genes with roughly equal numbers of GTF lines, so that
+    every chunk covers a contiguous stretch of the genome. Genes not in
+    *geneset* go into the last chunk.
+
+    Returns the number of lines written to each chunk.
+    '''
+    nlines = collections.Counter()
+    for fields in iterateGTF(IOTools.openFile(gtffile)):
+        match = RE_GENE_ID.search(fields[8])
+        nlines[match.group(1) if match else ""] += 1
+
+    genes = geneset.getGeneSpans()[0]
+    names = [geneset.genes[gene] for gene in genes
+             if geneset.genes[gene] in nlines]
+    sizes = numpy.array([nlines[name] for name in names], dtype=numpy.int64)
+    nchunks = len(outfiles)
+    total = max(1, sizes.sum())
+    chunk = numpy.minimum(
+        (numpy.cumsum(sizes) - sizes) * nchunks // total, nchunks - 1)
+    chunks = dict(zip(names, chunk.tolist()))
+
+    outfs = [IOTools.openFile(outfile, "w") for outfile in outfiles]
+    counts = [0] * nchunks
+    for line in iterateLines(IOTools.openFile(gtffile)):
+        match = RE_GENE_ID.search(line)
+        index = chunks.get(match.group(1) if match else "", nchunks - 1)
+        outfs[index].write(line)
+        counts[index] += 1
+    for outf in outfs:
+        outf.close()
+    return counts
@@ -0,0 +1,915 @@
+'''
+PipelinePeaksAndProfiles.py - utility functions for pipeline_peaksandprofiles
+==============================================================================
+
+Functions used by :doc:`pipeline_peaksandprofiles` that run inside the
+pipeline process rather than as cluster jobs.
+
+'''
+
+import os
+import re
+import glob
+import time
+import json
+import zlib
+import fcntl
+import struct
+import sqlite3
+import inspect
+import hashlib
+import itertools
+import collections
+import functools
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+import pysam
+from CGAT import IOTools
+import CGAT.Experiment as E
+import CGATPipelines.Pipeline as P
+from ruffus import check_if_uptodate
+
+# ledger of the resources held by jobs running on this machine, shared
+# by all pipeline processes started in the working directory
+LEDGER = ".local_resources.ledger"
+
+MEMORY_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30,
+                "T": 1 << 40}
+
+# numbers reservations made by this process
+RESERVATIONS = itertools.count()
+
+# input BAM names, <tissue>-<ChIP|Input>-<condition>-<replicate>
+RE_SAMPLE = re.compile(
+    r"^(?P<tissue>.+)-(?P<type>ChIP|Input)-(?P<condition>.+)-"
+    r"(?P<replicate>.+)$")
+
+
+class SampleManifest(object):
+    '''the input BAM files of the pipeline and the control of each
+    ChIP sample, resolved once from the file names.
+
+    The control of ``<tissue>-ChIP-<condition>-<replicate>`` is
+
+    * ``<tissue>-Input-<condition>-<replicate>`` with *inputpersample*,
+    * ``<tissue>-Input-<condition>.bwa`` without,
+
+    where the tissue of IgG samples is replaced by *mainsampleprefix*
+    unless *igginput* is set. Sample names that can not be parsed are
+    collected in :attr:`errors`, ChIP samples without their control in
+    :attr:`missing`. Both are raised by :meth:`validate`.
+    '''
+
+    def __init__(self, bamfiles, inputpersample=1, igginput=0,
+                 mainsampleprefix=None):
+        self.samples = collections.OrderedDict()
+        for bamfile in sorted(bamfiles):
+            name = P.snip(os.path.basename(bamfile), ".bam")
+            match = RE_SAMPLE.match(name)
+            self.samples[name] = match.groupdict() if match else None
+
+        self.controls = {}
+        self.errors = []
+        self.missing = []
+        for name, fields in self.samples.items():
+            if fields is None:
+                if "-ChIP-" in name:
+                    self.errors.append(
+                        "%s.bam: can not parse the sample name" % name)
+                continue
+            if fields["type"] != "ChIP":
+                continue
+            tissue = fields["tissue"]
+            if tissue == "IgG" and igginput == 0:
+                tissue = mainsampleprefix
+            if inputpersample == 1:
+                control = "%s-Input-%s-%s" % (tissue, fields["condition"],
+                                              fields["replicate"])
+            else:
+                control = "%s-Input-%s.bwa" % (tissue, fields["condition"])
+            self.controls[name] = control
+            if control not in self.samples:
+                self.missing.append("%s.bam: control %s.bam does not exist" %
+                                   (name, control))
+
+    def getControl(self, bamfile, suffix=".filtered.deduplicated.bam"):
+        '''return the control of the ChIP sample in *bamfile*, in the
+        same directory and with the same *suffix*.'''
+        name = P.snip(os.path.basename(bamfile), suffix)
+        return os.path.join(os.path.dirname(bamfile),
+                            self.controls[name] + suffix)
+
+    def validate(self, controls=True):
+        '''raise a ValueError listing all problems, if there are any.
+        Missing controls are only checked if *controls* is set.'''
+        errors = self.errors + (self.missing if controls else [])
+        if errors:
+            raise ValueError("%i problems with the input files:\n%s" %
+                             (len(errors), "\n".join(errors)))
+
+    def write(self, outfile):
+        '''write the samples and their controls to *outfile*.'''
+        rows = []
+        for name, fields in self.samples.items():
+            fields = fields or {}
+            rows.append([name] +
+                        [fields.get(x, "") for x in
+                         ("tissue", "type", "condition", "replicate")] +
+                        [self.controls.get(name, "")])
+        IOTools.writeLines(outfile, rows,
+                           header=["sample", "tissue", "type", "condition",
+                                   "replicate", "control"])
+
+
+def getMappedReads(bamfile):
+    '''return the number of mapped reads in *bamfile*.
+
+    The count is taken from the BAM index, equivalent to ``samtools
+    view -c -F 4`` without decompressing the file.
+    '''
+    if not os.path.exists(bamfile + ".bai"):
+        raise OSError("%s has no index" % bamfile)
+    samfile = pysam.AlignmentFile(bamfile, "rb")
+    nreads = samfile.mapped
+    samfile.close()
+    return nreads
+
+
+def writeMappedReadCounts(bamfiles, outfile, threads=8):
+    '''count mapped reads in *bamfiles* from their indices and write
+    them to *outfile*.
+
+    Files are processed in parallel and *outfile* is only replaced
+    once all counts are available.
+    '''
+    pool = ThreadPool(max(1, min(threads, len(bamfiles))))
+    try:
+        counts = pool.map(getMappedReads, bamfiles)
+    finally:
+        pool.close()
+
+    tmpfile = outfile + ".tmp"
+    IOTools.writeLines(tmpfile,
+                       [[bamfile, str(count)]
+                        for bamfile, count in zip(bamfiles, counts)],
+                       header=["bamfile", "mapped_reads"])
+    os.rename(tmpfile, outfile)
+
+
+# empty BGZF block marking the end of a BGZF file
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            b"\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def compressBlock(data, level=6):
+    '''return *data* (at most 64 KB) as a BGZF block.'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    return (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            b"\x02\x00" + struct.pack("<H", len(deflated) + 25) + deflated +
+            struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+def bgzipFile(infile, outfile, threads=1, level=6, blocksize=65280):
+    '''compress *infile* to the BGZF file *outfile*, as bgzip and
+    :func:`pysam.tabix_compress` do, using *threads* threads.
+
+    zlib releases the interpreter lock while compressing, so blocks are
+    compressed in parallel by a thread pool, a batch at a time, and
+    written in order. *outfile* is only replaced once it is complete.
+    '''
+    pool = ThreadPool(max(1, threads))
+    tmpfile = outfile + ".tmp"
+    try:
+        with open(infile, "rb") as inf, open(tmpfile, "wb") as outf:
+            while True:
+                blocks = []
+                for x in range(max(1, threads) * 16):
+                    data = inf.read(blocksize)
+                    if not data:
+                        break
+                    blocks.append(data)
+                if not blocks:
+                    break
+                for block in pool.map(
+                        functools.partial(compressBlock, level=level),
+                        blocks):
+                    outf.write(block)
+            outf.write(BGZF_EOF)
+    finally:
+        pool.close()
+    os.rename(tmpfile, outfile)
+
+
+def getSubsampleFraction(bamfile, fraction=0, nreads=0):
+    '''return the fraction of the reads in *bamfile* to keep in a
+    preview: *fraction* if it is set, otherwise the fraction leaving
+    about *nreads* mapped reads. Never more than 1.
+    '''
+    if float(fraction) > 0:
+        return min(1.0, float(fraction))
+    if int(nreads) > 0:
+        return min(1.0, float(nreads) / max(1, getMappedReads(bamfile)))
+    raise ValueError("please set preview_fraction or preview_reads")
+
+
+def fingerprintFile(filename, nblocks=16, blocksize=65536):
+    '''return a cheap content fingerprint of *filename*.
+
+    The fingerprint is a SHA1 digest of the file size and *nblocks*
+    blocks of *blocksize* bytes spread evenly over the file, always
+    including the first (header) and the last block. Small files are
+    hashed completely.
+    '''
+    size = os.path.getsize(filename)
+    digest = hashlib.sha1(str(size).encode("ascii"))
+    with open(filename, "rb") as inf:
+        if size <= nblocks * blocksize:
+            digest.update(inf.read())
+        else:
+            step = (size - blocksize) // (nblocks - 1)
+            for block in range(nblocks):
+                inf.seek(block * step)
+                digest.update(inf.read(blocksize))
+    return digest.hexdigest()
+
+
+def splitFeatureCounts(infile, outfiles, ncolumns=6):
+    '''split the output of a featureCounts run over several BAM files
+    into one file per BAM file, as if each had been counted on its own.
+
+    *outfiles* lists the output file for each BAM file in the order in
+    which they were given to featureCounts. The first *ncolumns*
+    columns describe the feature and are copied to every output. The
+    ``.summary`` file is split alongside.
+
+    Returns the number of features.
+    '''
+    nfeatures = 0
+    for suffix in ("", ".summary"):
+        columns = ncolumns if suffix == "" else 1
+        outfs = [IOTools.openFile(outfile + suffix + ".tmp", "w")
+                 for outfile in outfiles]
+        for line in IOTools.openFile(infile + suffix):
+            if line.startswith("#"):
+                for outf in outfs:
+                    outf.write(line)
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) != columns + len(outfiles):
+                raise ValueError("%s: expected %i columns, got %i" %
+                                 (infile + suffix,
+                                  columns + len(outfiles), len(fields)))
+            prefix = "\t".join(fields[:columns])
+            for outf, value in zip(outfs, fields[columns:]):
+                outf.write("%s\t%s\n" % (prefix, value))
+            if suffix == "":
+                nfeatures += 1
+        for outf in outfs:
+            outf.close()
+        for outfile in outfiles:
+            os.rename(outfile + suffix + ".tmp", outfile + suffix)
+    return nfeatures
+
+
+def parseMemory(value):
+    '''return the number of bytes in a job_memory value such as "6G".'''
+    match = re.match(r"^\s*([0-9.]+)\s*([KMGT]?)B?\s*$", str(value).upper())
+    if match is None:
+        raise ValueError("can not parse memory value '%s'" % value)
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def readMeminfo():
+    '''return a dictionary of /proc/meminfo fields in bytes.'''
+    meminfo = {}
+    with open("/proc/meminfo") as inf:
+        for line in inf:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+    return meminfo
+
+
+def getCapacity():
+    '''return the memory (bytes) and cores available to local jobs.
+
+    Taken from local_memory and local_cores in the configuration, or
+    from the machine if these are not set (0).
+    '''
+    memory = P.PARAMS.get("local_memory", 0)
+    cores = P.PARAMS.get("local_cores", 0)
+    if memory:
+        memory = parseMemory(memory)
+    else:
+        memory = readMeminfo()["MemTotal"]
+    if not cores:
+        cores = os.sysconf("SC_NPROCESSORS_ONLN")
+    return memory, int(cores)
+
+
+def isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def lockedLedger():
+    '''yield the reservations in the ledger while holding its lock.
+
+    Reservations of processes that no longer exist are dropped.
+    '''
+    with open(LEDGER, "a+") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            handle.seek(0)
+            content = handle.read()
+            reservations = json.loads(content) if content.strip() else {}
+            reservations = dict(
+                (key, value) for key, value in reservations.items()
+                if isAlive(value["pid"]))
+            yield reservations
+            handle.seek(0)
+            handle.truncate()
+            handle.write(json.dumps(reservations))
+            handle.flush()
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def reserve(job_memory="1G", job_threads=1, poll=5):
+    '''hold *job_memory* and *job_threads* of the local machine.
+
+    Blocks until the job fits next to the jobs that already hold
+    resources, both in the configured capacity and in the memory the
+    kernel reports as available. A job that does not fit the machine
+    at all runs once nothing else is running.
+    '''
+    memory = parseMemory(job_memory)
+    threads = int(job_threads)
+    capacity_memory, capacity_cores = getCapacity()
+    key = "%i.%i" % (os.getpid(), next(RESERVATIONS))
+
+    waited, wait = 0, 1
+    while True:
+        with lockedLedger() as reservations:
+            used_memory = sum(x["memory"] for x in reservations.values())
+            used_threads = sum(x["threads"] for x in reservations.values())
+            fits = (used_memory + memory <= capacity_memory and
+                    used_threads + threads <= capacity_cores and
+                    memory <= readMeminfo()["MemAvailable"])
+            if fits or not reservations:
+                reservations[key] = {"pid": os.getpid(),
+                                     "memory": memory,
+                                     "threads": threads}
+                break
+        if waited == 0:
+            E.info("waiting for %s memory and %i threads "
+                   "(%i jobs running)" % (job_memory, threads,
+                                          len(reservations)))
+        time.sleep(wait)
+        waited += wait
+        wait = min(wait * 2, poll)
+
+    try:
+        yield
+    finally:
+        with lockedLedger() as reservations:
+            reservations.pop(key, None)
+
+
+def formatMemory(nbytes):
+    '''return *nbytes* as a job_memory value, rounded up.'''
+    for unit in ("G", "M"):
+        if nbytes >= MEMORY_UNITS[unit] or unit == "M":
+            return "%i%s" % (-(-nbytes // MEMORY_UNITS[unit]), unit)
+
+
+def getInputSize(options):
+    '''return the total size in bytes of the input files of a task,
+    taken from its infile or infiles variable.'''
+    todo = [options.get("infiles", options.get("infile"))]
+    size = 0
+    while todo:
+        item = todo.pop()
+        if isinstance(item, (list, tuple)):
+            todo.extend(item)
+        elif isinstance(item, str) and os.path.isfile(item):
+            size += os.path.getsize(item)
+    return size
+
+
+def getInputReads(options):
+    '''return the number of mapped reads in the indexed BAM files
+    among the input files of a task, taken from their indices.'''
+    todo = [options.get("infiles", options.get("infile"))]
+    nreads = 0
+    while todo:
+        item = todo.pop()
+        if isinstance(item, (list, tuple)):
+            todo.extend(item)
+        elif isinstance(item, str) and item.endswith(".bam") and \
+                os.path.exists(item + ".bai"):
+            nreads += getMappedReads(item)
+    return nreads
+
+
+def connectJobStats():
+    '''connect to the job statistics database, creating it if needed.'''
+    dbh = sqlite3.connect(P.PARAMS.get("jobstats_database", "jobstats.db"),
+                          timeout=60)
+    dbh.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                   task TEXT, job TEXT, host TEXT,
+                   submitted REAL, started REAL, finished REAL,
+                   wall REAL, user REAL, sys REAL, max_rss INTEGER,
+                   read_bytes INTEGER, write_bytes INTEGER,
+                   rchar INTEGER, wchar INTEGER,
+                   input_size INTEGER, job_memory TEXT, job_threads INTEGER,
+                   returncode INTEGER, reads INTEGER)''')
+    dbh.execute("CREATE INDEX IF NOT EXISTS jobs_task ON jobs (task)")
+    # databases written before reads were recorded
+    columns = [x[1] for x in dbh.execute("PRAGMA table_info(jobs)")]
+    if "reads" not in columns:
+        dbh.execute("ALTER TABLE jobs ADD COLUMN reads INTEGER")
+    return dbh
+
+
+JOBSTATS_COLUMNS = ("task", "job", "host", "submitted", "started",
+                    "finished", "wall", "user", "sys", "max_rss",
+                    "read_bytes", "write_bytes", "rchar", "wchar",
+                    "input_size", "job_memory", "job_threads", "returncode",
+                    "reads")
+
+
+def loadJobStats(filename):
+    '''add the record in *filename* written by jobstats.py to the
+    database and remove it.'''
+    with open(filename) as inf:
+        record = json.load(inf)
+    dbh = connectJobStats()
+    try:
+        dbh.execute("INSERT INTO jobs VALUES (%s)" %
+                    ",".join(["?"] * len(JOBSTATS_COLUMNS)),
+                    [record.get(column) for column in JOBSTATS_COLUMNS])
+        dbh.commit()
+    finally:
+        dbh.close()
+    os.unlink(filename)
+
+
+def projectTimings(database, scales):
+    '''return a list of (task, jobs, wall, projected wall, scaled jobs)
+    for the successful jobs in the job statistics *database* of a
+    preview run.
+
+    *scales* maps sample names to the ratio of their full to their
+    subsampled number of reads. The wall time of a job is scaled by
+    the ratio of the sample its output is named after (the longest
+    matching name), jobs not named after a sample (annotations and
+    merges across samples) are not scaled.
+    '''
+    names = sorted(scales, key=len, reverse=True)
+    dbh = sqlite3.connect(database, timeout=60)
+    try:
+        rows = dbh.execute('''SELECT task, job, wall FROM jobs
+                              WHERE returncode = 0''').fetchall()
+    finally:
+        dbh.close()
+
+    tasks = collections.OrderedDict()
+    for task, job, wall in rows:
+        entry = tasks.setdefault(task, [0, 0.0, 0.0, 0])
+        sample = matchSample(job, names)
+        entry[0] += 1
+        entry[1] += wall
+        if sample:
+            entry[2] += wall * scales[sample]
+            entry[3] += 1
+        else:
+            entry[2] += wall
+    return [(task,) + tuple(entry) for task, entry in tasks.items()]
+
+
+def matchSample(job, names):
+    '''return the first of *names* that the output file name *job*
+    starts with, followed by a dot, or None. Pass *names* longest
+    first.'''
+    for name in names:
+        if job.startswith(name + "."):
+            return name
+    return None
+
+
+def orderByCost(filenames, database=None):
+    '''return the input files *filenames* ordered by the estimated
+    time of their jobs, longest first.
+
+    ruffus submits the jobs of a task in the order of its inputs and
+    downstream tasks inherit this order, so starting the longest jobs
+    first keeps a large sample from running alone at the end of a
+    task.
+
+    The cost of a file is the total wall time of the jobs named after
+    it in the last run recorded in the job statistics *database*. Files
+    without records are estimated from their size at the median time
+    per byte of those with records, or ordered by size alone if there
+    are no records.
+    '''
+    names = dict((P.snip(os.path.basename(x), ".bam"), x) for x in filenames)
+    sizes = dict((x, os.path.getsize(x)) for x in filenames)
+
+    walls = collections.defaultdict(float)
+    if database and os.path.exists(database):
+        dbh = sqlite3.connect(database, timeout=60)
+        try:
+            rows = dbh.execute('''SELECT task, job, wall FROM jobs
+                                  WHERE returncode = 0
+                                  ORDER BY finished''').fetchall()
+        finally:
+            dbh.close()
+        # the latest record of each job
+        latest = dict(((task, job), wall) for task, job, wall in rows)
+        ordered = sorted(names, key=len, reverse=True)
+        for (task, job), wall in latest.items():
+            sample = matchSample(job or "", ordered)
+            if sample:
+                walls[names[sample]] += wall or 0
+
+    rates = sorted(walls[x] / sizes[x] for x in walls if sizes[x])
+    rate = rates[len(rates) // 2] if rates else 1.0
+    costs = dict((x, walls[x] if x in walls else sizes[x] * rate)
+                 for x in filenames)
+    return sorted(filenames, key=lambda x: (-costs[x], x))
+
+
+def estimateMemory(task, input_size, job_memory):
+    '''return job_memory for *task* sized from previous runs.
+
+    The peak memory of every recorded run is scaled up by the ratio of
+    *input_size* to its input size (never down), and the
+    jobstats_quantile of these values times jobstats_margin is
+    returned. *job_memory* is returned unchanged if fewer than
+    jobstats_minruns successful runs have been recorded.
+    '''
+    if not os.path.exists(P.PARAMS.get("jobstats_database", "jobstats.db")):
+        return job_memory
+    dbh = connectJobStats()
+    try:
+        rows = dbh.execute(
+            "SELECT max_rss, input_size FROM jobs "
+            "WHERE task = ? AND returncode = 0", (task,)).fetchall()
+    finally:
+        dbh.close()
+    if len(rows) < int(P.PARAMS.get("jobstats_minruns", 3)):
+        return job_memory
+
+    scaled = sorted(
+        max_rss * max(1.0, float(input_size) / recorded_size)
+        if recorded_size else max_rss
+        for max_rss, recorded_size in rows)
+    quantile = float(P.PARAMS.get("jobstats_quantile", 0.95))
+    value = scaled[min(len(scaled) - 1, int(quantile * len(scaled)))]
+    value *= float(P.PARAMS.get("jobstats_margin", 1.2))
+    value = max(value, parseMemory(P.PARAMS.get("jobstats_minmemory",
+                                                "256M")))
+    estimate = formatMemory(int(value))
+    if estimate != job_memory:
+        E.info("%s: job_memory %s -> %s from %i recorded runs" %
+               (task, job_memory, estimate, len(rows)))
+    return estimate
+
+
+def recordStatement(options, recordfile, fields):
+    '''return a statement running the statement in *options* under
+    jobstats.py.
+
+    The statement is expanded as :func:`P.run` would and written to a
+    shell script next to *recordfile*, so that it is run unchanged.
+    The script repeats the shell setup of :func:`P.run`, so that a
+    failing command in a pipe fails the job unless ignore_pipe_errors
+    is set. The dictionary *fields* is added to the record.
+    '''
+    values = dict(P.PARAMS)
+    values.update(options)
+    statement = options["statement"] % values
+    statement = " ".join(re.sub("\t+", " ", statement).split("\n")).strip()
+    statement = re.sub(r"(^|;)\s*checkpoint\s*(?=;|$)",
+                       r"\1 [ $? -eq 0 ] || exit 1", statement)
+
+    scriptfile = P.snip(recordfile, ".json") + ".sh"
+    setup = ["umask 002"]
+    if not options.get("ignore_pipe_errors"):
+        setup.insert(0, "set -o pipefail")
+    with open(scriptfile, "w") as outf:
+        outf.write("#!/bin/bash\n%s\n%s\n" % ("\n".join(setup), statement))
+
+    fields = " ".join("--field=%s=%s" % (key, value)
+                      for key, value in sorted(fields.items()))
+    return ('''python %s/jobstats.py -v 0 --output=%s %s
+              bash %s''' % (P.PARAMS["localscriptsdir"], recordfile, fields,
+                             scriptfile))
+
+
+def run(**kwargs):
+    '''run the calling task's statement with :func:`P.run`.
+
+    With jobstats_record set, the statement runs under jobstats.py and
+    its peak memory, CPU time, wall time and I/O are added to the
+    jobstats_database together with the task's input size and the
+    number of reads in its indexed input BAM files. The record is
+    written by the job to a file in jobstats.dir and loaded here once
+    the job has finished, so this works for cluster jobs, and records
+    left behind by an interrupted run are loaded by
+    jobstats_report.py. With
+    jobstats_adaptive set, job_memory is then sized from these
+    records (see :func:`estimateMemory`).
+
+    When jobs run on the local machine (``--local``/without_cluster,
+    or to_cluster=False) the statement is admitted only once the
+    task's job_memory and job_threads are free (see :func:`reserve`),
+    so that concurrent ruffus jobs queue instead of overcommitting the
+    machine. Cluster jobs are submitted unchanged.
+
+    Jobs are recorded under the name of the calling function. Helper
+    functions running the statements of several tasks pass the name
+    of the task as *task_name*.
+    '''
+    caller = inspect.currentframe().f_back
+    options = dict(caller.f_locals)
+    options.update(kwargs)
+    task = options.pop("task_name", None) or caller.f_code.co_name
+
+    job_memory = options.get("job_memory",
+                             P.PARAMS.get("cluster_memory_default", "1G"))
+    job_threads = options.get("job_threads", 1)
+    input_size = getInputSize(options)
+    if P.PARAMS.get("jobstats_adaptive"):
+        job_memory = options["job_memory"] = estimateMemory(
+            task, input_size, job_memory)
+
+    recordfile = None
+    if P.PARAMS.get("jobstats_record"):
+        recorddir = os.path.join("jobstats.dir", task)
+        if not os.path.exists(recorddir):
+            os.makedirs(recorddir)
+        recordfile = os.path.join(
+            recorddir, "%i.%i.json" % (os.getpid(), next(RESERVATIONS)))
+        options["statement"] = recordStatement(options, recordfile, {
+            "task": task,
+            "job": os.path.basename(str(options.get("outfile", ""))),
+            "submitted": "%f" % time.time(),
+            "input_size": input_size,
+            "reads": getInputReads(options),
+            "job_memory": job_memory,
+            "job_threads": job_threads})
+
+    try:
+        if not (P.PARAMS.get("without_cluster") or
+                not options.get("to_cluster", True)):
+            return P.run(**options)
+        with reserve(job_memory, job_threads):
+            return P.run(**options)
+    finally:
+        if recordfile and os.path.exists(recordfile):
+            loadJobStats(recordfile)
+            os.unlink(P.snip(recordfile, ".json") + ".sh")
+
+
+RE_PARAMS = re.compile(
+    r"""PARAMS(?:\[\s*|\.get\(\s*)["']([^"']+)["']""")
+RE_INTERPOLATION = re.compile(r"%\(([^)]+)\)s")
+RE_LOCALSCRIPT = re.compile(r"%\(localscriptsdir\)s/([\w.]+\.py)")
+RE_CALL = re.compile(r"\b([A-Za-z_]\w*)\s*\(")
+
+
+def flattenFiles(value):
+    '''return the existing files named in a ruffus job parameter,
+    expanding glob patterns.'''
+    todo, files = [value], []
+    while todo:
+        item = todo.pop(0)
+        if isinstance(item, (list, tuple)):
+            todo = list(item) + todo
+        elif isinstance(item, str):
+            if os.path.exists(item):
+                files.append(item)
+            elif glob.has_magic(item):
+                files.extend(sorted(glob.glob(item)))
+    return files
+
+
+def getMissingFiles(value):
+    '''return the files named in a ruffus job parameter that do not
+    exist. Glob patterns are ignored.'''
+    todo, missing = [value], []
+    while todo:
+        item = todo.pop(0)
+        if isinstance(item, (list, tuple)):
+            todo = list(item) + todo
+        elif isinstance(item, str) and not glob.has_magic(item) and \
+                not os.path.exists(item):
+            missing.append(item)
+    return missing
+
+
+def fingerprintPath(path):
+    '''return a fingerprint of a file or of all files in a directory.'''
+    path = os.path.realpath(path)
+    if not os.path.isdir(path):
+        return fingerprintFile(path)
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for filename in sorted(files):
+            filename = os.path.join(root, filename)
+            digest.update(("%s\t%s\n" % (os.path.relpath(filename, path),
+                                          fingerprintFile(filename))
+                           ).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def getTaskDependencies(func):
+    '''return the source code of *func* and of the pipeline functions
+    it calls (recursively), the PARAMS keys they read and the local
+    scripts they run.'''
+    namespace = func.__globals__
+    params = namespace.get("PARAMS", {})
+    sources, keys, scripts = [], set(), set()
+    todo, seen = [func], set()
+    while todo:
+        f = todo.pop()
+        f = getattr(f, "__wrapped__", f)
+        if f in seen:
+            continue
+        seen.add(f)
+        try:
+            source = inspect.getsource(f)
+        except (IOError, TypeError):
+            continue
+        sources.append(source)
+        keys.update(RE_PARAMS.findall(source))
+        keys.update(x for x in RE_INTERPOLATION.findall(source)
+                    if x in params)
+        scripts.update(RE_LOCALSCRIPT.findall(source))
+        for name in RE_CALL.findall(source):
+            other = namespace.get(name)
+            if inspect.isfunction(other) and \
+               other.__module__ == func.__module__:
+                todo.append(other)
+    return sources, sorted(keys), sorted(scripts)
+
+
+def computeSignature(func, infiles):
+    '''return a dictionary describing everything a job of *func*
+    depends on: its input files, the values of the PARAMS keys it
+    reads, its code and the local scripts it runs.'''
+    sources, keys, scripts = getTaskDependencies(func)
+    params = func.__globals__.get("PARAMS", {})
+    scriptsdir = params.get("localscriptsdir", "")
+    signature = {
+        "inputs": dict((x, fingerprintPath(x)) for x in flattenFiles(infiles)),
+        "params": dict((key, str(params.get(key))) for key in keys),
+        "code": hashlib.sha1("".join(sources).encode("utf-8")).hexdigest(),
+        "scripts": dict(
+            (script, fingerprintFile(os.path.join(scriptsdir, script)))
+            for script in scripts
+            if os.path.exists(os.path.join(scriptsdir, script)))}
+    return signature
+
+
+def connectContentHashes():
+    dbh = sqlite3.connect(P.PARAMS.get("contenthash_database",
+                                       "contenthash.db"), timeout=60)
+    dbh.execute("CREATE TABLE IF NOT EXISTS jobs "
+                "(outputs TEXT PRIMARY KEY, task TEXT, signature TEXT)")
+    return dbh
+
+
+def getJobKey(outfiles):
+    return "\t".join(sorted(flattenFiles(outfiles)) or
+                     [str(outfiles)])
+
+
+def describeChanges(old, new):
+    '''return a message listing what differs between two signatures.'''
+    changes = []
+    for section in ("inputs", "params", "scripts"):
+        for key in sorted(set(old.get(section, {})) |
+                          set(new.get(section, {}))):
+            if old.get(section, {}).get(key) != new[section].get(key):
+                changes.append("%s %s" % (section[:-1], key))
+    if old.get("code") != new["code"]:
+        changes.append("task code")
+    return ", ".join(changes)
+
+
+def trackContent(func):
+    '''decide whether the jobs of a ruffus task are up to date from
+    the content of their inputs instead of file modification times.
+
+    Enabled with contenthash_enabled. A job reruns if an output is
+    missing or if any of the following changed since its outputs were
+    last made: the fingerprint (see :func:`fingerprintFile`) of an
+    input file, the value of a PARAMS key read by the task or by
+    pipeline functions it calls, the code of these functions or a
+    local script the task runs. Copying or touching files therefore
+    does not trigger a rerun, and changing a configuration value only
+    reruns the tasks that use it.
+
+    Jobs without a recorded signature are checked by modification
+    time, and their signature is recorded if they are up to date.
+
+    Apply as the innermost decorator of a task.
+    '''
+    if not P.PARAMS.get("contenthash_enabled"):
+        return func
+
+    def _isUptodate(*args):
+        infiles, outfiles = args[0], args[1]
+        outputs = flattenFiles(outfiles)
+        if not outputs or getMissingFiles(outfiles):
+            return True, "missing output"
+
+        signature = computeSignature(func, infiles)
+        dbh = connectContentHashes()
+        try:
+            row = dbh.execute("SELECT signature FROM jobs WHERE outputs = ?",
+                              (getJobKey(outfiles),)).fetchone()
+        finally:
+            dbh.close()
+
+        if row is None:
+            inputs = flattenFiles(infiles)
+            if inputs and max(os.path.getmtime(x) for x in inputs) > \
+               min(os.path.getmtime(x) for x in outputs):
+                return True, "no recorded signature, inputs newer"
+            recordSignature(func, outfiles, signature)
+            return False, "up to date by modification time, recorded"
+
+        changes = describeChanges(json.loads(row[0]), signature)
+        if changes:
+            return True, "changed: %s" % changes
+        return False, "content unchanged"
+
+    @functools.wraps(func)
+    def _task(*args):
+        result = func(*args)
+        recordSignature(func, args[1], computeSignature(func, args[0]))
+        return result
+
+    _task.__wrapped__ = func
+    _task.isUptodate = _isUptodate
+    return check_if_uptodate(_isUptodate)(_task)
+
+
+def checkMergeState(func):
+    '''rerun a task updating a ``merge_tables.py --incremental`` output
+    when the inputs recorded in its ``.state`` differ from the inputs
+    of the task.
+
+    Enabled with merge_incremental. ruffus does not rerun a @merge task
+    when one of its inputs was removed, which would leave the rows of
+    withdrawn samples in the table. Otherwise the decision is left to
+    :func:`trackContent`, if it applies, or made by modification time.
+
+    Apply outside :func:`trackContent`.
+    '''
+    if P.PARAMS.get("merge_incremental") != 1:
+        return func
+    check = getattr(func, "isUptodate", None)
+
+    def _isUptodate(*args):
+        infiles, outfile = args[0], args[1]
+        statefile = outfile + ".state"
+        if os.path.exists(outfile) and os.path.exists(statefile):
+            with open(statefile) as inf:
+                recorded = set(x["name"] for x in json.load(inf)["files"])
+            if recorded != set(flattenFiles(infiles)):
+                return True, "inputs added or removed"
+        if check is not None:
+            return check(*args)
+        if getMissingFiles(outfile):
+            return True, "missing output"
+        inputs = flattenFiles(infiles)
+        if inputs and max(os.path.getmtime(x) for x in inputs) > \
+           os.path.getmtime(outfile):
+            return True, "inputs newer"
+        return False, "up to date"
+
+    func.isUptodate = _isUptodate
+    return check_if_uptodate(_isUptodate)(func)
+
+
+def recordSignature(func, outfiles, signature):
+    dbh = connectContentHashes()
+    try:
+        dbh.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+                    (getJobKey(outfiles), func.__name__,
+                     json.dumps(signature, sort_keys=True)))
+        dbh.commit()
+    finally:
+        dbh.close()
@@ -92,15 +92,18 @@ Code
 
 """
 from ruffus import *
+from ruffus.combinatorics import product
 
 import sys
 import os
+import glob
 import sqlite3
 import CGAT.Experiment as E
 import CGATPipelines.Pipeline as P
 import re
-from CGAT import GTF
 from CGAT import IOTools
+import PipelinePeaksAndProfiles as PipelinePeaks
+import GenesetCache
 # load options from the config file
 PARAMS = P.getParameters(
     ["%s/pipeline.ini" % os.path.splitext(__file__)[0],
@@ -109,6 +112,24 @@ PARAMS = P.getParameters(
 
 PARAMS["pipelinedir"] = os.path.dirname(__file__)
 
+# scripts shipped with this pipeline
+PARAMS["localscriptsdir"] = os.path.join(PARAMS["pipelinedir"],
+                                         "pipeline_peaksandprofiles")
+
+# the input BAM files, largest expected jobs first if
+# schedule_largestfirst is set, so that their jobs start first
+if PARAMS["schedule_largestfirst"] == 1:
+    INPUTBAMS = PipelinePeaks.orderByCost(glob.glob("*.bam"),
+                                          PARAMS["jobstats_database"])
+else:
+    INPUTBAMS = sorted(glob.glob("*.bam"))
+
+# the input BAM files and the control of each ChIP sample
+MANIFEST = PipelinePeaks.SampleManifest(INPUTBAMS,
+                                        PARAMS["job_inputpersample"],
+                                        PARAMS["job_igginput"],
+                                        PARAMS["job_mainsampleprefix"])
+
 
 # ---------------------------------------------------
 # Specific pipeline tasks
@@ -118,39 +139,134 @@ PARAMS["pipelinedir"] = os.path.dirname(__file__)
 #Example: Cerebellum-Chip-minusCPT-Top1_2.bam
 #Controls must have 1 as the value in the final position
 
-#filters out reads that are unmapped, not a primary alignment or chimeric
-@follows(mkdir("filtered_bams.dir"))
-@transform("*.bam", regex(r"(.+).bam"),
-          r"filtered_bams.dir/\1.filtered.bam")
-def filterreads(infile,outfile):
-    statement='''samtools view -b -o %(outfile)s -F 268 -q 30  %(infile)s'''
-    job_memory="4G"
-    P.run()
-
-
-@follows(mkdir("deduplicated.dir"))
-@transform(filterreads,
-           regex(r"filtered_bams.dir/(.+).bam"),
-           r"deduplicated.dir/\1.deduplicated.bam")
-def removeduplicates(infile, outfile):
-    temp_file=P.snip(outfile, ".deduplicated.bam") + ".temp.bam"
-    metrics_file=P.snip(outfile, ".bam") + ".metrics"
-    statement='''MarkDuplicates I=%(infile)s  
-                                O=%(temp_file)s 
-                                M=%(metrics_file)s > %(temp_file)s.log;
-                                checkpoint;
-                                samtools view
-                                -q 30
-                                -F 1024
-                                -b
-                                %(temp_file)s
-                                > %(outfile)s;
-                                checkpoint;
-                                rm -r %(temp_file)s;
-                                checkpoint;
-                                samtools index %(outfile)s'''
-    job_memory="6G"
-    P.run()
+@follows()
+def checksamples():
+    '''Fail before any job is submitted if an input BAM name can not
+    be parsed. The samples and their controls are listed in
+    samples.tsv. The first task of every branch of the pipeline
+    follows this task. Missing controls are only reported here, they
+    stop the run in checkcontrols.'''
+    MANIFEST.write("samples.tsv")
+    MANIFEST.validate(controls=False)
+    for message in MANIFEST.missing:
+        E.warn(message)
+    E.info("%i samples, %i with controls" %
+           (len(MANIFEST.samples), len(MANIFEST.controls)))
+
+
+@follows(checksamples)
+def checkcontrols():
+    '''Fail if the control of a ChIP sample is missing. Only the peak
+    calling tasks follow this task, so targets that do not call peaks
+    run without controls.'''
+    MANIFEST.validate()
+
+def regionoptions(method):
+    '''return the options restricting the reads read by *method*
+    (samtools or fused) to the target regions, if regions_restrict is
+    set.'''
+    if PARAMS["regions_restrict"] != 1:
+        return ""
+    if method == "samtools":
+        return "-M -L geneset.regions.bed"
+    return "--regions=geneset.regions.bed"
+
+if PARAMS["dedup_method"] == "picard":
+
+    #filters out reads that are unmapped, not a primary alignment or chimeric
+    @follows(mkdir("filtered_bams.dir"), checksamples, "targetregions")
+    @transform(INPUTBAMS, regex(r"(.+).bam"),
+              r"filtered_bams.dir/\1.filtered.bam")
+    @PipelinePeaks.trackContent
+    def filterreads(infile,outfile):
+        regions = regionoptions("samtools")
+        job_threads = PARAMS["threads_filterreads"]
+        statement='''samtools view -@ %(job_threads)s -b -o %(outfile)s -F 268 -q 30 %(regions)s %(infile)s'''
+        job_memory="4G"
+        PipelinePeaks.run()
+
+
+    @follows(mkdir("deduplicated.dir"))
+    @transform(filterreads,
+               regex(r"filtered_bams.dir/(.+).bam"),
+               r"deduplicated.dir/\1.deduplicated.bam")
+    @PipelinePeaks.trackContent
+    def removeduplicates(infile, outfile):
+        temp_file=P.snip(outfile, ".deduplicated.bam") + ".temp.bam"
+        metrics_file=P.snip(outfile, ".bam") + ".metrics"
+        job_threads = PARAMS["threads_removeduplicates"]
+        statement='''MarkDuplicates I=%(infile)s  
+                                    O=%(temp_file)s 
+                                    M=%(metrics_file)s > %(temp_file)s.log;
+                                    checkpoint;
+                                    samtools view
+                                    -@ %(job_threads)s
+                                    -q 30
+                                    -F 1024
+                                    -b
+                                    %(temp_file)s
+                                    > %(outfile)s;
+                                    checkpoint;
+                                    rm -r %(temp_file)s;
+                                    checkpoint;
+                                    samtools index -@ %(job_threads)s %(outfile)s'''
+        job_memory="6G"
+        PipelinePeaks.run()
+
+else:
+
+    #filters reads, removes duplicates and indexes in a single pass
+    @follows(mkdir("deduplicated.dir"), checksamples, "targetregions")
+    @transform(INPUTBAMS, regex(r"(.+).bam"),
+               r"deduplicated.dir/\1.filtered.deduplicated.bam")
+    @PipelinePeaks.trackContent
+    def removeduplicates(infile, outfile):
+        '''Apply the same read filter and Picard style duplicate removal
+        as the samtools/MarkDuplicates chain, reading and writing each
+        BAM only once. Input BAMs must be coordinate sorted.'''
+        metrics_file = P.snip(outfile, ".bam") + ".metrics"
+        filter_flag = PARAMS["dedup_filter_flag"]
+        min_mapq = PARAMS["dedup_min_mapq"]
+        regions = regionoptions("fused")
+        job_threads = PARAMS["threads_removeduplicates"]
+        statement = '''python %(localscriptsdir)s/bam_filter_dedup.py
+                         -b %(infile)s
+                         -o %(outfile)s
+                         --metrics-file=%(metrics_file)s
+                         --filter-flag=%(filter_flag)s
+                         --min-mapq=%(min_mapq)s
+                         %(regions)s
+                         --threads=%(job_threads)s
+                         -L %(outfile)s.log'''
+        job_memory = "2G"
+        PipelinePeaks.run()
+
+
+@active_if(PARAMS["coverage_profiles"] == 1 or PARAMS["coverage_counts"] == 1)
+@follows(mkdir("coverage.dir"))
+@transform(removeduplicates,
+           regex(r"deduplicated.dir/(.+).deduplicated.bam"),
+           r"coverage.dir/\1.contigs.tsv")
+@PipelinePeaks.trackContent
+def buildcoverage(infile, outfile):
+    '''Decode each deduplicated BAM once into binned fragment coverage
+    and fragment centres (see :mod:`CoverageCache`), which the profile
+    and gene counting tasks read instead of the BAM file.'''
+    prefix = P.snip(outfile, ".contigs.tsv")
+    binsize = PARAMS["coverage_binsize"]
+    fragment_length = PARAMS["coverage_fragmentlength"]
+    bigwig = "--bigwig" if PARAMS["coverage_profiles"] == 1 else ""
+    job_threads = PARAMS["coverage_threads"]
+    statement = '''python %(localscriptsdir)s/bam2coverage.py
+                     -b %(infile)s
+                     -P %(prefix)s
+                     --binsize=%(binsize)s
+                     --fragment-length=%(fragment_length)s
+                     --threads=%(job_threads)s
+                     %(bigwig)s
+                     -L %(prefix)s.log'''
+    job_memory = "4G"
+    PipelinePeaks.run()
 
 
 #@transform(prepareBAMForPeakCalling,suffix(".prep.bam"),"deduplicated.bam")
@@ -161,13 +277,39 @@ def removeduplicates(infile, outfile):
     #             %(infile)s
      #            > %(outfile)s'''
     #job_memory="15G"
-    #P.run()
+    #PipelinePeaks.run()
+
+@follows(mkdir(PARAMS["annotations_cachedir"]), checksamples)
+@transform(PARAMS["job_annotations"],
+           formatter(),
+           "geneset.cache")
+@PipelinePeaks.trackContent
+def cacheannotations(infile, outfile):
+    '''Parse the geneset once into a columnar cache (see
+    :mod:`GenesetCache`) that all tasks using the annotations read.
+
+    The cache is stored under the checksum of the geneset in
+    annotations_cachedir and linked to *outfile*, so it is only rebuilt
+    when the geneset changes and can be shared between pipeline runs.'''
+    path = GenesetCache.build(infile, PARAMS["annotations_cachedir"])
+    if os.path.lexists(outfile):
+        os.unlink(outfile)
+    os.symlink(os.path.abspath(path), outfile)
+
 
 @follows("removeduplicates")
-@transform(PARAMS['job_annotations'],regex(r".*.gtf.gz"),"geneset_merged.gtf")
+@transform(cacheannotations,regex(r"geneset.cache"),"geneset_merged.gtf")
+@PipelinePeaks.trackContent
 def mergeexons(infile, outfile):
     gtfmethod=PARAMS['job_gtf2gtfmergemethod']
-    statement='''zcat %(infile)s | 
+    if gtfmethod in ("merge-transcripts", "merge-exons"):
+        GenesetCache.mergeGenes(GenesetCache.load(infile), outfile,
+                                method=gtfmethod)
+        return
+
+    infile = PARAMS["job_annotations"]
+    job_threads = PARAMS["threads_mergeexons"]
+    statement='''bgzip -@ %(job_threads)s -dc %(infile)s | 
                  python ~/devel/cgat/CGAT/scripts/gtf2gtf.py
                  --method=%(gtfmethod)s |
                  python ~/devel/cgat/CGAT/scripts/gtf2gtf.py
@@ -176,54 +318,129 @@ def mergeexons(infile, outfile):
     
 
     job_memory="15G"
-    P.run()
+    PipelinePeaks.run()
                  
 
-@follows("mergeexons")
-@follows(mkdir("genecounts.dir"))
-@transform(removeduplicates,regex(r"deduplicated.dir/(.+).deduplicated.bam"),add_inputs(mergeexons),r"genecounts.dir/\1.counts.txt")
-def getgenecounts(infiles,outfile):
-    bamfile, gtffile = infiles
-    statement='''featureCounts -t exon 
-                               -g gene_id
-                               -a %(gtffile)s 
-                               -o %(outfile)s 
-                               %(bamfile)s'''
-
-    job_memory="6G" 
-    P.run()
-
-@merge(getgenecounts, "combined_gene_counts.txt")
+if PARAMS["coverage_counts"] == 1:
+
+    @follows(mkdir("genecounts.dir"))
+    @transform(buildcoverage, regex(r"coverage.dir/(.+).contigs.tsv"),
+               add_inputs(mergeexons), r"genecounts.dir/\1.counts.txt")
+    @PipelinePeaks.trackContent
+    def getgenecounts(infiles, outfile):
+        '''Count the fragment centres in the exons of each gene from the
+        coverage cache, in the layout of featureCounts.'''
+        coveragefile, gtffile = infiles
+        prefix = P.snip(coveragefile, ".contigs.tsv")
+        bamfile = "deduplicated.dir/%s.deduplicated.bam" % \
+            os.path.basename(prefix)
+        statement = '''python %(localscriptsdir)s/coverage2counts.py
+                         -P %(prefix)s
+                         -g %(gtffile)s
+                         --name=%(bamfile)s
+                         -L %(outfile)s.log
+                         > %(outfile)s'''
+        job_memory = "2G"
+        PipelinePeaks.run()
+
+elif PARAMS["genecounts_batch"] == 0:
+
+    @follows("mergeexons")
+    @follows(mkdir("genecounts.dir"))
+    @transform(removeduplicates,regex(r"deduplicated.dir/(.+).deduplicated.bam"),add_inputs(mergeexons),r"genecounts.dir/\1.counts.txt")
+    @PipelinePeaks.trackContent
+    def getgenecounts(infiles,outfile):
+        bamfile, gtffile = infiles
+        job_threads = PARAMS["genecounts_threads"]
+        statement='''featureCounts -t exon 
+                                   -g gene_id
+                                   -T %(job_threads)s
+                                   -a %(gtffile)s 
+                                   -o %(outfile)s 
+                                   %(bamfile)s'''
+
+        job_memory="6G" 
+        PipelinePeaks.run()
+
+else:
+
+    @follows(mkdir("genecounts.dir"))
+    @merge([removeduplicates, mergeexons],
+           ["genecounts.dir/%s.filtered.counts.txt" % P.snip(x, ".bam")
+            for x in INPUTBAMS])
+    @PipelinePeaks.trackContent
+    def getgenecounts(infiles, outfiles):
+        '''Count all BAM files in batches of genecounts_batchsize (0 for
+        all at once) with one threaded featureCounts run each, so that
+        the annotation is loaded once per batch rather than once per
+        sample. The output is split into the same
+        genecounts.dir/<sample>.counts.txt files as counting every
+        sample on its own, which are the outputs of this task.'''
+        gtffile = [x for x in infiles if x.endswith(".gtf")][0]
+        bamfiles = sorted(x for x in infiles if x.endswith(".bam"))
+        batchsize = PARAMS["genecounts_batchsize"] or len(bamfiles)
+        batches = [bamfiles[x:x + batchsize]
+                   for x in range(0, len(bamfiles), batchsize)]
+
+        job_threads = PARAMS["genecounts_threads"]
+        job_memory = "6G"
+        for batch, batchfiles in enumerate(batches):
+            countsfile = os.path.join("genecounts.dir",
+                                      "batched.batch%03i.txt" % batch)
+            bamfiles = " ".join(batchfiles)
+            statement = '''featureCounts -t exon
+                                         -g gene_id
+                                         -T %(job_threads)s
+                                         -a %(gtffile)s
+                                         -o %(countsfile)s
+                                         %(bamfiles)s'''
+            # record the job under its own inputs and output
+            PipelinePeaks.run(infiles=batchfiles + [gtffile],
+                              outfile=countsfile)
+
+            PipelinePeaks.splitFeatureCounts(
+                countsfile,
+                [os.path.join("genecounts.dir",
+                              P.snip(os.path.basename(bamfile),
+                                     ".deduplicated.bam") + ".counts.txt")
+                 for bamfile in batchfiles])
+            os.unlink(countsfile)
+            os.unlink(countsfile + ".summary")
+
+def mergeoutput(outfile):
+    '''return the merge_tables.py options writing to *outfile*,
+    updating it in place if merge_incremental is set.'''
+    if PARAMS["merge_incremental"] == 1:
+        return "--incremental --output-file=%s" % outfile
+    return "-S %s" % outfile
+
+@follows(getgenecounts)
+@merge("genecounts.dir/*.counts.txt", "combined_gene_counts.txt")
+@PipelinePeaks.checkMergeState
+@PipelinePeaks.trackContent
 def mergegenecounts(infiles, outfile):
     infiles = " ".join(infiles)
-    statement = '''python ~/devel/cgat/CGAT/scripts/combine_tables.py
-                   --use-file-prefix -c 1,2,3,4,5,6 -k 7 --regex-filename="(.+).txt" -S %(outfile)s %(infiles)s'''
-    job_memory="10G" 
-    P.run()
+    output = mergeoutput(outfile)
+    statement = '''python %(localscriptsdir)s/merge_tables.py
+                   --use-file-prefix -c 1,2,3,4,5,6 -k 7 --regex-filename="(.+).txt" %(output)s %(infiles)s'''
+    job_memory="1G" 
+    PipelinePeaks.run()
                 
-@transform(PARAMS["job_annotations"],
+@transform(cacheannotations,
            formatter(),
            "contigs.tsv")
+@PipelinePeaks.trackContent
 def get_contigs(infile, outfile):
     '''Generate a pseudo-contigs file from the geneset, where the length of 
     each contigs is determined by the GTF entry with the highest end coordinate.
     Will not stop things going off the end on contigs, but that doesn't really
     matter for our purposes'''
 
-    last_contig = None
-    max_end = 0
-    outlines = []
-    for entry in GTF.iterator(IOTools.openFile(infile)):
-   
-        if last_contig != None and entry.contig != last_contig:
-            outlines.append([last_contig, str(max_end)])
-            max_end = 0
-            
-        max_end = max(max_end, entry.end)
-        last_contig = entry.contig
-
-    outlines.append([last_contig, str(max_end)])
-    IOTools.writeLines(outfile, outlines, header=None)
+    geneset = GenesetCache.load(infile)
+    IOTools.writeLines(outfile,
+                       [[contig, str(max_end)]
+                        for contig, max_end in geneset.getContigSizes()],
+                       header=None)
 
 #@transform(PARAMS["job_annotations"],
 #           regex(".+(geneset_.+).gtf.gz"),
@@ -245,28 +462,71 @@ def get_contigs(infile, outfile):
 #    outlines.append([last_contig, str(max_end)])
 #    IOTools.writeLines(outfile, outlines, header=None)
 
-@transform(PARAMS["job_annotations"],
+@transform(cacheannotations,
            formatter(),
            add_inputs(get_contigs),
            "geneset.filtered.gtf.gz")
+@PipelinePeaks.trackContent
 def filter_geneset(infiles, outfile):
-    geneset, genome_file = infiles
-    filter_extension_up=PARAMS["job_extension_up"]
-    filter_extension_down=PARAMS["job_extension_down"]
-
-
-        
-    statement = '''cgat gtf2gtf --method=merge-transcripts -I %(geneset)s
-                   | cgat gff2bed --is-gtf -L %(outfile)s.log
-                   | bedtools slop -l %(filter_extension_up)s -r %(filter_extension_down)s
-                     -s -i - -g %(genome_file)s
-                   | sort -k1,1 -k2,2n
-                   | bedtools merge -c 4 -o count
-                   | awk '$4>1'
-                   | bedtools intersect -v -a %(geneset)s -b -
-                   | bgzip > %(outfile)s'''
-    job_memory="10G"
-    P.run()
+    '''Remove genes whose extended windows overlap those of another gene.
+
+    Genes are extended by job_extension_up/job_extension_down, windows
+    touching or overlapping other windows are merged and every GTF
+    entry overlapping a merged region of two or more genes is dropped,
+    as the equivalent gtf2gtf/bedtools slop/merge/intersect pipeline
+    would. Runs in-process on the cached geneset.'''
+    cachefile, genome_file = infiles
+    geneset = PARAMS["job_annotations"]
+    filter_extension_up=int(PARAMS["job_extension_up"])
+    filter_extension_down=int(PARAMS["job_extension_down"])
+
+    contig_sizes = dict((contig, int(size)) for contig, size in
+                        (line.split()[:2] for line in
+                         IOTools.openFile(genome_file) if line.strip()))
+    genes = GenesetCache.load(cachefile)
+    overlapping = GenesetCache.findOverlappingGenes(
+        genes, contig_sizes, filter_extension_up, filter_extension_down)
+
+    tmpfile = P.snip(outfile, ".gz") + ".tmp"
+    nlines = GenesetCache.writeLines(geneset, ~overlapping, tmpfile)
+    threads = PARAMS["threads_filter_geneset"]
+    with PipelinePeaks.reserve("1G", threads):
+        PipelinePeaks.bgzipFile(tmpfile, outfile, threads=threads)
+    os.unlink(tmpfile)
+    E.info("%s: kept %i of %i entries" % (outfile, nlines, len(genes)))
+
+@active_if(PARAMS["regions_restrict"] == 1)
+@transform(cacheannotations,
+           formatter(),
+           add_inputs(get_contigs),
+           "geneset.regions.bed")
+@PipelinePeaks.trackContent
+def targetregions(infiles, outfile):
+    '''Write the regions the reads are restricted to with
+    regions_restrict: the genes kept by filter_geneset, extended by
+    job_extension_up/job_extension_down plus regions_padding on both
+    sides, and merged.'''
+    cachefile, genome_file = infiles
+    filter_extension_up = int(PARAMS["job_extension_up"])
+    filter_extension_down = int(PARAMS["job_extension_down"])
+    padding = int(PARAMS["regions_padding"])
+
+    contig_sizes = dict((contig, int(size)) for contig, size in
+                        (line.split()[:2] for line in
+                         IOTools.openFile(genome_file) if line.strip()))
+    genes = GenesetCache.load(cachefile)
+    overlapping = GenesetCache.findOverlappingGenes(
+        genes, contig_sizes, filter_extension_up, filter_extension_down)
+    regions = GenesetCache.getTargetRegions(
+        genes, ~overlapping, contig_sizes,
+        filter_extension_up + padding, filter_extension_down + padding)
+
+    tmpfile = outfile + ".tmp"
+    IOTools.writeLines(tmpfile, regions)
+    os.rename(tmpfile, outfile)
+    E.info("%s: %i regions covering %i bases" %
+           (outfile, len(regions), sum(end - start
+                                       for contig, start, end in regions)))
 
 #--normalize-transcript=total-sum
 #--normalize-profile=area
@@ -276,33 +536,139 @@ def filter_geneset(infiles, outfile):
 #           r"profiles.dir/\1-\2-\3-\4.bam2geneprofile")
 
 
-@follows(mkdir("profiles.dir"))
-@transform(removeduplicates,regex(r"deduplicated.dir/(.+)-(.+)-(.+).filtered.deduplicated.bam"),
-           add_inputs(filter_geneset),
-           r"profiles.dir/\1-\2-\3.bam2geneprofile")
-def geneprofiles(infiles,outfile):
-    bamfile, filtered_geneset = infiles
-    base=re.search(r"(profiles.dir/.+-.+-.+)bam2geneprofile", outfile, flags = 0)  
-    base=base.group(1)
+def profileinput(bamfile):
+    '''return the bam2geneprofile options reading the reads of
+    *bamfile*, or its cached coverage if coverage_profiles is set.'''
+    if PARAMS["coverage_profiles"] == 1:
+        prefix = "coverage.dir/%s" % P.snip(os.path.basename(bamfile),
+                                            ".deduplicated.bam")
+        return "--bigwig-file=%s.bw" % prefix
+    return "-b %s --merge-pairs" % bamfile
+
+
+def profileoptions(base):
+    '''return the bam2geneprofile method and output options and the
+    statement converting per-transcript profiles written under *base*
+    to binary matrices, if requested.'''
     outputallprofiles = PARAMS["job_outputallprofiles"]
-    inputpersample = PARAMS["job_inputpersample"]
     if outputallprofiles == 1:
         outputprofiles = "--output-all-profiles"
     elif outputallprofiles == 0:
         outputprofiles = ""
-    statement='''python ~/devel/cgat/CGAT/scripts/bam2geneprofile.py
-                 -b %(bamfile)s
-                 -g %(filtered_geneset)s
-                 --reporter=gene
-                 -m geneprofile 
-                 %(outputprofiles)s                 
-                 --normalize-transcript=none
-                 --normalize-profile=none
-                 --merge-pairs
-                 -P %(base)s%%s > 
-                 %(outfile)s'''
-    job_memory="6G"
-    P.run()
+    methods = P.asList(PARAMS["profiles_methods"])
+    tobinary = ""
+    if outputallprofiles == 1 and PARAMS["profiles_binary"] == 1:
+        localscriptsdir = PARAMS["localscriptsdir"]
+        for method in methods:
+            tobinary += '''; checkpoint;
+                python %(localscriptsdir)s/profiles2npy.py
+                -m %(base)s%(method)s.profiles.tsv.gz
+                -P %(base)s%(method)s.profiles
+                -L %(base)s%(method)s.profiles.log;
+                checkpoint;
+                rm -f %(base)s%(method)s.profiles.tsv.gz''' % locals()
+    return methods, outputprofiles, tobinary
+
+
+if PARAMS["scatter_profiles"] == 0:
+
+    @follows(mkdir("profiles.dir"), buildcoverage)
+    @transform(removeduplicates,regex(r"deduplicated.dir/(.+)-(.+)-(.+).filtered.deduplicated.bam"),
+               add_inputs(filter_geneset),
+               r"profiles.dir/\1-\2-\3.bam2profiles")
+    @PipelinePeaks.trackContent
+    def profiles(infiles,outfile):
+        '''Compute every profile listed in profiles_methods (geneprofile,
+        tssprofile, ...) in one bam2geneprofile run, so the BAM file and the
+        geneset are opened and read once per sample. Each method writes
+        its own profiles.dir/<sample>.<method>.matrix.tsv.gz.'''
+        bamfile, filtered_geneset = infiles
+        inputs = profileinput(bamfile)
+        base=re.search(r"(profiles.dir/.+-.+-.+)bam2profiles", outfile, flags = 0)
+        base=base.group(1)
+        methods, outputprofiles, tobinary = profileoptions(base)
+        methods = " ".join("-m %s" % method for method in methods)
+        statement='''python ~/devel/cgat/CGAT/scripts/bam2geneprofile.py
+                     %(inputs)s
+                     -g %(filtered_geneset)s
+                     --reporter=gene
+                     %(methods)s
+                     %(outputprofiles)s
+                     --normalize-transcript=none
+                     --normalize-profile=none
+                     -P %(base)s%%s >
+                     %(outfile)s
+                     %(tobinary)s'''
+        job_memory="6G"
+        PipelinePeaks.run()
+
+else:
+
+    @follows(mkdir("profiles.dir/chunks.dir"))
+    @split([filter_geneset, cacheannotations],
+           "profiles.dir/chunks.dir/geneset.chunk*.gtf.gz")
+    @PipelinePeaks.trackContent
+    def splitgeneset(infiles, outfiles):
+        '''Split the filtered geneset into scatter_chunks chunks of
+        neighbouring genes with similar numbers of entries.'''
+        filtered_geneset, cachefile = infiles
+        for outfile in outfiles:
+            os.unlink(outfile)
+        nchunks = PARAMS["scatter_chunks"]
+        outfiles = ["profiles.dir/chunks.dir/geneset.chunk%03i.gtf.gz" % x
+                    for x in range(nchunks)]
+        GenesetCache.splitGeneset(GenesetCache.load(cachefile),
+                                  filtered_geneset, outfiles)
+
+    @follows(buildcoverage)
+    @product(removeduplicates,
+             formatter(r"deduplicated.dir/(?P<SAMPLE>.+-.+-.+).filtered.deduplicated.bam"),
+             splitgeneset,
+             formatter(r"geneset.(?P<CHUNK>chunk\d+).gtf.gz"),
+             "profiles.dir/chunks.dir/{SAMPLE[0][0]}.{CHUNK[1][0]}.bam2profiles")
+    @PipelinePeaks.trackContent
+    def profilechunks(infiles, outfile):
+        '''Run bam2geneprofile on one chunk of the geneset. The BAM file
+        is indexed, so each chunk only reads the alignments over its own
+        genes and all chunks of a sample run in parallel.'''
+        bamfile, geneset_chunk = infiles
+        inputs = profileinput(bamfile)
+        base = P.snip(outfile, "bam2profiles")
+        methods, outputprofiles, tobinary = profileoptions(base)
+        methods = " ".join("-m %s" % method for method in methods)
+        statement='''python ~/devel/cgat/CGAT/scripts/bam2geneprofile.py
+                     %(inputs)s
+                     -g %(geneset_chunk)s
+                     --reporter=gene
+                     %(methods)s
+                     %(outputprofiles)s
+                     --normalize-transcript=none
+                     --normalize-profile=none
+                     -P %(base)s%%s >
+                     %(outfile)s'''
+        job_memory="2G"
+        PipelinePeaks.run()
+
+    @collate(profilechunks,
+             regex(r"profiles.dir/chunks.dir/(.+)\.chunk\d+\.bam2profiles"),
+             r"profiles.dir/\1.bam2profiles")
+    @PipelinePeaks.trackContent
+    def profiles(infiles, outfile):
+        '''Gather the chunks of a sample into the files a single
+        bam2geneprofile run would have written.'''
+        base = P.snip(outfile, "bam2profiles")
+        methods, outputprofiles, tobinary = profileoptions(base)
+        methods = " ".join("-m %s" % method for method in methods)
+        chunks = " ".join(P.snip(infile, "bam2profiles")
+                          for infile in sorted(infiles))
+        statement='''python %(localscriptsdir)s/gather_profiles.py
+                     %(methods)s
+                     -P %(base)s
+                     %(chunks)s >
+                     %(outfile)s
+                     %(tobinary)s'''
+        job_memory="2G"
+        PipelinePeaks.run()
 
 
 #removed     samplenumber = re.search(r"(deduplicated.dir/.+)-ChIP-(.+)-(.+).filtered.deduplicated.bam",bamfile,flags = 0)
@@ -315,31 +681,6 @@ def geneprofiles(infiles,outfile):
 #@transform(removeduplicates,regex(r"deduplicated.dir/(.+)-(.+)-(.+)-(.+).filtered.deduplicated.bam"),
 #           r"profiles.dir/\1-\2-\3.bam2tssprofile")
 
-@transform(removeduplicates,regex(r"deduplicated.dir/(.+)-(.+)-(.+).filtered.deduplicated.bam"),
-           add_inputs(filter_geneset),
-           r"profiles.dir/\1-\2-\3.bam2tssprofile")
-def tssprofiles(infiles,outfile):
-    bamfile, filtered_geneset = infiles
-    base=re.search(r"(profiles.dir/.+-.+-.+)bam2tssprofile", outfile, flags = 0)  
-    base=base.group(1)
-    outputallprofiles = PARAMS["job_outputallprofiles"]
-    inputpersample = PARAMS["job_inputpersample"]
-    if outputallprofiles == 1:
-        outputprofiles = "--output-all-profiles"
-    elif outputallprofiles == 0:
-        outputprofiles = ""
-    statement='''python ~/devel/cgat/CGAT/scripts/bam2geneprofile.py
-                 -b %(bamfile)s
-                 -g %(filtered_geneset)s
-                 --reporter=gene 
-                 -m tssprofile
-                 %(outputprofiles)s                 
-                 --merge-pairs
-                 -P %(base)s%%s > 
-                 %(outfile)s'''
-    job_memory="6G"
-    P.run()
-
 #removed     if inputpersample == 1:
 #        controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + "-" + samplenumber.group(3) + ".filtered.deduplicated.bam"
 #    elif inputpersample == 0:
@@ -355,115 +696,147 @@ def tssprofiles(infiles,outfile):
 
 #@merge("profiles.dir/*-*-*.bwa.geneprofile.matrix.tsv.gz", "combined_geneprofiles_matrix.txt")
 
-@follows(geneprofiles)
+@follows(profiles)
 @merge("profiles.dir/*-*-*.bwa.geneprofile.matrix.tsv.gz", "combined_geneprofiles_matrix.txt")
+@PipelinePeaks.checkMergeState
+@PipelinePeaks.trackContent
 def mergegeneprofiles(infiles, outfile):
     infiles = " ".join(infiles)
-    statement = '''python ~/devel/cgat/CGAT/scripts/combine_tables.py
+    output = mergeoutput(outfile)
+    statement = '''python %(localscriptsdir)s/merge_tables.py
                    --regex-filename="profiles.dir/(.+)-(.+)-(.+).bwa.geneprofile.matrix.tsv.gz"
                    --cat pulldown,condition,replicate
-                   -S %(outfile)s
+                   %(output)s
                    %(infiles)s'''
-    job_memory="10G"
-    P.run()
+    job_memory="1G"
+    PipelinePeaks.run()
 
 #@merge("profiles.dir/*-*-*-*.bwa.tssprofile.matrix.tsv.gz", "combined_tssprofiles_matrix.txt")
 
-@follows(tssprofiles)
+@follows(profiles)
 @merge("profiles.dir/*-*-*.bwa.tssprofile.matrix.tsv.gz", "combined_tssprofiles_matrix.txt")
+@PipelinePeaks.checkMergeState
+@PipelinePeaks.trackContent
 def mergetssprofiles(infiles, outfile):
     infiles = " ".join(infiles)
-    statement = '''python ~/devel/cgat/CGAT/scripts/combine_tables.py
+    output = mergeoutput(outfile)
+    statement = '''python %(localscriptsdir)s/merge_tables.py
                    --regex-filename="profiles.dir/(.+)-(.+)-(.+).bwa.tssprofile.matrix.tsv.gz"
                    --cat pulldown,condition,replicate
-                   -S %(outfile)s
+                   %(output)s
                    %(infiles)s'''
-    job_memory="10G"
-    P.run()
+    job_memory="1G"
+    PipelinePeaks.run()
 
 
-@follows(mergetssprofiles)
+@follows(removeduplicates)
 @merge("deduplicated.dir/*.bam", "Filtered_Deduplicated_Read_Counts.tsv")
+@PipelinePeaks.trackContent
 def getprocessedreadcounts(infiles, outfile):
-    infiles = " ".join(infiles)
-    statement = '''for i in %(infiles)s; do
-        echo -e $i' \t '$(samtools view -c -F 4 $i) >> Deduplicated_Bam_Read_Numbers.tsv;
-    done'''
-    job_memory="20G"
-    P.run()
-   
+    '''Count the mapped reads of every deduplicated BAM from its index.'''
+    threads = PARAMS["threads_readcounts"]
+    with PipelinePeaks.reserve("1G", threads):
+        PipelinePeaks.writeMappedReadCounts(infiles, outfile,
+                                            threads=threads)
+
+
+@active_if(PARAMS["macs2_cachetags"] == 1)
+@follows(mkdir("macs2tags.dir/cache"))
+@transform(removeduplicates,
+           regex(r"deduplicated.dir/(.+).filtered.deduplicated.bam"),
+           r"macs2tags.dir/\1.tags.bed.gz")
+@PipelinePeaks.trackContent
+def macs2tags(infile, outfile):
+    '''Parse and duplicate-filter each BAM for MACS2 once.
+
+    The tags are stored in macs2tags.dir/cache under a fingerprint of
+    the BAM content and linked to the per-sample output, so every
+    control is converted once however many ChIP samples, peak calling
+    modes and reruns use it.'''
+    fingerprint = PipelinePeaks.fingerprintFile(infile)
+    cachefile = os.path.join("macs2tags.dir", "cache",
+                             fingerprint + ".bed.gz")
+    if not os.path.exists(cachefile):
+        tmpfile = cachefile + ".tmp"
+        peakcallingformat = PARAMS["job_peakcallingformat"]
+        job_threads = PARAMS["threads_macs2tags"]
+        statement = '''macs2 filterdup -i %(infile)s
+                                       -f %(peakcallingformat)s
+                                       --keep-dup=1
+                                       --verbose=2
+                         2> %(outfile)s.log
+                         | bgzip -@ %(job_threads)s > %(tmpfile)s;
+                         checkpoint;
+                         mv %(tmpfile)s %(cachefile)s'''
+        job_memory = "6G"
+        PipelinePeaks.run()
+    if os.path.lexists(outfile):
+        os.unlink(outfile)
+    os.symlink(os.path.join("cache", os.path.basename(cachefile)), outfile)
+
+
+def macs2inputs(bamfile, controlfile):
+    '''return the treatment, control, format and duplicate option to
+    pass to macs2 callpeak, using the cached tags if enabled.'''
+    peakcallingformat = PARAMS["job_peakcallingformat"]
+    if PARAMS["macs2_cachetags"] != 1:
+        return bamfile, controlfile, peakcallingformat, ""
+
+    def _tags(filename):
+        return os.path.join(
+            "macs2tags.dir",
+            P.snip(os.path.basename(filename), ".filtered.deduplicated.bam") +
+            ".tags.bed.gz")
+
+    tagformat = {"BAM": "BED", "BAMPE": "BEDPE"}[peakcallingformat]
+    return _tags(bamfile), _tags(controlfile), tagformat, "--keep-dup all"
 
+
+@follows(macs2tags, checkcontrols)
 @follows(mkdir("broadpeakcalling.dir"))
 @transform(removeduplicates,
 	   regex(r"deduplicated.dir/(.+)-ChIP-(.+)-(.+).filtered.deduplicated.bam"),
            r"broadpeakcalling.dir/\1-ChIP-\2-\3.bam.macs2")
+@PipelinePeaks.trackContent
 def broadpeakcall(infile,outfile):
     bamfile = infile
     peakcalling = PARAMS["job_peakcalling"]
     peakcallingformat = PARAMS["job_peakcallingformat"]
-    inputpersample = PARAMS["job_inputpersample"]
-    IgG_Input = PARAMS["job_igginput"]
-    IgG_input_prefix = PARAMS["job_mainsampleprefix"]
-    samplenumber = re.search(r"(deduplicated.dir/.+)-ChIP-(.+)-(.+).filtered.deduplicated.bam",bamfile,flags = 0)
-    if inputpersample == 1:
-        if re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) != "IgG":
-            controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + "-" + samplenumber.group(3) + ".filtered.deduplicated.bam"
-        elif re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) == "IgG":
-            if IgG_Input == 1:
-                controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + "-" + samplenumber.group(3) + ".filtered.deduplicated.bam"
-            elif IgG_Input == 0:
-                controlfile = "deduplicated.dir/" + IgG_input_prefix + "-Input-" + samplenumber.group(2) + "-" + samplenumber.group(3) + ".filtered.deduplicated.bam"                
-    elif inputpersample == 0:
-        if re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) != "IgG":
-            controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + ".bwa.filtered.deduplicated.bam"
-        elif re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) == "IgG":
-            if IgG_Input == 1:
-                controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + ".bwa.filtered.deduplicated.bam"
-            elif IgG_Input == 0:
-                controlfile = "deduplicated.dir/" + IgG_input_prefix + "-Input-" + samplenumber.group(2) + ".bwa.filtered.deduplicated.bam"
+    controlfile = MANIFEST.getControl(bamfile)
+    bamfile, controlfile, peakcallingformat, keepdup = macs2inputs(bamfile, controlfile)
     drctry=re.search(r"(broadpeakcalling.dir/.+-ChIP-.+-.+).bam.macs2", outfile, flags = 0)
     drc=drctry.group(1)
+    if PARAMS["foldchange_broad"] == 1:
+        bedgraphs = "-B --SPMR"
+    else:
+        bedgraphs = ""
     statement='''macs2 callpeak -t %(bamfile)s 
                                 -c %(controlfile)s
                                 -g hs
                                 --verbose=2
                                 --broad
+                                %(bedgraphs)s
                                 -f %(peakcallingformat)s 
+                                %(keepdup)s
                                 --outdir %(drc)s
                                 --tempdir %(tmpdir)s >
                                 %(outfile)s'''
     job_memory="6G"
-    P.run()
+    PipelinePeaks.run()
 
 
+@follows(macs2tags, checkcontrols)
 @follows(mkdir("narrowpeakcalling.dir"))
 @transform(removeduplicates,
 	   regex(r"deduplicated.dir/(.+)-ChIP-(.+)-(.+).filtered.deduplicated.bam"),
            r"narrowpeakcalling.dir/\1-ChIP-\2-\3.bam.macs2")
+@PipelinePeaks.trackContent
 def narrowpeakcall(infile,outfile):
     bamfile  = infile
     peakcalling = PARAMS["job_peakcalling"]
     peakcallingformat = PARAMS["job_peakcallingformat"]
-    IgG_Input = PARAMS["job_igginput"]
-    IgG_input_prefix = PARAMS["job_mainsampleprefix"]
-    inputpersample = PARAMS["job_inputpersample"]
-    samplenumber = re.search(r"(deduplicated.dir/.+)-ChIP-(.+)-(.+).filtered.deduplicated.bam",bamfile,flags = 0)
-    if inputpersample == 1:
-        if re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) != "IgG":
-            controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + "-" + samplenumber.group(3) + ".filtered.deduplicated.bam"
-        elif re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) == "IgG":
-            if IgG_Input == 1:
-                controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + "-" + samplenumber.group(3) + ".filtered.deduplicated.bam"
-            elif IgG_Input == 0:
-                controlfile = "deduplicated.dir/" + IgG_input_prefix + "-Input-" + samplenumber.group(2) + "-" + samplenumber.group(3) + ".filtered.deduplicated.bam"
-    elif inputpersample == 0:
-        if re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) != "IgG":
-            controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + ".bwa.filtered.deduplicated.bam"
-        elif re.search(r"deduplicated.dir/(.+)-ChIP-.+-.+.filtered.deduplicated.bam",bamfile,flags = 0).group(1) == "IgG":
-            if IgG_Input == 1:
-                controlfile = samplenumber.group(1) + "-Input-" + samplenumber.group(2) + ".bwa.filtered.deduplicated.bam"
-            elif IgG_Input == 0:
-                controlfile = "deduplicated.dir/" + IgG_input_prefix + "-Input-" + samplenumber.group(2) + ".bwa.filtered.deduplicated.bam"
+    controlfile = MANIFEST.getControl(bamfile)
+    bamfile, controlfile, peakcallingformat, keepdup = macs2inputs(bamfile, controlfile)
     drctry=re.search(r"(narrowpeakcalling.dir/.+-ChIP-.+-.+).bam.macs2", outfile, flags = 0)
     drc=drctry.group(1)
     statement='''macs2 callpeak -t %(bamfile)s 
@@ -473,37 +846,69 @@ def narrowpeakcall(infile,outfile):
                                 --call-summits
                                 --verbose=2
                                 -f %(peakcallingformat)s 
+                                %(keepdup)s
                                 --outdir %(drc)s
                                 --tempdir %(tmpdir)s >
                                 %(outfile)s'''
     job_memory="6G"
-    P.run()
+    PipelinePeaks.run()
+
+def foldchange(treatment, control, outfile, task_name):
+    '''Compare the MACS2 treatment pileup with the control lambda and
+    write the result as a bigWig. With foldchange_engine=stream this is
+    done in one pass without intermediate bedGraph files. The job is
+    recorded under *task_name*.'''
+    contigs = PARAMS["foldchange_contigs"]
+    method = PARAMS["foldchange_method"]
+    logfile = outfile + ".log"
+    if PARAMS["foldchange_engine"] == "macs2":
+        cmpfile = os.path.join(os.path.dirname(outfile), "%s.bdg" % method)
+        sortedcmpfile = P.snip(cmpfile, ".bdg") + "_sorted.bdg"
+        statement='''macs2 bdgcmp -t %(treatment)s
+                     -c %(control)s
+                     -o %(cmpfile)s
+                     -m %(method)s ;
+                     checkpoint;
+                     sort -k1,1 -k2,2n %(cmpfile)s > %(sortedcmpfile)s;
+                     checkpoint;
+                     rm %(cmpfile)s;
+                     ~/devel/bedGraphToBigWig %(sortedcmpfile)s
+                     %(contigs)s
+                     %(outfile)s >> %(logfile)s;
+                     checkpoint;
+                     rm %(sortedcmpfile)s'''
+        job_memory="8G"
+    else:
+        statement='''python %(localscriptsdir)s/bdgcmp2bigwig.py
+                     -t %(treatment)s
+                     -c %(control)s
+                     --contigs=%(contigs)s
+                     -m %(method)s
+                     -o %(outfile)s
+                     -L %(logfile)s'''
+        job_memory="2G"
+    PipelinePeaks.run(task_name=task_name)
+
 
 @transform(narrowpeakcall, regex(r"narrowpeakcalling.dir/(.+).bam.macs2"),add_inputs(r"narrowpeakcalling.dir/\1/NA_control_lambda.bdg"),r"narrowpeakcalling.dir/\1/\1.narrow_fc_signal.bw")
+@PipelinePeaks.trackContent
 def foldchangebw(infiles, outfile):
     filetemplate,control = infiles
     sample=re.search(r"narrowpeakcalling.dir/(.+).bam.macs2", filetemplate, flags = 0).group(1)
-    cmpfile="narrowpeakcalling.dir/" + sample + "/narrow_FE.bdg"
-    sortedcmpfile="narrowpeakcalling.dir/" + sample + "/narrow_FE_sorted.bdg"
     newinfile = "narrowpeakcalling.dir/" + sample + "/NA_treat_pileup.bdg"
-    logfile=outfile+".log"
-    statement='''macs2 bdgcmp -t %(newinfile)s
-                 -c %(control)s
-                 -o %(cmpfile)s
-                 -m FE ;
-                 checkpoint;
-                 sort -k1,1 -k2,2n %(cmpfile)s > %(sortedcmpfile)s;
-                 checkpoint;
-                 rm %(cmpfile)s;
-                 ~/devel/bedGraphToBigWig %(sortedcmpfile)s
-                 /shared/sudlab1/General/annotations/hg38_noalt_ensembl85/assembly.dir/contigs.tsv
-                 %(outfile)s >> %(logfile)s;
-                 checkpoint;
-                 rm %(sortedcmpfile)s'''
-    job_memory="8G"
-    P.run()
-                 
-    
+    foldchange(newinfile, control, outfile, "foldchangebw")
+
+
+@active_if(PARAMS["foldchange_broad"] == 1)
+@transform(broadpeakcall, regex(r"broadpeakcalling.dir/(.+).bam.macs2"),add_inputs(r"broadpeakcalling.dir/\1/NA_control_lambda.bdg"),r"broadpeakcalling.dir/\1/\1.broad_fc_signal.bw")
+@PipelinePeaks.trackContent
+def broadfoldchangebw(infiles, outfile):
+    filetemplate,control = infiles
+    sample=re.search(r"broadpeakcalling.dir/(.+).bam.macs2", filetemplate, flags = 0).group(1)
+    newinfile = "broadpeakcalling.dir/" + sample + "/NA_treat_pileup.bdg"
+    foldchange(newinfile, control, outfile, "broadfoldchangebw")
+
+
 #@follows("geneprofiles")
 #@transform("geneprofiles.dir/*geneprofile.profiles.tsv.gz", regex(r"(.+).geneprofile.profiles.tsv.gz"),r"\1.normalisedprofile.tsv.gz")
 #def normaliseprofiles(infile, outfile):
@@ -512,14 +917,79 @@ def foldchangebw(infiles, outfile):
 #                -L /dev/null
 #                > %(outfile)s'''
 #    job_memory="20G"
-#    P.run()
+#    PipelinePeaks.run()
 
 # ---------------------------------------------------
 # Generic pipeline tasks
-@follows(broadpeakcall, getprocessedreadcounts, foldchangebw, mergegeneprofiles, mergetssprofiles, mergegenecounts)
+@follows(broadpeakcall, getprocessedreadcounts, foldchangebw, broadfoldchangebw, mergegeneprofiles, mergetssprofiles, mergegenecounts)
 def full():
     pass
 
 
+@follows(mkdir("preview.dir"), checksamples)
+@transform(INPUTBAMS, regex(r"(.+).bam"), r"preview.dir/\1.bam")
+@PipelinePeaks.trackContent
+def subsamplereads(infile, outfile):
+    '''Subsample each input BAM for a preview run. samtools keeps or
+    drops reads by a hash of their name and preview_seed, so mates
+    stay together and every run selects the same reads.'''
+    fraction = PipelinePeaks.getSubsampleFraction(
+        infile, PARAMS["preview_fraction"], PARAMS["preview_reads"])
+    job_threads = PARAMS["threads_subsamplereads"]
+    if fraction >= 1:
+        statement = '''cp %(infile)s %(outfile)s;
+                       checkpoint;
+                       samtools index -@ %(job_threads)s %(outfile)s'''
+    else:
+        subsample = "%i%s" % (PARAMS["preview_seed"],
+                              ("%.8f" % fraction)[1:])
+        statement = '''samtools view -@ %(job_threads)s -b -s %(subsample)s
+                       -o %(outfile)s %(infile)s;
+                       checkpoint;
+                       samtools index -@ %(job_threads)s %(outfile)s'''
+    job_memory = "1G"
+    PipelinePeaks.run()
+
+
+@merge(subsamplereads, "preview.dir/projection.tsv")
+@PipelinePeaks.trackContent
+def preview(infiles, outfile):
+    '''Run the full target on the subsampled BAM files in preview.dir,
+    which reads the configuration of this directory as ../pipeline.ini,
+    and project the time each task would take on the full data from
+    the job statistics of the preview, which are always recorded.'''
+    with open(os.path.join("preview.dir", "pipeline.ini"), "w") as outf:
+        outf.write("[jobstats]\nrecord=1\n")
+    pipeline = re.sub(r"\.pyc$", ".py", os.path.abspath(__file__))
+    options = PARAMS["preview_options"]
+    statement = '''cd preview.dir &&
+                   python %(pipeline)s make full %(options)s'''
+    to_cluster = False
+    job_memory = "1G"
+    PipelinePeaks.run()
+
+    # the subsets are a fraction of the full files, scale by their size
+    scales = dict(
+        (P.snip(os.path.basename(infile), ".bam"),
+         float(os.path.getsize(os.path.basename(infile))) /
+         max(1, os.path.getsize(infile)))
+        for infile in infiles)
+    database = os.path.join("preview.dir", PARAMS["jobstats_database"])
+    if os.path.exists(database):
+        rows = PipelinePeaks.projectTimings(database, scales)
+    else:
+        E.warn("%s does not exist, no timings to project" % database)
+        rows = []
+
+    IOTools.writeLines(outfile,
+                       [[task, njobs, "%.1f" % wall, "%.1f" % projected,
+                         nscaled]
+                        for task, njobs, wall, projected, nscaled in rows],
+                       header=["task", "jobs", "preview_wall",
+                               "projected_wall", "scaled_jobs"])
+    E.info("preview took %.0fs of job time, projected %.0fs for the "
+           "full data" % (sum(x[2] for x in rows), sum(x[3] for x in rows)))
+
+
 if __name__ == "__main__":
     sys.exit(P.main(sys.argv))
@@ -0,0 +1,194 @@
+'''
+CoverageCache.py - binned fragment coverage of a BAM file
+==========================================================
+
+The fragments of a BAM file are decoded once and stored under a
+common prefix so that later stages can read them without going back
+to the BAM file:
+
+``<prefix>.<contig>.coverage.npy``
+   float32 mean fragment depth in bins of ``binsize`` bases.
+
+``<prefix>.<contig>.centres.npy``
+   sorted int32 positions of the fragment centres, which give exact
+   fragment counts over any interval.
+
+``<prefix>.bw``
+   optionally, the binned depth as a bigWig file. bigWig files are
+   compressed and indexed and can be read by bam2geneprofile in
+   place of the BAM file.
+
+``<prefix>.contigs.tsv``
+   one line per contig with its length and number of fragments,
+   preceded by ``#`` lines recording the bin size, the fragment
+   length and the number of fragments. This file is written last and
+   marks the cache as complete.
+
+All arrays are in NumPy's ``.npy`` format and are opened with
+``numpy.load(..., mmap_mode="r")``, so only the parts that are used
+are read.
+
+Fragments are the template of properly paired reads. Other reads are
+extended to ``fragment_length`` in their direction, or kept at their
+aligned length if ``fragment_length`` is 0. Secondary, supplementary
+and unmapped alignments are ignored.
+
+'''
+
+import os
+import array
+import numpy
+import pysam
+from CGAT import IOTools
+
+
+def iterateFragments(samfile):
+    '''iterate over (contig index, start, end, strand) of the reads in
+    *samfile*.
+
+    Properly paired templates are returned once, from their leftmost
+    read, with *strand* set to None. Other reads are returned with
+    their aligned coordinates and strand.
+    '''
+    for read in samfile.fetch(until_eof=True):
+        if read.is_unmapped or read.is_secondary or read.is_supplementary:
+            continue
+        if read.is_proper_pair:
+            if read.template_length > 0 or \
+               (read.template_length == 0 and read.is_read1):
+                start = read.reference_start
+                yield (read.reference_id, start,
+                       start + max(read.template_length, 1), None)
+        else:
+            yield (read.reference_id, read.reference_start,
+                   read.reference_end, "-" if read.is_reverse else "+")
+
+
+def binCoverage(starts, ends, length, binsize):
+    '''return the mean depth in bins of *binsize* over a contig of
+    *length* covered by fragments [*starts*, *ends*).
+
+    The covered bases up to each bin boundary x are
+    sum(x - s for s < x) - sum(x - e for e < x), computed from the
+    sorted fragment ends without a per-base array.
+    '''
+    boundaries = numpy.minimum(
+        numpy.arange(0, length + binsize, binsize, dtype=numpy.int64),
+        length)
+    total = numpy.zeros(len(boundaries), dtype=numpy.float64)
+    for positions, sign in ((numpy.sort(starts), 1), (numpy.sort(ends), -1)):
+        cumulative = numpy.concatenate(
+            [[0], numpy.cumsum(positions, dtype=numpy.float64)])
+        n = numpy.searchsorted(positions, boundaries, side="left")
+        total += sign * (boundaries * n - cumulative[n])
+    widths = numpy.diff(boundaries)
+    coverage = numpy.diff(total)[:len(widths)]
+    return (coverage / numpy.maximum(widths, 1)).astype(numpy.float32)
+
+
+def build(bamfile, prefix, binsize=10, fragment_length=0, threads=1,
+          bigwig=False):
+    '''build the coverage cache of *bamfile* under *prefix*.'''
+    samfile = pysam.AlignmentFile(bamfile, "rb", threads=threads)
+    contigs = list(samfile.references)
+    lengths = list(samfile.lengths)
+    starts = [array.array("l") for x in contigs]
+    ends = [array.array("l") for x in contigs]
+    nfragments = 0
+
+    for tid, start, end, strand in iterateFragments(samfile):
+        nfragments += 1
+        if strand is not None and fragment_length:
+            if strand == "+":
+                end = min(lengths[tid], start + fragment_length)
+            else:
+                start = max(0, end - fragment_length)
+        starts[tid].append(start)
+        ends[tid].append(end)
+    samfile.close()
+
+    outdir = os.path.dirname(prefix)
+    if outdir and not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    if bigwig:
+        import pyBigWig
+        bw = pyBigWig.open(prefix + ".bw.tmp", "w")
+        bw.addHeader(list(zip(contigs, lengths)))
+
+    rows = []
+    for contig, length, contig_starts, contig_ends in zip(
+            contigs, lengths, starts, ends):
+        contig_starts = numpy.array(contig_starts, dtype=numpy.int64)
+        contig_ends = numpy.array(contig_ends, dtype=numpy.int64)
+        coverage = binCoverage(contig_starts, contig_ends, length, binsize)
+        numpy.save(prefix + ".%s.coverage.npy" % contig, coverage)
+        centres = numpy.sort((contig_starts + contig_ends) // 2)
+        numpy.save(prefix + ".%s.centres.npy" % contig,
+                   centres.astype(numpy.int32))
+        if bigwig and len(coverage):
+            bw.addEntries(contig, 0, values=coverage.astype(numpy.float64),
+                          span=binsize, step=binsize)
+        rows.append([contig, str(length), str(len(centres))])
+
+    if bigwig:
+        bw.close()
+        os.rename(prefix + ".bw.tmp", prefix + ".bw")
+
+    tmpfile = prefix + ".contigs.tsv.tmp"
+    with IOTools.openFile(tmpfile, "w") as outf:
+        outf.write("# binsize\t%i\n" % binsize)
+        outf.write("# fragment_length\t%i\n" % fragment_length)
+        outf.write("# fragments\t%i\n" % nfragments)
+        outf.write("contig\tlength\tfragments\n")
+        for row in rows:
+            outf.write("\t".join(row) + "\n")
+    os.rename(tmpfile, prefix + ".contigs.tsv")
+    return nfragments
+
+
+class Coverage(object):
+    '''read access to a coverage cache.'''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.info = {}
+        self.lengths = {}
+        self.fragments = {}
+        with IOTools.openFile(prefix + ".contigs.tsv") as inf:
+            for line in inf:
+                fields = line.rstrip("\r\n").split("\t")
+                if line.startswith("#"):
+                    self.info[fields[0][1:].strip()] = int(fields[1])
+                elif fields[0] != "contig":
+                    self.lengths[fields[0]] = int(fields[1])
+                    self.fragments[fields[0]] = int(fields[2])
+        self.binsize = self.info["binsize"]
+        self.nfragments = self.info["fragments"]
+        self._centres = {}
+
+    def getCoverage(self, contig):
+        '''return the binned mean depth of *contig*.'''
+        return numpy.load(self.prefix + ".%s.coverage.npy" % contig,
+                          mmap_mode="r")
+
+    def getCentres(self, contig):
+        '''return the sorted fragment centres of *contig*.'''
+        if contig not in self._centres:
+            self._centres[contig] = numpy.load(
+                self.prefix + ".%s.centres.npy" % contig, mmap_mode="r")
+        return self._centres[contig]
+
+    def countFragments(self, contig, starts, ends):
+        '''return the number of fragment centres in each interval
+        [*starts*, *ends*) of *contig*.'''
+        if contig not in self.lengths:
+            return numpy.zeros(len(starts), dtype=numpy.int64)
+        centres = self.getCentres(contig)
+        return (numpy.searchsorted(centres, ends, side="left") -
+                numpy.searchsorted(centres, starts, side="left"))
+
+
+def load(prefix):
+    '''open the coverage cache under *prefix*.'''
+    return Coverage(prefix)
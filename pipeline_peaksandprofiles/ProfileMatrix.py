@@ -0,0 +1,174 @@
+'''
+ProfileMatrix.py - binary storage for per-transcript profile matrices
+======================================================================
+
+A profile matrix is stored under a common prefix as
+
+``<prefix>.npy``
+   float32 matrix with one row per transcript/gene and one column
+   per bin, in NumPy's ``.npy`` format so that it can be opened with
+   ``numpy.load(..., mmap_mode="r")`` without reading it into memory.
+
+``<prefix>.rows.tsv.gz``
+   the row names, one per line, in matrix order.
+
+``<prefix>.header.tsv``
+   the header line of the original text matrix, if it had one.
+
+:class:`Writer` appends rows block by block without knowing the final
+number of rows in advance: the ``.npy`` header is written with a
+fixed size and rewritten with the final shape when the writer is
+closed.
+
+'''
+
+import os
+import struct
+import itertools
+import numpy
+from CGAT import IOTools
+
+# size of the .npy header, large enough for any shape we will write
+HEADER_SIZE = 128
+
+
+def isBinary(filename):
+    '''return True if *filename* names a binary profile matrix.'''
+    return filename.endswith(".npy") or \
+        os.path.exists(filename + ".npy")
+
+
+def getPrefix(filename):
+    if filename.endswith(".npy"):
+        return filename[:-len(".npy")]
+    return filename
+
+
+def buildHeader(nrows, ncols):
+    '''build a .npy version 1.0 header of exactly HEADER_SIZE bytes.'''
+    desc = "{'descr': '<f4', 'fortran_order': False, 'shape': (%i, %i), }" \
+        % (nrows, ncols)
+    desc = desc.ljust(HEADER_SIZE - 11) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(desc)) + \
+        desc.encode("latin1")
+
+
+class Writer(object):
+    '''write a profile matrix block by block.'''
+
+    def __init__(self, prefix, header=None):
+        self.prefix = prefix
+        self.ncols = None
+        self.nrows = 0
+        self.outf = open(prefix + ".npy", "wb")
+        self.outf.write(buildHeader(0, 0))
+        self.rows = IOTools.openFile(prefix + ".rows.tsv.gz", "w")
+        if header is not None:
+            with IOTools.openFile(prefix + ".header.tsv", "w") as outf:
+                outf.write(header.rstrip("\r\n") + "\n")
+        elif os.path.exists(prefix + ".header.tsv"):
+            os.unlink(prefix + ".header.tsv")
+
+    def write(self, names, matrix):
+        '''append rows *names* with values *matrix*.'''
+        if len(names) == 0:
+            return
+        matrix = numpy.ascontiguousarray(matrix, dtype="<f4")
+        if self.ncols is None:
+            self.ncols = matrix.shape[1]
+        elif matrix.shape[1] != self.ncols:
+            raise ValueError("expected %i columns, got %i" %
+                             (self.ncols, matrix.shape[1]))
+        self.outf.write(matrix.tobytes())
+        self.rows.write("".join("%s\n" % name for name in names))
+        self.nrows += len(names)
+
+    def close(self):
+        self.outf.seek(0)
+        self.outf.write(buildHeader(self.nrows, self.ncols or 0))
+        self.outf.close()
+        self.rows.close()
+
+
+def load(filename):
+    '''open a binary profile matrix.
+
+    Returns a tuple (header, names, matrix) where *matrix* is a
+    read-only memory map and *header* is None if the original text
+    file had no header.
+    '''
+    prefix = getPrefix(filename)
+    matrix = numpy.load(prefix + ".npy", mmap_mode="r")
+    with IOTools.openFile(prefix + ".rows.tsv.gz") as inf:
+        names = [line.rstrip("\r\n") for line in inf]
+    if len(names) != matrix.shape[0]:
+        raise ValueError("%s: %i row names for %i rows" %
+                         (prefix, len(names), matrix.shape[0]))
+    header = None
+    if os.path.exists(prefix + ".header.tsv"):
+        with IOTools.openFile(prefix + ".header.tsv") as inf:
+            header = inf.readline().rstrip("\r\n")
+    return header, names, matrix
+
+
+def iterateChunks(filename, chunk_size):
+    '''iterate over blocks of (names, matrix) of a binary matrix.
+
+    The matrix blocks are views into the memory map, no data is
+    copied.
+    '''
+    header, names, matrix = load(filename)
+    for start in range(0, len(names), chunk_size):
+        yield names[start:start + chunk_size], \
+            matrix[start:start + chunk_size]
+
+
+def iterateTextChunks(infile, chunk_size):
+    '''iterate over blocks of (names, matrix) of a text matrix.
+
+    The first line of *infile* must already have been consumed if it
+    is a header. Empty lines are skipped.
+    '''
+    while True:
+        lines = list(itertools.islice(infile, chunk_size))
+        if not lines:
+            break
+        names, rows = [], []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.split("\t")
+            names.append(fields[0])
+            rows.append(fields[1:])
+        if names:
+            yield names, numpy.array(rows, dtype=numpy.float64)
+
+
+def isHeader(line):
+    '''return True if *line* is not a row of numbers.'''
+    try:
+        [float(col) for col in line.strip().split("\t")[1:]]
+    except ValueError:
+        return True
+    return False
+
+
+def fromText(infile, prefix, chunk_size=10000):
+    '''convert the text matrix *infile* to a binary matrix at *prefix*.
+
+    Returns the number of rows written.
+    '''
+    inf = IOTools.openFile(infile)
+    first = inf.readline()
+    if first and isHeader(first):
+        header, lines = first, inf
+    else:
+        header, lines = None, itertools.chain([first] if first else [], inf)
+
+    writer = Writer(prefix, header=header)
+    for names, matrix in iterateTextChunks(lines, chunk_size):
+        writer.write(names, matrix)
+    writer.close()
+    inf.close()
+    return writer.nrows
@@ -0,0 +1,105 @@
+'''
+bam2coverage.py - build the coverage cache of a BAM file
+=========================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Decodes a BAM file once and writes its fragment coverage and fragment
+centres under ``--output-prefix`` (see :mod:`CoverageCache`). The
+profile and gene counting stages of the pipeline read this cache
+instead of the BAM file.
+
+Usage
+-----
+
+Example::
+
+   python bam2coverage.py -b sample.bam --binsize=10
+       --fragment-length=200 --bigwig -P coverage.dir/sample
+
+Type::
+
+   python bam2coverage.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import CGAT.Experiment as E
+import CoverageCache
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bam-file", dest="bamfile", type="string",
+                      help="BAM file to read")
+
+    parser.add_option("-P", "--output-prefix", dest="output_prefix",
+                      type="string",
+                      help="prefix of the coverage cache")
+
+    parser.add_option("--binsize", dest="binsize", type="int",
+                      help="size of the coverage bins, 1 for base "
+                      "resolution")
+
+    parser.add_option("--fragment-length", dest="fragment_length",
+                      type="int",
+                      help="length to extend reads that are not properly "
+                      "paired to, 0 to keep their aligned length")
+
+    parser.add_option("--bigwig", dest="bigwig", action="store_true",
+                      help="also write the coverage as a bigWig file "
+                      "(requires pyBigWig)")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="threads used to decompress the BAM file")
+
+    parser.set_defaults(
+        bamfile=None,
+        output_prefix=None,
+        binsize=10,
+        fragment_length=0,
+        bigwig=False,
+        threads=1)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.bamfile:
+        raise ValueError("please specify a --bam-file")
+    if not options.output_prefix:
+        raise ValueError("please specify an --output-prefix")
+
+    nfragments = CoverageCache.build(
+        options.bamfile, options.output_prefix,
+        binsize=options.binsize,
+        fragment_length=options.fragment_length,
+        threads=options.threads,
+        bigwig=options.bigwig)
+    E.info("cached the coverage of %i fragments" % nfragments)
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,660 @@
+'''
+bam_filter_dedup.py - filter reads and remove duplicates in one pass
+=====================================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Replaces the chain ``samtools view -F 268 -q 30``, Picard
+``MarkDuplicates``, ``samtools view -q 30 -F 1024`` and ``samtools
+index`` with a single streaming pass over a coordinate sorted BAM
+file.
+
+Reads are filtered on their flag and mapping quality first. The
+remaining reads are grouped into duplicate sets the way Picard does:
+
+* pairs are keyed on the unclipped 5' position and strand of both
+  mates, the pair with the highest sum of base qualities (>= 15) is
+  kept,
+* unpaired reads are keyed on their own unclipped 5' position and
+  strand. They are duplicates if a paired read shares that position,
+  otherwise all but the best scoring read are duplicates,
+* pairs whose mate did not pass the filter are never duplicates,
+* secondary and supplementary alignments are passed through.
+
+Reads are held back only until every read that could share their
+duplicate set has been seen. Pairs whose mates map further away than
+``--max-distance`` (or to another contig) are decided when the first
+mate is seen, using the ``MC``, ``MQ`` and ``ms`` tags written by
+``samtools fixmate -m`` where present.
+
+With ``--regions``, only reads overlapping the regions in a BED file
+are read, through the index of the input BAM file. Each read is
+returned once, in coordinate order, even if it overlaps several
+regions. Mates outside the regions are treated as if they did not
+pass the filter.
+
+The metrics file follows the layout of Picard's DuplicationMetrics.
+Optical duplicates are not detected, READ_PAIR_OPTICAL_DUPLICATES is
+always 0.
+
+Usage
+-----
+
+Example::
+
+   python bam_filter_dedup.py -b sample.bam -o sample.deduplicated.bam
+          --metrics-file=sample.deduplicated.metrics
+
+Type::
+
+   python bam_filter_dedup.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import re
+import math
+import heapq
+import time
+import collections
+import pysam
+import CGAT.Experiment as E
+from CGAT import IOTools
+
+UNKNOWN_LIBRARY = "Unknown Library"
+
+METRICS_COLUMNS = ("LIBRARY",
+                   "UNPAIRED_READS_EXAMINED",
+                   "READ_PAIRS_EXAMINED",
+                   "SECONDARY_OR_SUPPLEMENTARY_RDS",
+                   "UNMAPPED_READS",
+                   "UNPAIRED_READ_DUPLICATES",
+                   "READ_PAIR_DUPLICATES",
+                   "READ_PAIR_OPTICAL_DUPLICATES",
+                   "PERCENT_DUPLICATION",
+                   "ESTIMATED_LIBRARY_SIZE")
+
+# cigar operations for soft and hard clips
+CLIPS = (4, 5)
+
+
+class Entry(object):
+    '''a read waiting in the output buffer.'''
+    __slots__ = ("read", "duplicate", "resolved")
+
+    def __init__(self, read):
+        self.read = read
+        self.duplicate = False
+        self.resolved = False
+
+
+def baseQualityScore(read):
+    '''Picard's SUM_OF_BASE_QUALITIES score.'''
+    quals = read.query_qualities
+    if quals is None:
+        return 0
+    return min(sum(q for q in quals if q >= 15), 16383)
+
+
+def unclippedFivePrime(read):
+    '''return the 0-based unclipped 5' coordinate of *read*.'''
+    cigar = read.cigartuples
+    clip = 0
+    if read.is_reverse:
+        for op, length in reversed(cigar):
+            if op not in CLIPS:
+                break
+            clip += length
+        return read.reference_end - 1 + clip
+    else:
+        for op, length in cigar:
+            if op not in CLIPS:
+                break
+            clip += length
+        return read.reference_start - clip
+
+
+def mateFivePrime(read):
+    '''estimate the unclipped 5' coordinate of the mate of *read*.
+
+    Uses the ``MC`` tag if present. Without it, the mate is assumed
+    to align ungapped over the same length as *read*.
+    '''
+    if read.has_tag("MC"):
+        ops = re.findall(r"(\d+)([MIDNSHP=X])", read.get_tag("MC"))
+        if read.mate_is_reverse:
+            reflen = sum(int(l) for l, op in ops if op in "MDN=X")
+            clip = 0
+            for l, op in reversed(ops):
+                if op not in "SH":
+                    break
+                clip += int(l)
+            return read.next_reference_start + reflen - 1 + clip
+        else:
+            clip = 0
+            for l, op in ops:
+                if op not in "SH":
+                    break
+                clip += int(l)
+            return read.next_reference_start - clip
+    if read.mate_is_reverse:
+        return read.next_reference_start + read.query_length - 1
+    return read.next_reference_start
+
+
+def estimateLibrarySize(read_pairs, unique_read_pairs):
+    '''Picard's estimate of the number of unique molecules.'''
+
+    def f(x, c, n):
+        return c / x - 1 + math.exp(-n / x)
+
+    read_pairs = float(read_pairs)
+    unique_read_pairs = float(unique_read_pairs)
+    if read_pairs <= 0 or read_pairs - unique_read_pairs <= 0:
+        return None
+    if unique_read_pairs >= read_pairs or \
+       f(unique_read_pairs, unique_read_pairs, read_pairs) < 0:
+        return None
+
+    m, M = 1.0, 100.0
+    while f(M * unique_read_pairs, unique_read_pairs, read_pairs) > 0:
+        M *= 10.0
+    for i in range(40):
+        r = (m + M) / 2.0
+        u = f(r * unique_read_pairs, unique_read_pairs, read_pairs)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return int(unique_read_pairs * (m + M) / 2.0)
+
+
+class DuplicationMetrics(object):
+    '''counters per library, as in picard.sam.DuplicationMetrics.'''
+
+    def __init__(self, library):
+        self.library = library
+        self.unpaired = 0
+        self.paired = 0
+        self.secondary = 0
+        self.unpaired_duplicates = 0
+        self.paired_duplicates = 0
+
+    def asRow(self):
+        read_pairs = self.paired // 2
+        pair_duplicates = self.paired_duplicates // 2
+        examined = self.unpaired + read_pairs * 2
+        if examined:
+            percent = float(self.unpaired_duplicates +
+                            pair_duplicates * 2) / examined
+        else:
+            percent = 0.0
+        size = estimateLibrarySize(read_pairs,
+                                   read_pairs - pair_duplicates)
+        return [self.library,
+                self.unpaired,
+                read_pairs,
+                self.secondary,
+                0,
+                self.unpaired_duplicates,
+                pair_duplicates,
+                0,
+                "%.6f" % percent,
+                "" if size is None else size]
+
+
+class DuplicateMarker(object):
+    '''mark duplicates on a coordinate sorted stream of reads.
+
+    Reads are passed in with :meth:`add` (reads passing the filter)
+    and :meth:`discard` (reads failing it). Reads become available
+    in input order from :meth:`ready` once their duplicate status is
+    known.
+    '''
+
+    def __init__(self, libraries, window=1000, max_distance=10000,
+                 min_mapq=30):
+        self.libraries = libraries
+        self.window = window
+        self.max_distance = max(max_distance, window)
+        self.min_mapq = min_mapq
+
+        self.buffer = collections.deque()
+        # (tid, due, counter, kind, key) - groups complete once the
+        # stream has moved past (tid, due)
+        self.heap = []
+        self.counter = 0
+
+        self.fragments = {}
+        self.pairs = {}
+        self.far_pairs = {}
+
+        # first mates waiting for their mate
+        self.pending = {}
+        # first mates of far pairs, already decided
+        self.decided = {}
+        # names of primary reads that failed the filter
+        self.filtered = set()
+
+        self.metrics = collections.OrderedDict()
+
+    def getMetrics(self, library):
+        try:
+            return self.metrics[library]
+        except KeyError:
+            m = self.metrics[library] = DuplicationMetrics(library)
+            return m
+
+    def getLibrary(self, read):
+        try:
+            return self.libraries.get(read.get_tag("RG"),
+                                      UNKNOWN_LIBRARY)
+        except KeyError:
+            return UNKNOWN_LIBRARY
+
+    def getName(self, read):
+        if read.has_tag("RG"):
+            return "%s:%s" % (read.get_tag("RG"), read.query_name)
+        return read.query_name
+
+    def schedule(self, tid, due, kind, key):
+        self.counter += 1
+        heapq.heappush(self.heap, (tid, due, self.counter, kind, key))
+
+    def dueFor(self, pos, reverse):
+        '''position after which no more reads can share a 5' end.'''
+        if reverse:
+            return pos
+        return pos + self.window
+
+    def advance(self, tid, pos):
+        '''finalize all groups that are complete at (*tid*, *pos*).'''
+        heap = self.heap
+        while heap and (heap[0][0], heap[0][1]) < (tid, pos):
+            self.finalize(heapq.heappop(heap))
+
+    def flush(self):
+        '''finalize all remaining groups at the end of the input.'''
+        while self.heap:
+            self.finalize(heapq.heappop(self.heap))
+        for name in list(self.pending.keys()):
+            self.resolveOrphan(name)
+
+    def finalize(self, item):
+        kind, key = item[3], item[4]
+
+        if kind == "fragment":
+            has_paired, members = self.fragments.pop(key)
+            best = None
+            if not has_paired:
+                for score, entry in members:
+                    if best is None or score > best[0]:
+                        best = (score, entry)
+            for score, entry in members:
+                if best is None or entry is not best[1]:
+                    self.setDuplicate(entry, False)
+                entry.resolved = True
+
+        elif kind in ("pair", "far"):
+            if kind == "pair":
+                members = self.pairs.pop(key)
+            else:
+                members = self.far_pairs.pop(key)
+            best = None
+            for member in members:
+                if best is None or member[0] > best[0]:
+                    best = member
+            for member in members:
+                for entry in member[1:]:
+                    if member is not best:
+                        self.setDuplicate(entry, True)
+                    entry.resolved = True
+
+        elif kind == "mate":
+            # mate never turned up, treat as orphan
+            if key in self.pending:
+                self.resolveOrphan(key)
+
+    def setDuplicate(self, entry, paired):
+        entry.duplicate = True
+        metrics = self.getMetrics(self.getLibrary(entry.read))
+        if paired:
+            metrics.paired_duplicates += 1
+        else:
+            metrics.unpaired_duplicates += 1
+
+    def resolveOrphan(self, name):
+        entry = self.pending.pop(name)[0]
+        entry.resolved = True
+
+    def discard(self, read):
+        '''register a read that failed the filter.'''
+        if read.is_unmapped or read.is_secondary or \
+           read.is_supplementary or not read.is_paired or \
+           read.mate_is_unmapped:
+            return
+        name = self.getName(read)
+        if name in self.pending:
+            self.resolveOrphan(name)
+        elif name in self.filtered or name in self.decided:
+            self.filtered.discard(name)
+            self.decided.pop(name, None)
+        elif (read.next_reference_id, read.next_reference_start) >= \
+                (read.reference_id, read.reference_start):
+            self.filtered.add(name)
+
+    def add(self, read):
+        '''add a read that passed the filter.'''
+        tid = read.reference_id
+        self.advance(tid, read.reference_start)
+
+        entry = Entry(read)
+        self.buffer.append(entry)
+        library = self.getLibrary(read)
+        metrics = self.getMetrics(library)
+
+        if read.is_secondary or read.is_supplementary:
+            metrics.secondary += 1
+            entry.resolved = True
+            return
+
+        reverse = read.is_reverse
+        pos = unclippedFivePrime(read)
+        score = baseQualityScore(read)
+        paired = read.is_paired and not read.mate_is_unmapped
+
+        key = (library, tid, pos, reverse)
+        group = self.fragments.get(key)
+        if group is None:
+            group = self.fragments[key] = [False, []]
+            self.schedule(tid, self.dueFor(pos, reverse), "fragment", key)
+
+        if not paired:
+            metrics.unpaired += 1
+            group[1].append((score, entry))
+            return
+
+        group[0] = True
+        metrics.paired += 1
+        name = self.getName(read)
+
+        if name in self.pending:
+            first, first_end, first_score = self.pending.pop(name)
+            ends = sorted((first_end, (tid, pos, reverse)))
+            key = (library,) + ends[0] + ends[1]
+            members = self.pairs.get(key)
+            if members is None:
+                members = self.pairs[key] = []
+                self.schedule(ends[1][0],
+                              self.dueFor(ends[1][1], ends[1][2]),
+                              "pair", key)
+            members.append((first_score + score, first, entry))
+
+        elif name in self.decided:
+            first = self.decided.pop(name)
+            if first.duplicate:
+                self.setDuplicate(entry, True)
+            entry.resolved = True
+
+        elif name in self.filtered:
+            self.filtered.discard(name)
+            entry.resolved = True
+
+        elif (read.next_reference_id, read.next_reference_start) < \
+                (tid, read.reference_start):
+            # mate should have been seen already
+            entry.resolved = True
+
+        elif read.next_reference_id != tid or \
+                read.next_reference_start - read.reference_start > \
+                self.max_distance:
+            self.addFarPair(read, entry, library, name,
+                            (tid, pos, reverse), score)
+
+        else:
+            self.pending[name] = (entry, (tid, pos, reverse), score)
+            self.schedule(read.next_reference_id,
+                          read.next_reference_start,
+                          "mate", name)
+
+    def addFarPair(self, read, entry, library, name, end, score):
+        '''decide a pair with a distant mate on the first mate.'''
+        if read.has_tag("MQ") and read.get_tag("MQ") < self.min_mapq:
+            entry.resolved = True
+            self.filtered.add(name)
+            return
+
+        if read.has_tag("ms"):
+            mate_score = read.get_tag("ms")
+        else:
+            mate_score = score
+        mate_end = (read.next_reference_id,
+                    mateFivePrime(read),
+                    read.mate_is_reverse)
+        ends = sorted((end, mate_end))
+        key = (library,) + ends[0] + ends[1]
+        members = self.far_pairs.get(key)
+        if members is None:
+            members = self.far_pairs[key] = []
+            self.schedule(end[0], self.dueFor(end[1], end[2]), "far", key)
+        members.append((score + mate_score, entry))
+        self.decided[name] = entry
+
+    def ready(self):
+        '''iterate over reads whose status has been decided.'''
+        buf = self.buffer
+        while buf and buf[0].resolved:
+            yield buf.popleft()
+
+
+def readRegions(bedfile):
+    '''return a sorted list of (contig, start, end) in *bedfile*,
+    with overlapping and book-ended regions merged.'''
+    regions = []
+    with IOTools.openFile(bedfile) as inf:
+        for line in inf:
+            if line.startswith(("#", "track", "browser")) or not line.strip():
+                continue
+            fields = line.split("\t")
+            regions.append((fields[0], int(fields[1]), int(fields[2])))
+    regions.sort()
+    merged = []
+    for contig, start, end in regions:
+        if merged and merged[-1][0] == contig and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([contig, start, end])
+    return [tuple(x) for x in merged]
+
+
+def iterateRegions(infile, regions):
+    '''iterate over the reads in *infile* overlapping *regions*, in
+    the order of the file.
+
+    A read overlapping several regions is returned with the first,
+    reads starting before the end of the previous region of a contig
+    are skipped.
+    '''
+    order = dict((contig, n) for n, contig in enumerate(infile.references))
+    regions = sorted((x for x in regions if x[0] in order),
+                     key=lambda x: (order[x[0]], x[1]))
+    last_contig, last_end = None, 0
+    for contig, start, end in regions:
+        if contig != last_contig:
+            last_contig, last_end = contig, 0
+        for read in infile.fetch(contig, start, end):
+            if read.reference_start < last_end:
+                continue
+            yield read
+        last_end = end
+
+
+def writeMetrics(outfile, metrics, argv):
+
+    outf = IOTools.openFile(outfile, "w")
+    outf.write("## htsjdk.samtools.metrics.StringHeader\n")
+    outf.write("# %s\n" % " ".join(argv))
+    outf.write("## htsjdk.samtools.metrics.StringHeader\n")
+    outf.write("# Started on: %s\n\n" % time.asctime())
+    outf.write("## METRICS CLASS\tpicard.sam.DuplicationMetrics\n")
+    outf.write("\t".join(METRICS_COLUMNS) + "\n")
+    for m in metrics.values():
+        outf.write("\t".join(map(str, m.asRow())) + "\n")
+    outf.write("\n")
+    outf.close()
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bam-file", dest="bamfile", type="string",
+                      help="coordinate sorted input bam file")
+
+    parser.add_option("-o", "--output-bam", dest="output_bam",
+                      type="string",
+                      help="output bam file, will be indexed")
+
+    parser.add_option("--metrics-file", dest="metrics_file",
+                      type="string",
+                      help="output file for duplication metrics")
+
+    parser.add_option("-F", "--filter-flag", dest="filter_flag",
+                      type="int",
+                      help="drop reads with any of these flags set")
+
+    parser.add_option("-q", "--min-mapq", dest="min_mapq", type="int",
+                      help="drop reads below this mapping quality")
+
+    parser.add_option("--mark-only", dest="remove_duplicates",
+                      action="store_false",
+                      help="flag duplicates instead of removing them")
+
+    parser.add_option("--window", dest="window", type="int",
+                      help="largest expected read length including "
+                      "clipped bases")
+
+    parser.add_option("--max-distance", dest="max_distance", type="int",
+                      help="mates further apart than this are decided "
+                      "on the first mate")
+
+    parser.add_option("--regions", dest="regions", type="string",
+                      help="BED file of regions to read, requires an "
+                      "indexed BAM file")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="threads used to decompress, compress and "
+                      "index BAM files")
+
+    parser.set_defaults(
+        bamfile=None,
+        output_bam=None,
+        regions=None,
+        threads=1,
+        metrics_file=None,
+        filter_flag=268,
+        min_mapq=30,
+        remove_duplicates=True,
+        window=1000,
+        max_distance=10000)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.bamfile or not options.output_bam:
+        raise ValueError("please specify --bam-file and --output-bam")
+
+    infile = pysam.AlignmentFile(options.bamfile, "rb",
+                                 threads=options.threads)
+    header = infile.header
+    if hasattr(header, "to_dict"):
+        header = header.to_dict()
+    else:
+        header = dict(header)
+
+    if header.get("HD", {}).get("SO") != "coordinate":
+        E.warn("%s is not flagged as coordinate sorted" % options.bamfile)
+
+    libraries = dict((rg["ID"], rg.get("LB", UNKNOWN_LIBRARY))
+                     for rg in header.get("RG", []))
+    header.setdefault("PG", []).append(
+        {"ID": "bam_filter_dedup",
+         "PN": "bam_filter_dedup.py",
+         "CL": " ".join(argv)})
+
+    outfile = pysam.AlignmentFile(options.output_bam, "wb", header=header,
+                                  threads=options.threads)
+
+    marker = DuplicateMarker(libraries,
+                             window=options.window,
+                             max_distance=options.max_distance,
+                             min_mapq=options.min_mapq)
+
+    filter_flag, min_mapq = options.filter_flag, options.min_mapq
+    remove = options.remove_duplicates
+    ninput, noutput = 0, 0
+
+    def _write():
+        n = 0
+        for entry in marker.ready():
+            if entry.duplicate:
+                if remove:
+                    continue
+                entry.read.is_duplicate = True
+            outfile.write(entry.read)
+            n += 1
+        return n
+
+    if options.regions:
+        regions = readRegions(options.regions)
+        E.info("reading %i regions" % len(regions))
+        reads = iterateRegions(infile, regions)
+    else:
+        reads = infile.fetch(until_eof=True)
+
+    for read in reads:
+        ninput += 1
+        if read.flag & filter_flag or read.mapping_quality < min_mapq:
+            marker.discard(read)
+            continue
+        marker.add(read)
+        noutput += _write()
+
+    marker.flush()
+    noutput += _write()
+
+    outfile.close()
+    infile.close()
+    pysam.index("-@", str(options.threads), options.output_bam)
+
+    if options.metrics_file:
+        writeMetrics(options.metrics_file, marker.metrics, argv)
+
+    E.info("ninput=%i, noutput=%i" % (ninput, noutput))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
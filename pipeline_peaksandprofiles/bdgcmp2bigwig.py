@@ -0,0 +1,300 @@
+'''
+bdgcmp2bigwig.py - compare MACS2 bedGraph tracks straight into a bigWig
+========================================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Replaces ``macs2 bdgcmp``, ``sort`` and ``bedGraphToBigWig`` for the
+treatment pileup and control lambda tracks written by ``macs2
+callpeak -B``. Both bedGraph files are read together, contig by
+contig, the comparison is computed for every interval where either
+track changes and the result is written directly to a bigWig file.
+No intermediate files are written.
+
+Methods follow ``macs2 bdgcmp``:
+
+FE
+   (treatment + pseudocount) / (control + pseudocount)
+
+logLR
+   log10 likelihood ratio of the treatment against the control
+   (positive for enrichment, negative for depletion)
+
+ppois
+   -log10 Poisson p-value of the treatment given the control as
+   expectation
+
+Intervals are clipped to the contig sizes given with ``--contigs``.
+Contigs are written in the order in which they appear in the
+treatment file. Requires the pyBigWig module.
+
+Usage
+-----
+
+Example::
+
+   python bdgcmp2bigwig.py
+       -t NA_treat_pileup.bdg -c NA_control_lambda.bdg
+       --contigs=contigs.tsv -m FE -o sample.narrow_fc_signal.bw
+
+Type::
+
+   python bdgcmp2bigwig.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import math
+import collections
+import pyBigWig
+import CGAT.Experiment as E
+from CGAT import IOTools
+
+LN10 = math.log(10)
+
+
+def indexBedGraph(filename):
+    '''return an ordered dictionary of contig to (start, end) byte
+    offsets in *filename*.
+
+    Lines of a contig must be contiguous and sorted by position, as
+    MACS2 writes them.
+    '''
+    index = collections.OrderedDict()
+    contig, start, offset = None, 0, 0
+    with open(filename, "rb") as inf:
+        for line in inf:
+            if line.startswith(b"track") or line.startswith(b"#"):
+                offset += len(line)
+                continue
+            this = line[:line.index(b"\t")].decode()
+            if this != contig:
+                if contig is not None:
+                    if contig in index:
+                        raise ValueError(
+                            "%s: contig %s is not contiguous" %
+                            (filename, contig))
+                    index[contig] = (start, offset)
+                contig, start = this, offset
+            offset += len(line)
+    if contig is not None:
+        index[contig] = (start, offset)
+    return index
+
+
+def iterateIntervals(inf, start, end):
+    '''iterate over (start, end, value) between byte offsets.'''
+    inf.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        line = inf.readline()
+        if not line:
+            break
+        remaining -= len(line)
+        fields = line.split(b"\t")
+        yield int(fields[1]), int(fields[2]), float(fields[3])
+
+
+def iterateSegments(treatment, control):
+    '''merge two step functions into (start, end, t, c) segments
+    covered by both tracks.'''
+    t = next(treatment, None)
+    c = next(control, None)
+    while t is not None and c is not None:
+        start = max(t[0], c[0])
+        end = min(t[1], c[1])
+        if start < end:
+            yield start, end, t[2], c[2]
+        if t[1] <= c[1]:
+            t = next(treatment, None)
+        else:
+            c = next(control, None)
+
+
+def foldEnrichment(t, c, pseudocount):
+    c += pseudocount
+    if c == 0:
+        return 0.0
+    return (t + pseudocount) / c
+
+
+def logLikelihoodRatio(t, c, pseudocount):
+    x, y = t + pseudocount, c + pseudocount
+    if x == y or y <= 0:
+        return 0.0
+    xlogx = x * math.log(x) if x > 0 else 0.0
+    s = xlogx - x * math.log(y) + y - x
+    if x < y:
+        s = -s
+    return s / LN10
+
+
+class PoissonScore(object):
+    '''-log10 of the upper tail P(X > t) with X ~ Poisson(c).'''
+
+    def __init__(self):
+        self.cache = {}
+
+    def __call__(self, t, c, pseudocount):
+        n = int(t + pseudocount)
+        lam = c + pseudocount
+        key = (n, lam)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        if lam <= 0:
+            score = 0.0
+        else:
+            # log-sum-exp over the terms k = n + 1, n + 2, ...
+            k = n + 1
+            logterm = -lam + k * math.log(lam) - math.lgamma(k + 1)
+            terms = [logterm]
+            while True:
+                k += 1
+                logterm += math.log(lam) - math.log(k)
+                terms.append(logterm)
+                if k > lam and logterm < terms[0] - 40:
+                    break
+            top = max(terms)
+            logp = top + math.log(sum(math.exp(x - top) for x in terms))
+            score = max(0.0, -logp / LN10)
+        if len(self.cache) > 1000000:
+            self.cache.clear()
+        self.cache[key] = score
+        return score
+
+
+METHODS = {"FE": foldEnrichment,
+           "logLR": logLikelihoodRatio,
+           "ppois": None}
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-t", "--treatment", dest="treatment",
+                      type="string",
+                      help="treatment pileup bedGraph")
+
+    parser.add_option("-c", "--control", dest="control", type="string",
+                      help="control lambda bedGraph")
+
+    parser.add_option("-g", "--contigs", dest="contigs", type="string",
+                      help="tab separated contig names and sizes")
+
+    parser.add_option("-o", "--output-bigwig", dest="output_bigwig",
+                      type="string",
+                      help="bigWig file to write")
+
+    parser.add_option("-m", "--method", dest="method", type="choice",
+                      choices=sorted(METHODS.keys()),
+                      help="comparison to compute")
+
+    parser.add_option("-p", "--pseudocount", dest="pseudocount",
+                      type="float",
+                      help="pseudocount added to both tracks")
+
+    parser.add_option("--buffer-size", dest="buffer_size", type="int",
+                      help="intervals to collect before writing")
+
+    parser.set_defaults(
+        treatment=None,
+        control=None,
+        contigs=None,
+        output_bigwig=None,
+        method="FE",
+        pseudocount=0.0,
+        buffer_size=100000)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.method == "ppois":
+        compare = PoissonScore()
+    else:
+        compare = METHODS[options.method]
+    pseudocount = options.pseudocount
+
+    sizes = dict((contig, int(size)) for contig, size in
+                 (line[:-1].split("\t")[:2]
+                  for line in IOTools.openFile(options.contigs)
+                  if line.strip() and not line.startswith("#")))
+
+    treatment_index = indexBedGraph(options.treatment)
+    control_index = indexBedGraph(options.control)
+
+    contigs = [contig for contig in treatment_index
+               if contig in control_index and contig in sizes]
+    for contig in treatment_index:
+        if contig not in contigs:
+            E.warn("skipping %s: missing from control or contigs" % contig)
+
+    bw = pyBigWig.open(options.output_bigwig, "w")
+    bw.addHeader([(contig, sizes[contig]) for contig in contigs])
+
+    tinf = open(options.treatment, "rb")
+    cinf = open(options.control, "rb")
+
+    nintervals = 0
+    for contig in contigs:
+        size = sizes[contig]
+        starts, ends, values = [], [], []
+
+        def _flush():
+            if starts:
+                bw.addEntries([contig] * len(starts), starts,
+                              ends=ends, values=values)
+                del starts[:], ends[:], values[:]
+
+        segments = iterateSegments(
+            iterateIntervals(tinf, *treatment_index[contig]),
+            iterateIntervals(cinf, *control_index[contig]))
+
+        for start, end, t, c in segments:
+            if start >= size:
+                break
+            end = min(end, size)
+            value = compare(t, c, pseudocount)
+            if starts and ends[-1] == start and values[-1] == value:
+                ends[-1] = end
+                continue
+            if len(starts) >= options.buffer_size:
+                _flush()
+            starts.append(start)
+            ends.append(end)
+            values.append(value)
+            nintervals += 1
+        _flush()
+
+    bw.close()
+    tinf.close()
+    cinf.close()
+
+    E.info("wrote %i intervals on %i contigs" % (nintervals, len(contigs)))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
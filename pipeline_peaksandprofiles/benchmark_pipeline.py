@@ -0,0 +1,523 @@
+'''
+benchmark_pipeline.py - benchmark the pipeline on simulated data
+=================================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Simulate a scaled-down ChIP-seq experiment with
+``simulate_chipseq.py`` and time the steps of the pipeline on it.
+
+Every benchmark case runs as a separate process under
+``jobstats.py``, which records its wall time, CPU time, peak memory
+and I/O. The cases cover the steps that run without a cluster or
+external tools:
+
+``bam_filter_dedup``
+   read filtering and duplicate removal of one ChIP sample
+   (``removeduplicates``).
+
+``read_counts``
+   mapped read counts of all samples from their indices
+   (``getprocessedreadcounts``).
+
+``geneset_cache``, ``get_contigs``, ``merge_exons``, ``filter_geneset``
+   the geneset cache and the tasks reading it.
+
+``bdgcmp2bigwig``
+   fold change bigWig of one ChIP sample (``foldchangebw``).
+
+``merge_gene_counts``
+   joining per-sample count tables (``mergegenecounts``).
+
+``profiles2npy``, ``normalise_profiles``, ``normalise_profiles_binary``
+   per-transcript profile conversion and normalisation.
+
+With ``--pipeline`` the complete pipeline (``make full --local``,
+from read filtering to the fold change bigWigs) is also run on the
+simulated data and the per-task statistics it records in its job
+statistics database are added to the report. This needs the external
+tools the pipeline uses (MACS2, featureCounts, ...).
+
+The report is written as JSON to ``--output`` (default stdout). It
+holds the dataset parameters, every measurement and the median of
+each statistic per case. With ``--baseline`` the medians are
+compared to an earlier report, and the script exits with status 1 if
+any case became slower than ``--tolerance`` allows.
+
+Usage
+-----
+
+Example::
+
+   python benchmark_pipeline.py --work-dir=benchmark.dir --reads=200000
+       --repeats=3 --output=benchmark.json
+
+   python benchmark_pipeline.py --work-dir=benchmark.dir
+       --baseline=benchmark.json
+
+Type::
+
+   python benchmark_pipeline.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import shutil
+import hashlib
+import sqlite3
+import platform
+import subprocess
+import numpy
+import CGAT.Experiment as E
+from CGAT import IOTools
+
+SCRIPTSDIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINEDIR = os.path.dirname(SCRIPTSDIR)
+
+STATISTICS = ("wall", "user", "sys", "max_rss", "read_bytes",
+              "write_bytes", "rchar", "wchar")
+
+
+def python(script, *args):
+    return [sys.executable, os.path.join(SCRIPTSDIR, script)] + list(args)
+
+
+def snippet(code):
+    '''return a command running python *code* with the pipeline
+    modules importable.'''
+    return [sys.executable, "-c", code]
+
+
+# cases reading the output of other cases
+REQUIRES = {"get_contigs": ["geneset_cache"],
+            "merge_exons": ["geneset_cache"],
+            "filter_geneset": ["geneset_cache"],
+            "normalise_profiles_binary": ["profiles2npy"]}
+
+
+def buildCases(datadir):
+    '''return the benchmark cases as a list of (name, command).
+
+    Commands run in the directory of a repeat and read the simulated
+    data in *datadir* or the outputs of the cases listed in REQUIRES.
+    '''
+    bamfiles = sorted(glob.glob(os.path.join(datadir, "*.bam")))
+    chip = [x for x in bamfiles if "-ChIP-" in x][0]
+    sample = os.path.basename(chip)[:-len(".bam")]
+    gtffile = os.path.join(datadir, "geneset.gtf.gz")
+    contigs = os.path.join(datadir, "contigs.tsv")
+
+    cases = [
+        ("bam_filter_dedup",
+         python("bam_filter_dedup.py", "-b", chip,
+                "-o", "deduplicated.bam",
+                "--metrics-file=deduplicated.metrics", "-L", "dedup.log")),
+        ("read_counts",
+         snippet("import PipelinePeaksAndProfiles as P; "
+                 "P.writeMappedReadCounts(%r, 'read_counts.tsv')" %
+                 bamfiles)),
+        ("geneset_cache",
+         snippet("import GenesetCache as G, os; "
+                 "os.symlink(G.build(%r, 'annotations.dir'), "
+                 "'geneset.cache')" % gtffile)),
+        ("get_contigs",
+         snippet("import GenesetCache as G; from CGAT import IOTools; "
+                 "IOTools.writeLines('contigs.tsv', "
+                 "[[c, str(s)] for c, s in "
+                 "G.load('geneset.cache').getContigSizes()], header=None)")),
+        ("merge_exons",
+         snippet("import GenesetCache as G; "
+                 "G.mergeGenes(G.load('geneset.cache'), "
+                 "'geneset_merged.gtf')")),
+        ("filter_geneset",
+         snippet("import GenesetCache as G, pysam; "
+                 "g = G.load('geneset.cache'); "
+                 "m = G.findOverlappingGenes(g, dict(g.getContigSizes()), "
+                 "1000, 1000); "
+                 "G.writeLines(%r, ~m, 'geneset.filtered.gtf'); "
+                 "pysam.tabix_compress('geneset.filtered.gtf', "
+                 "'geneset.filtered.gtf.gz', force=True)" % gtffile)),
+        ("merge_gene_counts",
+         python("merge_tables.py", "--use-file-prefix",
+                "-c", "1,2,3,4,5,6", "-k", "7",
+                "--regex-filename=(.+).counts.txt",
+                "-S", "combined_gene_counts.txt", "-L", "merge.log") +
+         sorted(glob.glob(os.path.join(datadir, "counts", "*.counts.txt")))),
+        ("profiles2npy",
+         python("profiles2npy.py",
+                "-m", os.path.join(datadir, "profiles",
+                                   "sample.profiles.tsv.gz"),
+                "-P", "sample.profiles", "-L", "profiles2npy.log")),
+        ("normalise_profiles",
+         python("normalise_profiles.py",
+                "-m", os.path.join(datadir, "profiles",
+                                   "sample.profiles.tsv.gz"),
+                "-S", "normalised.tsv", "-L", "normalise.log")),
+        ("normalise_profiles_binary",
+         python("normalise_profiles.py", "-m", "sample.profiles.npy",
+                "--output-binary=normalised", "-L", "normalise.log")),
+    ]
+
+    pileup = os.path.join(datadir, sample + ".treat_pileup.bdg")
+    if os.path.exists(pileup):
+        cases.append(
+            ("bdgcmp2bigwig",
+             python("bdgcmp2bigwig.py", "-t", pileup,
+                    "-c", os.path.join(datadir,
+                                       sample + ".control_lambda.bdg"),
+                    "--contigs", contigs, "-m", "FE",
+                    "-o", sample + ".fc_signal.bw", "-L", "bdgcmp.log")))
+    return cases
+
+
+def writeTables(datadir, seed, nbins=100):
+    '''write per-sample gene count tables and a per-transcript profile
+    matrix for the simulated geneset.'''
+    rng = numpy.random.RandomState(seed)
+    genes, transcripts = {}, {}
+    for line in IOTools.openFile(os.path.join(datadir, "geneset.gtf.gz")):
+        fields = line[:-1].split("\t")
+        gene_id = fields[8].split('"')[1]
+        transcripts[fields[8].split('"')[3]] = True
+        start, end = int(fields[3]), int(fields[4])
+        if gene_id in genes:
+            gene = genes[gene_id]
+            gene[1], gene[2] = min(gene[1], start), max(gene[2], end)
+        else:
+            genes[gene_id] = [fields[0], start, end, fields[6]]
+    transcripts = sorted(transcripts)
+
+    countsdir = os.path.join(datadir, "counts")
+    if not os.path.exists(countsdir):
+        os.makedirs(countsdir)
+    for bamfile in glob.glob(os.path.join(datadir, "*.bam")):
+        sample = os.path.basename(bamfile)[:-len(".bam")]
+        with open(os.path.join(countsdir, sample + ".counts.txt"),
+                  "w") as outf:
+            outf.write("# Program:featureCounts; Command:simulated\n")
+            outf.write("Geneid\tChr\tStart\tEnd\tStrand\tLength\t%s\n" %
+                       bamfile)
+            for gene_id in sorted(genes):
+                contig, start, end, strand = genes[gene_id]
+                outf.write("%s\t%s\t%i\t%i\t%s\t%i\t%i\n" % (
+                    gene_id, contig, start, end, strand, end - start + 1,
+                    rng.poisson(50)))
+
+    profilesdir = os.path.join(datadir, "profiles")
+    if not os.path.exists(profilesdir):
+        os.makedirs(profilesdir)
+    matrix = rng.poisson(2, size=(len(transcripts), nbins))
+    with IOTools.openFile(os.path.join(profilesdir,
+                                       "sample.profiles.tsv.gz"),
+                          "w") as outf:
+        outf.write("name\t%s\n" % "\t".join("bin%i" % x
+                                            for x in range(nbins)))
+        for name, row in zip(transcripts, matrix):
+            outf.write("%s\t%s\n" % (name, "\t".join(map(str, row))))
+
+
+def runCase(name, command, workdir, env):
+    '''run *command* under jobstats.py in *workdir* and return its
+    record.'''
+    recordfile = os.path.join(workdir, name + ".jobstats.json")
+    returncode = subprocess.call(
+        python("jobstats.py", "-v", "0", "--output=%s" % recordfile,
+               "--field=case=%s" % name) + command,
+        cwd=workdir, env=env)
+    with open(recordfile) as inf:
+        record = json.load(inf)
+    if returncode != 0:
+        raise OSError("benchmark case %s failed with status %i, see %s" %
+                      (name, returncode, workdir))
+    return record
+
+
+def writePipelineConfig(filename, datadir, options):
+    '''write a pipeline.ini running the pipeline on the simulated data.'''
+    with open(filename, "w") as outf:
+        outf.write("""[job]
+annotations=%(gtffile)s
+peakcallingformat=%(format)s
+inputpersample=%(inputpersample)i
+mainsampleprefix=%(tissue)s
+
+[foldchange]
+contigs=%(contigs)s
+
+[annotations]
+cachedir=%(cachedir)s
+
+[jobstats]
+record=1
+adaptive=0
+""" % {"gtffile": os.path.join(datadir, "geneset.gtf.gz"),
+       "format": "BAMPE" if options.paired else "BAM",
+       "inputpersample": 1 if options.input_per_sample else 0,
+       "tissue": options.tissue,
+       "contigs": os.path.join(datadir, "contigs.tsv"),
+       "cachedir": os.path.join(options.work_dir, "annotations.dir")})
+
+
+def runPipeline(datadir, pipelinedir, options, env):
+    '''run the complete pipeline on the simulated data and return the
+    statistics per task from its job statistics database.'''
+    if os.path.exists(pipelinedir):
+        shutil.rmtree(pipelinedir)
+    os.makedirs(pipelinedir)
+    for bamfile in glob.glob(os.path.join(datadir, "*.bam")):
+        os.symlink(bamfile, os.path.join(pipelinedir,
+                                         os.path.basename(bamfile)))
+        os.symlink(bamfile + ".bai", os.path.join(
+            pipelinedir, os.path.basename(bamfile) + ".bai"))
+    writePipelineConfig(os.path.join(pipelinedir, "pipeline.ini"),
+                        datadir, options)
+
+    record = runCase(
+        "pipeline",
+        [sys.executable,
+         os.path.join(PIPELINEDIR, "pipeline_peaksandprofiles.py"),
+         "make", "full", "--local", "-p", str(options.processes), "-v", "5"],
+        pipelinedir, env)
+
+    dbh = sqlite3.connect(os.path.join(pipelinedir, "jobstats.db"))
+    tasks = {}
+    for row in dbh.execute(
+            "SELECT task, COUNT(*), SUM(wall), SUM(user), SUM(sys), "
+            "MAX(max_rss), SUM(read_bytes), SUM(write_bytes) "
+            "FROM jobs GROUP BY task"):
+        tasks[row[0]] = dict(zip(
+            ("jobs", "wall", "user", "sys", "max_rss", "read_bytes",
+             "write_bytes"), row[1:]))
+    dbh.close()
+    return {"total": record, "tasks": tasks}
+
+
+def summarise(records):
+    '''return the median of each statistic per case.'''
+    summary = {}
+    for name in sorted(set(record["case"] for record in records)):
+        values = [record for record in records if record["case"] == name]
+        summary[name] = dict(
+            (key, float(numpy.median([record[key] for record in values])))
+            for key in STATISTICS)
+    return summary
+
+
+def compare(summary, baseline, tolerance, statistics=("wall", "max_rss")):
+    '''return a list of regressions of *summary* against *baseline*.'''
+    regressions = []
+    for name, values in sorted(summary.items()):
+        if name not in baseline:
+            continue
+        for key in statistics:
+            before, after = baseline[name][key], values[key]
+            if before > 0 and after > before * (1.0 + tolerance):
+                regressions.append({"case": name, "statistic": key,
+                                    "baseline": before, "value": after,
+                                    "ratio": after / before})
+    return regressions
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-w", "--work-dir", dest="work_dir", type="string",
+                      help="directory for the data and benchmark runs")
+
+    parser.add_option("--reads", dest="reads", type="int",
+                      help="fragments per simulated sample")
+
+    parser.add_option("--genes", dest="genes", type="int",
+                      help="number of simulated genes")
+
+    parser.add_option("--contigs", dest="contigs", type="string",
+                      help="comma separated contig:size pairs")
+
+    parser.add_option("--paired", dest="paired", action="store_true",
+                      help="simulate paired-end reads")
+
+    parser.add_option("--duplicate-rate", dest="duplicate_rate",
+                      type="float",
+                      help="probability that a fragment is duplicated")
+
+    parser.add_option("--input-per-sample", dest="input_per_sample",
+                      action="store_true",
+                      help="one Input per ChIP replicate")
+
+    parser.add_option("--tissue", dest="tissue", type="string",
+                      help="tissue part of the sample names")
+
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="random seed for the simulation")
+
+    parser.add_option("--repeats", dest="repeats", type="int",
+                      help="number of times to run each case")
+
+    parser.add_option("--case", dest="cases", type="string",
+                      action="append",
+                      help="run only this case (can be given more "
+                      "than once)")
+
+    parser.add_option("--pipeline", dest="pipeline", action="store_true",
+                      help="also run the complete pipeline locally")
+
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+                      help="parallel jobs when running the pipeline")
+
+    parser.add_option("-o", "--output", dest="output", type="string",
+                      help="file to write the JSON report to")
+
+    parser.add_option("--baseline", dest="baseline", type="string",
+                      help="earlier report to compare against")
+
+    parser.add_option("--tolerance", dest="tolerance", type="float",
+                      help="allowed relative increase over the baseline")
+
+    parser.set_defaults(
+        work_dir="benchmark.dir",
+        reads=100000,
+        genes=300,
+        contigs="chr1:2000000,chr2:1500000,chr3:1000000",
+        paired=False,
+        duplicate_rate=0.1,
+        input_per_sample=False,
+        tissue="Sim",
+        seed=1,
+        repeats=3,
+        cases=[],
+        pipeline=False,
+        processes=4,
+        output=None,
+        baseline=None,
+        tolerance=0.25)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    dataset = {"reads": options.reads, "genes": options.genes,
+               "contigs": options.contigs, "paired": options.paired,
+               "duplicate_rate": options.duplicate_rate,
+               "input_per_sample": options.input_per_sample,
+               "tissue": options.tissue, "seed": options.seed}
+
+    # simulate once per set of parameters
+    options.work_dir = os.path.abspath(options.work_dir)
+    datadir = os.path.join(options.work_dir, "data.%s" % hashlib.md5(
+        json.dumps(dataset, sort_keys=True).encode()).hexdigest()[:10])
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [PIPELINEDIR, SCRIPTSDIR] +
+        [x for x in [os.environ.get("PYTHONPATH")] if x])
+
+    if not os.path.exists(os.path.join(datadir, "dataset.json")):
+        command = python(
+            "simulate_chipseq.py", "--output-dir=%s" % datadir,
+            "--reads=%i" % options.reads, "--genes=%i" % options.genes,
+            "--contigs=%s" % options.contigs,
+            "--duplicate-rate=%f" % options.duplicate_rate,
+            "--tissue=%s" % options.tissue, "--seed=%i" % options.seed,
+            "--bedgraphs", "-L", os.path.join(options.work_dir,
+                                              "simulate.log"))
+        if options.paired:
+            command.append("--paired")
+        if options.input_per_sample:
+            command.append("--input-per-sample")
+        if not os.path.exists(options.work_dir):
+            os.makedirs(options.work_dir)
+        subprocess.check_call(command, env=env)
+        writeTables(datadir, options.seed)
+        with open(os.path.join(datadir, "dataset.json"), "w") as outf:
+            json.dump(dataset, outf, sort_keys=True)
+
+    cases = buildCases(datadir)
+    selected = set(name for name, command in cases)
+    if options.cases:
+        selected = set(options.cases)
+        # required cases are run, but not reported
+        required = set(x for name in selected
+                       for x in REQUIRES.get(name, []))
+        cases = [case for case in cases
+                 if case[0] in selected or case[0] in required]
+
+    records = []
+    for repeat in range(options.repeats):
+        workdir = os.path.join(options.work_dir, "runs", "repeat%i" % repeat)
+        if os.path.exists(workdir):
+            shutil.rmtree(workdir)
+        os.makedirs(workdir)
+        for name, command in cases:
+            record = runCase(name, command, workdir, env)
+            if name not in selected:
+                continue
+            record["repeat"] = repeat
+            records.append(record)
+            E.info("%s (repeat %i): %.2fs wall, %.1f MB" %
+                   (name, repeat, record["wall"], record["max_rss"] / 1e6))
+
+    report = {"dataset": dataset,
+              "host": socket.gethostname(),
+              "platform": platform.platform(),
+              "python": platform.python_version(),
+              "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "records": records,
+              "summary": summarise(records)}
+
+    if options.pipeline:
+        report["pipeline"] = runPipeline(
+                datadir, os.path.join(options.work_dir, "pipeline"),
+            options, env)
+
+    returncode = 0
+    if options.baseline:
+        with open(options.baseline) as inf:
+            baseline = json.load(inf)
+        if baseline.get("dataset") != dataset:
+            E.warn("baseline was run on a different dataset")
+        report["regressions"] = compare(report["summary"],
+                                        baseline["summary"],
+                                        options.tolerance)
+        for regression in report["regressions"]:
+            E.warn("%(case)s: %(statistic)s %(baseline)g -> %(value)g "
+                   "(x%(ratio).2f)" % regression)
+        if report["regressions"]:
+            returncode = 1
+
+    if options.output:
+        with open(options.output, "w") as outf:
+            json.dump(report, outf, indent=2, sort_keys=True)
+    else:
+        options.stdout.write(json.dumps(report, indent=2, sort_keys=True) +
+                             "\n")
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+    return returncode
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
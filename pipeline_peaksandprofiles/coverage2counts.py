@@ -0,0 +1,149 @@
+'''
+coverage2counts.py - count fragments per gene from a coverage cache
+====================================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Counts the fragments of a sample over the exons of each gene in a GTF
+file, using the fragment centres of its coverage cache (see
+:mod:`CoverageCache`) instead of the BAM file.
+
+A fragment is counted for a gene if its centre lies in one of the
+gene's exons. Exons of a gene should not overlap (for example the
+``merge-exons`` output of the pipeline), otherwise fragments are
+counted once per exon. Fragments in exons of overlapping genes are
+counted for each gene.
+
+The output has the layout of featureCounts: ``Geneid``, ``Chr``,
+``Start``, ``End``, ``Strand`` and ``Length`` followed by the count,
+headed by the name given with ``--name``.
+
+Usage
+-----
+
+Example::
+
+   python coverage2counts.py -P coverage.dir/sample
+       -g geneset_merged.gtf --name=sample.bam > sample.counts.txt
+
+Type::
+
+   python coverage2counts.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import collections
+import numpy
+import CGAT.Experiment as E
+from CGAT import IOTools
+from CGAT import GTF
+import CoverageCache
+
+
+def readExons(gtffile, feature="exon"):
+    '''return a dictionary of gene to a list of its *feature* entries
+    (contig, start, end, strand), in the order of *gtffile*.'''
+    genes = collections.OrderedDict()
+    with IOTools.openFile(gtffile) as inf:
+        for gff in GTF.iterator(inf):
+            if gff.feature != feature:
+                continue
+            genes.setdefault(gff.gene_id, []).append(
+                (gff.contig, gff.start, gff.end, gff.strand))
+    return genes
+
+
+def countGenes(coverage, genes, outfile, name):
+    '''write the fragment counts of *genes* to *outfile*.'''
+    outfile.write("\t".join(["Geneid", "Chr", "Start", "End", "Strand",
+                             "Length", name]) + "\n")
+
+    # count all exons of a contig in one pass over its centres
+    by_contig = collections.defaultdict(list)
+    for gene, exons in genes.items():
+        for n, exon in enumerate(exons):
+            by_contig[exon[0]].append((gene, n, exon[1], exon[2]))
+    counts = {}
+    for contig, exons in by_contig.items():
+        starts = numpy.array([x[2] for x in exons], dtype=numpy.int64)
+        ends = numpy.array([x[3] for x in exons], dtype=numpy.int64)
+        for exon, count in zip(exons, coverage.countFragments(
+                contig, starts, ends)):
+            counts[exon[:2]] = count
+
+    total = 0
+    for gene, exons in genes.items():
+        count = sum(counts[(gene, n)] for n in range(len(exons)))
+        total += count
+        outfile.write("\t".join(
+            [gene,
+             ";".join(x[0] for x in exons),
+             ";".join(str(x[1] + 1) for x in exons),
+             ";".join(str(x[2]) for x in exons),
+             ";".join(x[3] for x in exons),
+             str(sum(x[2] - x[1] for x in exons)),
+             str(count)]) + "\n")
+    return total
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-P", "--coverage-prefix", dest="coverage_prefix",
+                      type="string",
+                      help="prefix of the coverage cache")
+
+    parser.add_option("-g", "--gtf-file", dest="gtffile", type="string",
+                      help="GTF file with the exons of each gene")
+
+    parser.add_option("--feature", dest="feature", type="string",
+                      help="GTF feature to count over")
+
+    parser.add_option("--name", dest="name", type="string",
+                      help="title of the count column")
+
+    parser.set_defaults(
+        coverage_prefix=None,
+        gtffile=None,
+        feature="exon",
+        name="counts")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not options.coverage_prefix or not options.gtffile:
+        raise ValueError("please specify a --coverage-prefix and a "
+                         "--gtf-file")
+
+    coverage = CoverageCache.load(options.coverage_prefix)
+    genes = readExons(options.gtffile, options.feature)
+    total = countGenes(coverage, genes, options.stdout, options.name)
+    E.info("counted %i of %i fragments in %i genes" %
+           (total, coverage.nfragments, len(genes)))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
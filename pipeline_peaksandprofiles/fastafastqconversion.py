@@ -1,6 +1,6 @@
 '''
-cgat_script_template.py - template for CGAT scripts
-====================================================
+fastafastqconversion.py - convert FASTA reads to FASTQ
+=======================================================
 
 :Author:
 :Release: $Id$
@@ -10,20 +10,40 @@ cgat_script_template.py - template for CGAT scripts
 Purpose
 -------
 
-.. Overall purpose and function of the script>
+Converts the reads in a FASTA file (for example assembled or
+simulated reads) to FASTQ with a constant base quality of
+``--quality`` (Phred+33, as Illumina 1.8).
+
+The FASTA file is streamed, sequences can span several lines. Reads
+are converted in batches of ``--batch-size``: the quality strings are
+cached per read length and every batch is written as a single block.
+
+The output is compressed according to ``--compress``:
+
+none
+   plain text.
+gzip
+   each batch is an independent gzip member, which gzip and zcat
+   read as one file.
+bgzip
+   blocked gzip, as written by ``bgzip``, with the end-of-file
+   marker.
+
+By default, output files ending in ``.gz`` are compressed with gzip.
+With ``--threads`` larger than 1, batches are formatted and compressed
+in parallel by worker processes and written in input order.
 
 Usage
 -----
 
-.. Example use case
-
 Example::
 
-   python cgat_script_template.py
+   python fastafastqconversion.py -f reads.fasta.gz --threads=4
+       --output-file=reads.fastq.gz
 
 Type::
 
-   python cgat_script_template.py --help
+   python fastafastqconversion.py --help
 
 for command line help.
 
@@ -33,12 +53,99 @@ Command line options
 '''
 
 import sys
+import zlib
+import struct
+import multiprocessing
 import CGAT.Experiment as E
-import os
-import re
 from CGAT import IOTools
-from CGAT import Fastq
-from CGAT import FastaIterator
+
+# largest input to a BGZF block, leaving room for incompressible data
+BGZF_BLOCK_SIZE = 65280
+
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            b"\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def iterateFasta(infile):
+    '''iterate over (title, sequence) of the records in *infile*.'''
+    title, sequence = None, []
+    for line in infile:
+        if line.startswith(">"):
+            if title is not None:
+                yield title, "".join(sequence)
+            title, sequence = line[1:].rstrip("\r\n"), []
+        elif title is not None:
+            sequence.append(line.strip())
+    if title is not None:
+        yield title, "".join(sequence)
+
+
+def iterateBatches(records, batch_size):
+    '''group *records* into lists of *batch_size*.'''
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def formatBatch(batch, quality, qualities):
+    '''return the FASTQ text of the records in *batch*.
+
+    *qualities* caches the quality string of each read length.
+    '''
+    lines = []
+    for title, sequence in batch:
+        length = len(sequence)
+        quals = qualities.get(length)
+        if quals is None:
+            quals = qualities[length] = quality * length
+        lines.append("@%s\n%s\n+\n%s\n" % (title, sequence, quals))
+    return "".join(lines)
+
+
+def compressGzip(data, level):
+    '''return *data* as a gzip member.'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compressBGZF(data, level):
+    '''return *data* as a series of BGZF blocks.'''
+    blocks = []
+    for offset in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[offset:offset + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(block) + compressor.flush()
+        blocks.append(
+            b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02"
+            b"\x00" + struct.pack("<H", len(deflated) + 25) + deflated +
+            struct.pack("<II", zlib.crc32(block) & 0xffffffff, len(block)))
+    return b"".join(blocks)
+
+
+class BatchConverter(object):
+    '''format and compress batches of reads.'''
+
+    def __init__(self, quality, compress, level):
+        self.quality = quality
+        self.compress = compress
+        self.level = level
+        self.qualities = {}
+
+    def __call__(self, batch):
+        data = formatBatch(batch, self.quality, self.qualities).encode(
+            "ascii")
+        if self.compress == "gzip":
+            return compressGzip(data, self.level)
+        elif self.compress == "bgzip":
+            return compressBGZF(data, self.level)
+        return data
+
+
 def main(argv=None):
     """script main.
     parses command line options in sys.argv, unless *argv* is given.
@@ -51,36 +158,87 @@ def main(argv=None):
     parser = E.OptionParser(version="%prog version: $Id$",
                             usage=globals()["__doc__"])
 
-    parser.add_option("-pm","--profilematrix", dest="matrixfile", type="string",
-                      help="name of profile file you want to convert")
+    parser.add_option("-f", "--fastafile", dest="fastafile", type="string",
+                      help="FASTA file to convert, - for stdin")
+
+    parser.add_option("--output-file", dest="output_file", type="string",
+                      help="FASTQ file to write instead of stdout")
 
-# add common options (-h/--help, ...) and parse command line
+    parser.add_option("--compress", dest="compress", type="choice",
+                      choices=("none", "gzip", "bgzip"),
+                      help="compression of the output, by default gzip "
+                      "for output files ending in .gz")
+
+    parser.add_option("--compression-level", dest="level", type="int",
+                      help="zlib compression level")
+
+    parser.add_option("--quality", dest="quality", type="int",
+                      help="Phred quality of every base")
+
+    parser.add_option("--batch-size", dest="batch_size", type="int",
+                      help="number of reads converted and written "
+                      "together")
+
+    parser.add_option("--threads", dest="threads", type="int",
+                      help="number of worker processes")
+
+    parser.set_defaults(
+        fastafile="-",
+        output_file=None,
+        compress=None,
+        level=6,
+        quality=30,
+        batch_size=10000,
+        threads=1)
+
+    # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
-    #outf = IOTools.openFile("my_output", "w")
-    for line in options.matrixfile:
-        line = line.strip()
-        fields = line.split()
-        total = sum([float(col) for col in fields[1:]])
-        if total == 0:
-            continue
+
+    compress = options.compress
+    if compress is None:
+        if options.output_file and options.output_file.endswith(".gz"):
+            compress = "gzip"
         else:
-            for i, col in enumerate(fields):
-                if i == 0: continue
-                fields[i] = col/total
-    options.stdout.write("\t".join(map(str,fields)))
- 
-
-
-    for fasta_read in FastaIterator.iterate(IOTools.openFile(options.fastafile)):
-	read_sequence = fasta_read.sequence
-        read_name = fasta_read.title
-        quals = '.' * len(read_sequence)
-        
-        new_fastq = Fastq.Record(identifier=read_name,
-                                 seq=read_sequence,
-                                 quals=quals)
-        new_fastq.fromPhred([30]*len(read_sequence), format='illumina-1.8')
-	options.stdout.write(str(new_fastq)+"\n")
+            compress = "none"
+
+    if options.fastafile == "-":
+        infile = options.stdin
+    else:
+        infile = IOTools.openFile(options.fastafile)
+
+    if options.output_file:
+        outfile = open(options.output_file, "wb")
+    else:
+        outfile = getattr(options.stdout, "buffer", options.stdout)
+
+    converter = BatchConverter(chr(33 + options.quality), compress,
+                               options.level)
+    batches = iterateBatches(iterateFasta(infile), options.batch_size)
+
+    pool = None
+    if options.threads > 1:
+        pool = multiprocessing.Pool(options.threads)
+        blocks = pool.imap(converter, batches)
+    else:
+        blocks = (converter(batch) for batch in batches)
+
+    nbatches = 0
+    try:
+        for block in blocks:
+            outfile.write(block)
+            nbatches += 1
+        if compress == "bgzip":
+            outfile.write(BGZF_EOF)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if options.output_file:
+            outfile.close()
+
+    E.info("converted %i batches of up to %i reads" %
+           (nbatches, options.batch_size))
+
     # write footer and output benchmark information.
     E.Stop()
 
@@ -0,0 +1,203 @@
+'''
+gather_profiles.py - combine bam2geneprofile results of geneset chunks
+=======================================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+When profiles are computed in parallel over chunks of the geneset
+(``scatter_profiles`` in the pipeline), every chunk writes its own
+``<chunk-prefix><method>.matrix.tsv.gz`` and, with
+``--output-all-profiles``, ``<chunk-prefix><method>.profiles.tsv.gz``.
+This script combines them into the files a single run over the whole
+geneset would have written under ``--output-prefix``.
+
+Matrices
+   rows must agree on the ``--key-columns`` in every chunk. The
+   ``--sum-columns`` are summed. All other columns are averaged,
+   weighted by each chunk's total of the first sum column, which is
+   exact for values normalised to the chunk total. This assumes
+   ``--normalize-transcript=none``, so that chunk counts add up.
+
+   Columns normalised in any other way, for example to the maximum
+   or with ``--normalize-profile=area``, are not recomputed from the
+   gathered counts. Their weighted means differ from the values of a
+   single run over the whole geneset and should be recomputed from
+   the summed columns if they are needed.
+
+Per-transcript profiles
+   concatenated in chunk order with a single header.
+
+Usage
+-----
+
+Example::
+
+   python gather_profiles.py -m geneprofile -m tssprofile
+       -P profiles.dir/sample.bwa.
+       profiles.dir/chunks.dir/sample.bwa.chunk000.
+       profiles.dir/chunks.dir/sample.bwa.chunk001.
+
+Type::
+
+   python gather_profiles.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import CGAT.Experiment as E
+from CGAT import IOTools
+
+
+def readMatrix(filename):
+    '''return header and rows of a profile matrix.'''
+    with IOTools.openFile(filename) as inf:
+        lines = [line.rstrip("\r\n").split("\t") for line in inf
+                 if not line.startswith("#")]
+    return lines[0], lines[1:]
+
+
+def gatherMatrices(filenames, outfile, key_columns, sum_columns):
+    '''combine the matrices in *filenames* and write to *outfile*.'''
+    header, nrows = None, 0
+    keys, sums, weighted, weights = None, None, None, []
+
+    for filename in filenames:
+        this_header, rows = readMatrix(filename)
+        if header is None:
+            header = this_header
+            key_index = [i for i, x in enumerate(header) if x in key_columns]
+            sum_index = [i for i, x in enumerate(header) if x in sum_columns]
+            if not sum_index:
+                raise ValueError("%s has none of the columns %s" %
+                                 (filename, ",".join(sum_columns)))
+            other_index = [i for i in range(len(header))
+                           if i not in key_index and i not in sum_index]
+            keys = [[row[i] for i in key_index] for row in rows]
+            sums = [[0.0] * len(sum_index) for row in rows]
+            weighted = [[0.0] * len(other_index) for row in rows]
+            nrows = len(rows)
+        elif this_header != header or len(rows) != nrows:
+            raise ValueError("%s does not have the layout of %s" %
+                             (filename, filenames[0]))
+
+        weight = sum(float(row[sum_index[0]]) for row in rows)
+        weights.append(weight)
+        for n, row in enumerate(rows):
+            if [row[i] for i in key_index] != keys[n]:
+                raise ValueError("row %i of %s does not match %s" %
+                                 (n + 1, filename, filenames[0]))
+            for j, i in enumerate(sum_index):
+                sums[n][j] += float(row[i])
+            for j, i in enumerate(other_index):
+                weighted[n][j] += float(row[i]) * weight
+
+    total = sum(weights)
+    outfile.write("\t".join(header) + "\n")
+    for key, sum_values, other_values in zip(keys, sums, weighted):
+        values = dict(zip(key_index, key))
+        values.update(zip(sum_index, ["%.12g" % x for x in sum_values]))
+        values.update(zip(other_index,
+                          ["%.12g" % (x / total if total else 0.0)
+                           for x in other_values]))
+        outfile.write("\t".join(values[i] for i in range(len(header))) +
+                      "\n")
+    return nrows
+
+
+def gatherProfiles(filenames, outfile):
+    '''concatenate per-transcript profiles, writing the header once.'''
+    header, nrows = None, 0
+    for filename in filenames:
+        with IOTools.openFile(filename) as inf:
+            first = inf.readline()
+            if header is None:
+                header = first
+                outfile.write(header)
+            elif first != header:
+                raise ValueError("header of %s differs from %s" %
+                                 (filename, filenames[0]))
+            for line in inf:
+                outfile.write(line)
+                nrows += 1
+    return nrows
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-m", "--method", dest="methods", type="string",
+                      action="append",
+                      help="profile method to gather (can be given "
+                      "more than once)")
+
+    parser.add_option("-P", "--output-prefix", dest="output_prefix",
+                      type="string",
+                      help="prefix of the gathered output files")
+
+    parser.add_option("--key-columns", dest="key_columns", type="string",
+                      help="comma separated matrix columns identifying "
+                      "a row")
+
+    parser.add_option("--sum-columns", dest="sum_columns", type="string",
+                      help="comma separated matrix columns to sum")
+
+    parser.set_defaults(
+        methods=[],
+        output_prefix=None,
+        key_columns="bin,region,region_bin",
+        sum_columns="counts,background")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not args:
+        raise ValueError("no chunk prefixes given")
+    if not options.output_prefix:
+        raise ValueError("please specify an --output-prefix")
+
+    key_columns = options.key_columns.split(",")
+    sum_columns = options.sum_columns.split(",")
+
+    for method in options.methods:
+        matrices = [prefix + method + ".matrix.tsv.gz" for prefix in args]
+        with IOTools.openFile(
+                options.output_prefix + method + ".matrix.tsv.gz",
+                "w") as outf:
+            nrows = gatherMatrices(matrices, outf, key_columns, sum_columns)
+        E.info("%s: gathered %i chunks into %i rows" %
+               (method, len(matrices), nrows))
+
+        profiles = [prefix + method + ".profiles.tsv.gz" for prefix in args]
+        if all(os.path.exists(x) for x in profiles):
+            with IOTools.openFile(
+                    options.output_prefix + method + ".profiles.tsv.gz",
+                    "w") as outf:
+                nrows = gatherProfiles(profiles, outf)
+            E.info("%s: gathered %i profiles" % (method, nrows))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
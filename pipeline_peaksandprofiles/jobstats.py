@@ -0,0 +1,208 @@
+'''
+jobstats.py - run a command and record the resources it used
+=============================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Runs a command, waits for it and writes a JSON record of the
+resources used by the command and all its child processes:
+
+``wall``, ``user``, ``sys``
+   elapsed, user CPU and system CPU time in seconds.
+
+``max_rss``
+   peak resident memory in bytes. The process tree is sampled every
+   ``--interval`` seconds and the peak of the summed RSS of all its
+   processes is reported, or the largest single process if that is
+   higher (as reported by ``getrusage``).
+
+``read_bytes``, ``write_bytes``, ``rchar``, ``wchar``
+   storage and total I/O from ``/proc/self/io``, which includes all
+   waited-for children.
+
+Fields given with ``--field=key=value`` are added to the record, the
+command's exit status is returned.
+
+The pipeline wraps its jobs with this script and collects the records
+into a database (see :mod:`PipelinePeaksAndProfiles`).
+
+Usage
+-----
+
+Example::
+
+   python jobstats.py --output=job.json --field=task=profiles
+       bash job.sh
+
+Type::
+
+   python jobstats.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import time
+import json
+import socket
+import resource
+import threading
+import subprocess
+import CGAT.Experiment as E
+
+
+def readIO(pid="self"):
+    '''return the counters in /proc/<pid>/io.'''
+    counters = {}
+    try:
+        with open("/proc/%s/io" % pid) as inf:
+            for line in inf:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except (IOError, OSError):
+        pass
+    return counters
+
+
+def getChildren():
+    '''return a dictionary of pid to parent pid for all processes.'''
+    parents = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % pid) as inf:
+                stat = inf.read()
+        except (IOError, OSError):
+            continue
+        # the command name can contain spaces, fields follow the ")"
+        fields = stat[stat.rindex(")") + 2:].split()
+        parents[int(pid)] = int(fields[1])
+    return parents
+
+
+def getTreeRSS(root):
+    '''return the summed resident memory in bytes of *root* and all
+    its descendants.'''
+    parents = getChildren()
+    tree, todo = set(), [root]
+    while todo:
+        pid = todo.pop()
+        tree.add(pid)
+        todo.extend(child for child, parent in parents.items()
+                    if parent == pid and child not in tree)
+    pagesize = resource.getpagesize()
+    rss = 0
+    for pid in tree:
+        try:
+            with open("/proc/%i/statm" % pid) as inf:
+                rss += int(inf.read().split()[1]) * pagesize
+        except (IOError, OSError):
+            pass
+    return rss
+
+
+class Sampler(threading.Thread):
+    '''track the peak memory of a process tree.'''
+
+    def __init__(self, pid, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.is_set():
+            self.peak = max(self.peak, getTreeRSS(self.pid))
+            self.finished.wait(self.interval)
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--output", dest="output", type="string",
+                      help="file to write the JSON record to")
+
+    parser.add_option("--field", dest="fields", type="string",
+                      action="append",
+                      help="key=value pair to add to the record")
+
+    parser.add_option("--interval", dest="interval", type="float",
+                      help="seconds between memory samples")
+
+    parser.disable_interspersed_args()
+
+    parser.set_defaults(
+        output=None,
+        fields=[],
+        interval=1.0)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not args:
+        raise ValueError("no command given")
+
+    record = dict(field.split("=", 1) for field in options.fields)
+    record["host"] = socket.gethostname()
+    record["command"] = " ".join(args)
+
+    io_before = readIO()
+    started = time.time()
+    process = subprocess.Popen(args)
+    sampler = Sampler(process.pid, options.interval)
+    sampler.start()
+    returncode = process.wait()
+    finished = time.time()
+    sampler.finished.set()
+    sampler.join()
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_after = readIO()
+
+    record.update({
+        "started": started,
+        "finished": finished,
+        "wall": finished - started,
+        "user": usage.ru_utime,
+        "sys": usage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss": max(sampler.peak, usage.ru_maxrss * 1024),
+        "returncode": returncode})
+    for key in ("read_bytes", "write_bytes", "rchar", "wchar"):
+        record[key] = io_after.get(key, 0) - io_before.get(key, 0)
+
+    tmpfile = options.output + ".tmp"
+    with open(tmpfile, "w") as outf:
+        json.dump(record, outf, sort_keys=True)
+    os.rename(tmpfile, options.output)
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+    return returncode
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
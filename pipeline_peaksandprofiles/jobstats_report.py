@@ -0,0 +1,290 @@
+'''
+jobstats_report.py - summarise the job statistics of pipeline runs
+===================================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Reads the job statistics the pipeline records with
+``jobstats_record`` (see :mod:`jobstats` and
+:func:`PipelinePeaksAndProfiles.run`) and reports where the time of a
+run went. Records in ``--jobstats-dir`` that were not loaded into the
+database, for example because the pipeline was interrupted while
+cluster jobs were still running, are merged into it first.
+
+Only the last run is reported unless ``--all-runs`` is given. Runs are
+separated by periods of more than ``--gap`` seconds without a job.
+
+The report has three tab-separated sections:
+
+tasks
+   per task the number of jobs, wall time, queue wait (from submission
+   to the start on the node), CPU time, CPU use per thread, reads
+   processed per second of wall time, bytes read and written and the
+   largest peak memory.
+
+samples
+   the ``--top`` samples with the largest total wall time over all
+   their jobs, with the task that took longest.
+
+critical path
+   the chain of jobs that determined the length of the run: starting
+   from the job that finished last, each job is preceded by the job
+   that finished last before it was submitted. ``idle`` is the time
+   between the two, spent in the pipeline process or in tasks that are
+   not run as jobs.
+
+Usage
+-----
+
+Example::
+
+   python jobstats_report.py --database=jobstats.db
+
+Type::
+
+   python jobstats_report.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import re
+import sys
+import glob
+import json
+import sqlite3
+import collections
+import CGAT.Experiment as E
+
+
+def mergeSidecars(dbh, directory):
+    '''load the job records left in *directory* into *dbh*.'''
+    columns = [x[1] for x in dbh.execute("PRAGMA table_info(jobs)")]
+    nrecords = 0
+    for filename in sorted(glob.glob(os.path.join(directory, "*",
+                                                  "*.json"))):
+        try:
+            with open(filename) as inf:
+                record = json.load(inf)
+        except ValueError:
+            E.warn("%s is not a valid record, skipped" % filename)
+            continue
+        names = [x for x in columns if x in record]
+        dbh.execute("INSERT INTO jobs (%s) VALUES (%s)" %
+                    (",".join(names), ",".join(["?"] * len(names))),
+                    [record[x] for x in names])
+        dbh.commit()
+        os.unlink(filename)
+        scriptfile = filename[:-len(".json")] + ".sh"
+        if os.path.exists(scriptfile):
+            os.unlink(scriptfile)
+        nrecords += 1
+    return nrecords
+
+
+def readJobs(dbh):
+    '''return the recorded jobs as dictionaries, ordered by submission.'''
+    columns = [x[1] for x in dbh.execute("PRAGMA table_info(jobs)")]
+    jobs = []
+    for row in dbh.execute("SELECT * FROM jobs"):
+        job = dict(zip(columns, row))
+        if job["finished"] is None:
+            continue
+        if job["submitted"] is None:
+            job["submitted"] = job["started"]
+        jobs.append(job)
+    jobs.sort(key=lambda x: x["submitted"])
+    return jobs
+
+
+def selectLastRun(jobs, gap):
+    '''return the jobs of the last run, which starts after the last
+    period of more than *gap* seconds without a running job.'''
+    first, finished = 0, None
+    for n, job in enumerate(jobs):
+        if finished is not None and job["submitted"] - finished > gap:
+            first = n
+        finished = max(finished or job["finished"], job["finished"])
+    return jobs[first:]
+
+
+def summariseTasks(jobs):
+    '''return per task rows of the tasks section, in order of first
+    submission.'''
+    tasks = collections.OrderedDict()
+    for job in jobs:
+        tasks.setdefault(job["task"], []).append(job)
+
+    rows = []
+    for task, task_jobs in tasks.items():
+        wall = sum(x["wall"] or 0 for x in task_jobs)
+        wait = sum(max(0, x["started"] - x["submitted"])
+                   for x in task_jobs)
+        cpu = sum((x["user"] or 0) + (x["sys"] or 0) for x in task_jobs)
+        threads = sum((x["wall"] or 0) * int(x["job_threads"] or 1)
+                      for x in task_jobs)
+        reads = sum(x.get("reads") or 0 for x in task_jobs)
+        rows.append([task, len(task_jobs),
+                     sum(1 for x in task_jobs if x["returncode"]),
+                     "%.1f" % wall, "%.1f" % wait, "%.1f" % cpu,
+                     "%.2f" % (cpu / threads if threads else 0),
+                     reads, "%.0f" % (reads / wall if wall else 0),
+                     sum(x["read_bytes"] or 0 for x in task_jobs),
+                     sum(x["write_bytes"] or 0 for x in task_jobs),
+                     max(x["max_rss"] or 0 for x in task_jobs)])
+    return rows
+
+
+def summariseSamples(jobs, regex, top):
+    '''return rows of the samples section for the *top* samples with
+    the largest wall time.'''
+    samples = collections.defaultdict(list)
+    for job in jobs:
+        match = regex.search(job["job"] or "")
+        if match:
+            samples[match.group(1)].append(job)
+
+    rows = []
+    for sample, sample_jobs in samples.items():
+        slowest = max(sample_jobs, key=lambda x: x["wall"] or 0)
+        rows.append([sample, len(sample_jobs),
+                     sum(x["wall"] or 0 for x in sample_jobs),
+                     slowest["task"], slowest["wall"] or 0])
+    rows.sort(key=lambda x: -x[2])
+    return [[sample, njobs, "%.1f" % wall, task, "%.1f" % task_wall]
+            for sample, njobs, wall, task, task_wall in rows[:top]]
+
+
+def findCriticalPath(jobs, tolerance=1.0):
+    '''return rows of the critical path section, from the first to the
+    last job.'''
+    if not jobs:
+        return []
+    start = min(x["submitted"] for x in jobs)
+    current = max(jobs, key=lambda x: x["finished"])
+    path = [current]
+    while True:
+        before = [x for x in jobs
+                  if x["finished"] <= current["submitted"] + tolerance and
+                  x is not current]
+        if not before:
+            break
+        current = max(before, key=lambda x: x["finished"])
+        path.append(current)
+    path.reverse()
+
+    rows, previous = [], start
+    for job in path:
+        rows.append([job["task"], job["job"],
+                     "%.1f" % (job["submitted"] - start),
+                     "%.1f" % max(0, job["submitted"] - previous),
+                     "%.1f" % max(0, job["started"] - job["submitted"]),
+                     "%.1f" % (job["wall"] or 0)])
+        previous = job["finished"]
+    return rows
+
+
+def writeSection(outfile, title, header, rows):
+    outfile.write("## %s\n" % title)
+    outfile.write("\t".join(header) + "\n")
+    for row in rows:
+        outfile.write("\t".join(map(str, row)) + "\n")
+    outfile.write("\n")
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--database", dest="database", type="string",
+                      help="job statistics database")
+
+    parser.add_option("--jobstats-dir", dest="jobstats_dir",
+                      type="string",
+                      help="directory with job records to merge first")
+
+    parser.add_option("--all-runs", dest="all_runs", action="store_true",
+                      help="report all recorded runs, not only the last")
+
+    parser.add_option("--gap", dest="gap", type="float",
+                      help="seconds without a job separating two runs")
+
+    parser.add_option("--sample-regex", dest="sample_regex", type="string",
+                      help="regular expression extracting the sample "
+                      "from a job's output file name")
+
+    parser.add_option("--top", dest="top", type="int",
+                      help="number of samples to report")
+
+    parser.set_defaults(
+        database="jobstats.db",
+        jobstats_dir="jobstats.dir",
+        all_runs=False,
+        gap=3600,
+        sample_regex=r"^([^.]+-[^.]+-[^.]+-[^.]+?)\.",
+        top=10)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if not os.path.exists(options.database):
+        raise OSError("%s does not exist, run the pipeline with "
+                      "jobstats_record=1" % options.database)
+
+    dbh = sqlite3.connect(options.database, timeout=60)
+    try:
+        if options.jobstats_dir and os.path.isdir(options.jobstats_dir):
+            nrecords = mergeSidecars(dbh, options.jobstats_dir)
+            if nrecords:
+                E.info("merged %i job records from %s" %
+                       (nrecords, options.jobstats_dir))
+        jobs = readJobs(dbh)
+    finally:
+        dbh.close()
+
+    if not options.all_runs:
+        jobs = selectLastRun(jobs, options.gap)
+    if jobs:
+        E.info("%i jobs over %.0f seconds" %
+               (len(jobs), max(x["finished"] for x in jobs) -
+                min(x["submitted"] for x in jobs)))
+
+    outfile = options.stdout
+    writeSection(outfile, "tasks",
+                 ["task", "jobs", "failed", "wall", "queue_wait", "cpu",
+                  "cpu_per_thread", "reads", "reads_per_second",
+                  "read_bytes", "write_bytes", "max_rss"],
+                 summariseTasks(jobs))
+    writeSection(outfile, "samples",
+                 ["sample", "jobs", "wall", "slowest_task",
+                  "slowest_task_wall"],
+                 summariseSamples(jobs, re.compile(options.sample_regex),
+                                  options.top))
+    writeSection(outfile, "critical path",
+                 ["task", "job", "submitted", "idle", "queue_wait",
+                  "wall"],
+                 findCriticalPath(jobs))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,492 @@
+'''
+merge_tables.py - merge per-sample tables with constant memory
+===============================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Streaming replacement for the two ways this pipeline uses
+``combine_tables.py``. Only one row of each input is held in memory
+at any time, so memory does not grow with the number of samples.
+
+``--cat``
+   concatenate the tables. The header is written once, and every row
+   is prefixed with the groups matched by ``--regex-filename`` in the
+   name of the file it came from.
+
+``--columns``/``--take``
+   join the tables on the key ``--columns``. All inputs are read in
+   parallel, row by row, and must list the same keys in the same order
+   (featureCounts writes genes in annotation order for every
+   sample). The ``--take`` columns of each input are appended to the
+   key columns.
+
+Lines starting with ``#`` are skipped. Binary profile matrices (see
+:mod:`ProfileMatrix`) are read through their memory map.
+
+With ``--incremental`` the merged table is written to
+``--output-file`` and a record of the inputs it was built from is
+kept in ``<output-file>.state``. When the script is run again, only
+inputs that are new or changed (by size and modification time) are
+read:
+
+* in ``--cat`` mode their rows are appended to the existing table,
+  and rows of inputs that were removed or changed are dropped by
+  copying the rest of the existing table, without reading the other
+  inputs,
+* in join mode the existing table is read once and the columns of
+  new inputs are added next to the retained columns.
+
+Rows or columns of new inputs follow those already in the table. The
+table is rebuilt from all inputs if it or its state are missing or
+were made with different options.
+
+Usage
+-----
+
+Example::
+
+   python merge_tables.py
+       --regex-filename="profiles.dir/(.+)-(.+)-(.+).bwa.geneprofile.matrix.tsv.gz"
+       --cat pulldown,condition,replicate
+       -S combined_geneprofiles_matrix.txt
+       profiles.dir/*.geneprofile.matrix.tsv.gz
+
+   python merge_tables.py --use-file-prefix -c 1,2,3,4,5,6 -k 7
+       --regex-filename="(.+).txt" -S combined_gene_counts.txt
+       genecounts.dir/*.counts.txt
+
+   python merge_tables.py --incremental
+       --output-file=combined_gene_counts.txt
+       --use-file-prefix -c 1,2,3,4,5,6 -k 7
+       --regex-filename="(.+).txt" genecounts.dir/*.counts.txt
+
+Type::
+
+   python merge_tables.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import re
+import sys
+import json
+import CGAT.Experiment as E
+from CGAT import IOTools
+import ProfileMatrix
+
+# version of the layout of the .state files, older states are rebuilt
+STATE_VERSION = 2
+
+
+def iterateRows(filename):
+    '''iterate over the rows of *filename* as lists of fields.
+
+    The first row returned is the header.
+    '''
+    if ProfileMatrix.isBinary(filename):
+        header, names, matrix = ProfileMatrix.load(filename)
+        if header is not None:
+            yield header.split("\t")
+        for name, row in zip(names, matrix):
+            yield [name] + ["%.7g" % x for x in row]
+        return
+
+    with IOTools.openFile(filename) as inf:
+        for line in inf:
+            if line.startswith("#"):
+                continue
+            yield line.rstrip("\r\n").split("\t")
+
+
+def getPrefix(filename, regex):
+    '''return the groups of *regex* in *filename*.'''
+    if regex is None:
+        return (os.path.basename(filename).split(".")[0],)
+    match = regex.search(filename)
+    if match is None:
+        raise ValueError("%s does not match --regex-filename" % filename)
+    return match.groups()
+
+
+class CountingWriter(object):
+    '''write text to a binary file, keeping track of the offset.'''
+
+    def __init__(self, filename, mode="wb"):
+        self.outf = open(filename, mode)
+        self.offset = self.outf.tell() if "a" in mode else 0
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.outf.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        self.outf.close()
+
+
+def getFingerprint(filename):
+    '''return the size and modification time of *filename*.'''
+    if not os.path.exists(filename) and ProfileMatrix.isBinary(filename):
+        filename = ProfileMatrix.getPrefix(filename) + ".npy"
+    stat = os.stat(filename)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def concatenateTables(outfile, filenames, regex, categories, header=None,
+                      ranges=None):
+    '''concatenate tables, prefixing each row with its file's groups.
+
+    The header is written unless an expected *header* is given. If
+    *ranges* is a dictionary, the byte range of the rows of each file
+    in *outfile* is added to it.
+    '''
+    nrows = 0
+    for filename in filenames:
+        prefix = list(getPrefix(filename, regex))
+        if len(prefix) != len(categories):
+            raise ValueError("%s: %i groups for %i categories" %
+                             (filename, len(prefix), len(categories)))
+        rows = iterateRows(filename)
+        this_header = next(rows, None)
+        if this_header is None:
+            E.warn("%s is empty" % filename)
+            if ranges is not None:
+                ranges[filename] = [outfile.tell(), outfile.tell()]
+            continue
+        if header is None:
+            header = this_header
+            outfile.write("\t".join(categories + header) + "\n")
+        elif this_header != header:
+            raise ValueError("header of %s differs from the other "
+                             "inputs" % filename)
+        # the header is not part of any file's range
+        if ranges is not None:
+            start = outfile.tell()
+        for row in rows:
+            outfile.write("\t".join(prefix + row) + "\n")
+            nrows += 1
+        if ranges is not None:
+            ranges[filename] = [start, outfile.tell()]
+    return nrows
+
+
+def getTitles(filenames, headers, regex, take, use_file_prefix):
+    '''return the output column titles of the *take* columns.'''
+    titles = []
+    for filename, header in zip(filenames, headers):
+        prefix = getPrefix(filename, regex)[0]
+        for col in take:
+            if not use_file_prefix:
+                titles.append(header[col])
+            elif len(take) == 1:
+                titles.append(prefix)
+            else:
+                titles.append("%s_%s" % (prefix, header[col]))
+    return titles
+
+
+def joinTables(outfile, filenames, regex, columns, take,
+               use_file_prefix=False):
+    '''join tables on the key *columns*, reading them in lockstep.'''
+    iterators = [iterateRows(filename) for filename in filenames]
+    headers = [next(it) for it in iterators]
+    titles = getTitles(filenames, headers, regex, take, use_file_prefix)
+
+    outfile.write("\t".join([headers[0][col] for col in columns] +
+                            titles) + "\n")
+
+    nrows = 0
+    while True:
+        rows = [next(it, None) for it in iterators]
+        if rows[0] is None:
+            if any(row is not None for row in rows):
+                raise ValueError("%s has fewer rows than the other "
+                                 "inputs" % filenames[0])
+            break
+        key = [rows[0][col] for col in columns]
+        values = []
+        for filename, row in zip(filenames, rows):
+            if row is None:
+                raise ValueError("%s has fewer rows than %s" %
+                                 (filename, filenames[0]))
+            if [row[col] for col in columns] != key:
+                raise ValueError(
+                    "key %s in %s does not match %s in %s, inputs must "
+                    "list their keys in the same order" %
+                    ("\t".join(row[col] for col in columns), filename,
+                     "\t".join(key), filenames[0]))
+            values.extend(row[col] for col in take)
+        outfile.write("\t".join(key + values) + "\n")
+        nrows += 1
+    return nrows
+
+
+def updateConcatenation(outfilename, state, filenames, regex, categories):
+    '''bring the concatenated table in *outfilename* up to date with
+    *filenames*, reading only new or changed inputs.'''
+    recorded = dict((x["name"], x) for x in state["files"])
+    keep = [x for x in state["files"] if x["name"] in filenames and
+            x["fingerprint"] == getFingerprint(x["name"])]
+    kept = set(x["name"] for x in keep)
+    add = [x for x in filenames if x not in kept]
+    ndropped = len(recorded) - len(keep)
+
+    if ndropped:
+        # copy the retained rows into a new table
+        tmpfile = outfilename + ".tmp"
+        outf = CountingWriter(tmpfile)
+        with open(outfilename, "rb") as inf:
+            header = inf.readline()
+            outf.outf.write(header)
+            outf.offset = len(header)
+            for entry in keep:
+                start = outf.tell()
+                inf.seek(entry["range"][0])
+                outf.outf.write(inf.read(entry["range"][1] -
+                                         entry["range"][0]))
+                outf.offset += entry["range"][1] - entry["range"][0]
+                entry["range"] = [start, outf.tell()]
+        outf.close()
+        os.rename(tmpfile, outfilename)
+
+    header = state["header"]
+    outf = CountingWriter(outfilename, "ab")
+    ranges = {}
+    nrows = concatenateTables(outf, add, regex, categories,
+                              header=header, ranges=ranges)
+    outf.close()
+    if header is None:
+        header = readHeader(outfilename, len(categories))
+
+    state["header"] = header
+    state["files"] = keep + [{"name": x, "fingerprint": getFingerprint(x),
+                              "range": ranges[x]} for x in add]
+    E.info("kept %i, added %i and removed %i files" %
+           (len(keep), len(add), ndropped))
+    return nrows
+
+
+def updateJoin(outfilename, state, filenames, regex, columns, take,
+               use_file_prefix):
+    '''bring the joined table in *outfilename* up to date with
+    *filenames*, reading only new or changed inputs and the existing
+    table.'''
+    keep = [x for x in state["files"] if x["name"] in filenames and
+            x["fingerprint"] == getFingerprint(x["name"])]
+    kept = set(x["name"] for x in keep)
+    add = [x for x in filenames if x not in kept]
+    ndropped = len(state["files"]) - len(keep)
+    if not add and not ndropped:
+        E.info("%s is up to date" % outfilename)
+        return 0
+
+    # positions of the retained columns in the existing table
+    retain, position = [], len(columns)
+    retained = set(id(x) for x in keep)
+    for entry in state["files"]:
+        if id(entry) in retained:
+            retain.extend(range(position, position + len(take)))
+        position += len(take)
+
+    iterators = [iterateRows(filename) for filename in add]
+    headers = [next(it) for it in iterators]
+    titles = getTitles(add, headers, regex, take, use_file_prefix)
+
+    nkeys = len(columns)
+    tmpfile = outfilename + ".tmp"
+    nrows = 0
+    with IOTools.openFile(tmpfile, "w") as outf:
+        rows = iterateRows(outfilename)
+        header = next(rows)
+        outf.write("\t".join(header[:nkeys] + [header[x] for x in retain] +
+                             titles) + "\n")
+        for row in rows:
+            key = row[:nkeys]
+            values = [row[x] for x in retain]
+            for filename, it in zip(add, iterators):
+                other = next(it, None)
+                if other is None:
+                    raise ValueError("%s has fewer rows than %s" %
+                                     (filename, outfilename))
+                if [other[col] for col in columns] != key:
+                    raise ValueError(
+                        "key %s in %s does not match %s in %s, inputs must "
+                        "list their keys in the same order" %
+                        ("\t".join(other[col] for col in columns), filename,
+                         "\t".join(key), outfilename))
+                values.extend(other[col] for col in take)
+            outf.write("\t".join(key + values) + "\n")
+            nrows += 1
+    for filename, it in zip(add, iterators):
+        if next(it, None) is not None:
+            raise ValueError("%s has more rows than %s" %
+                             (filename, outfilename))
+    os.rename(tmpfile, outfilename)
+
+    state["files"] = keep + [{"name": x, "fingerprint": getFingerprint(x)}
+                             for x in add]
+    E.info("kept %i, added %i and removed %i files" %
+           (len(keep), len(add), ndropped))
+    return nrows
+
+
+def readHeader(filename, nprefix=0):
+    '''return the header of a merged table without the first
+    *nprefix* columns, or None if it is empty.'''
+    with open(filename) as inf:
+        line = inf.readline()
+    if not line:
+        return None
+    return line.rstrip("\r\n").split("\t")[nprefix:]
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--cat", dest="cat", type="string",
+                      help="concatenate tables, adding these comma "
+                      "separated columns filled from --regex-filename")
+
+    parser.add_option("-c", "--columns", dest="columns", type="string",
+                      help="comma separated key columns (1-based) to "
+                      "join on")
+
+    parser.add_option("-k", "--take", dest="take", type="string",
+                      help="comma separated columns (1-based) to take "
+                      "from each table")
+
+    parser.add_option("--regex-filename", dest="regex_filename",
+                      type="string",
+                      help="regular expression extracting the sample "
+                      "name(s) from the filename")
+
+    parser.add_option("--use-file-prefix", dest="use_file_prefix",
+                      action="store_true",
+                      help="name taken columns after the file")
+
+    parser.add_option("--output-file", dest="output_file", type="string",
+                      help="write the merged table to this file instead "
+                      "of stdout")
+
+    parser.add_option("--incremental", dest="incremental",
+                      action="store_true",
+                      help="update --output-file, reading only new or "
+                      "changed inputs")
+
+    parser.set_defaults(
+        cat=None,
+        columns="1",
+        take=None,
+        regex_filename=None,
+        use_file_prefix=False,
+        output_file=None,
+        incremental=False)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    filenames = args
+    if not filenames:
+        raise ValueError("no input files given")
+
+    regex = None
+    if options.regex_filename:
+        regex = re.compile(options.regex_filename)
+
+    if options.incremental and not options.output_file:
+        raise ValueError("--incremental requires an --output-file")
+
+    settings = {"version": STATE_VERSION, "cat": options.cat, "columns": options.columns,
+                "take": options.take,
+                "regex_filename": options.regex_filename,
+                "use_file_prefix": options.use_file_prefix}
+    if options.cat:
+        categories = options.cat.split(",")
+    else:
+        if not options.take:
+            raise ValueError("please specify the columns to --take")
+        columns = [int(x) - 1 for x in options.columns.split(",")]
+        take = [int(x) - 1 for x in options.take.split(",")]
+
+    state, statefile = None, None
+    if options.incremental:
+        statefile = options.output_file + ".state"
+        if os.path.exists(statefile) and \
+           os.path.exists(options.output_file):
+            with open(statefile) as inf:
+                state = json.load(inf)
+            if state["settings"] != settings or \
+               state["fingerprint"] != getFingerprint(options.output_file):
+                E.info("%s was made differently, rebuilding" %
+                       options.output_file)
+                state = None
+
+    if state is not None:
+        if options.cat:
+            nrows = updateConcatenation(options.output_file, state,
+                                        filenames, regex, categories)
+        else:
+            nrows = updateJoin(options.output_file, state, filenames, regex,
+                               columns, take, options.use_file_prefix)
+    else:
+        if options.output_file:
+            outfile = CountingWriter(options.output_file)
+        else:
+            outfile = options.stdout
+        # byte ranges are only needed to update the output in place
+        ranges = {} if statefile else None
+        if options.cat:
+            nrows = concatenateTables(outfile, filenames, regex, categories,
+                                      ranges=ranges)
+        else:
+            nrows = joinTables(outfile, filenames, regex, columns, take,
+                               use_file_prefix=options.use_file_prefix)
+        if options.output_file:
+            outfile.close()
+        if statefile:
+            files = [{"name": x, "fingerprint": getFingerprint(x)}
+                     for x in filenames]
+            if options.cat:
+                for entry in files:
+                    entry["range"] = ranges[entry["name"]]
+            state = {"settings": settings, "files": files,
+                     "header": readHeader(options.output_file,
+                                          len(categories))
+                     if options.cat else None}
+
+    if statefile:
+        state["fingerprint"] = getFingerprint(options.output_file)
+        with open(statefile + ".tmp", "w") as outf:
+            json.dump(state, outf)
+        os.rename(statefile + ".tmp", statefile)
+
+    E.info("merged %i files, wrote %i rows" % (len(filenames), nrows))
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
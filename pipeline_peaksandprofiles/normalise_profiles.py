@@ -1,6 +1,6 @@
 '''
-cgat_script_template.py - template for CGAT scripts
-====================================================
+normalise_profiles.py - normalise per-transcript profiles to their total
+=========================================================================
 
 :Author:
 :Release: $Id$
@@ -10,20 +10,32 @@ cgat_script_template.py - template for CGAT scripts
 Purpose
 -------
 
-.. Overall purpose and function of the script>
+Normalise every row of a profile matrix (as written by
+``bam2geneprofile.py --output-all-profiles``) so that its values sum
+to one. Rows that sum to zero are dropped. The first column is the
+row name and is passed through unchanged, as is a header line.
+
+The matrix is read in blocks of ``--chunk-size`` rows which are
+parsed and normalised as NumPy arrays and written out in one go, so
+memory use is bounded by the chunk size rather than the number of
+rows.
+
+The input can also be a binary matrix written by ``profiles2npy.py``
+(see :mod:`ProfileMatrix`), which is read through a memory map
+without parsing. With ``--output-binary`` the normalised matrix is
+written in the same binary format instead of as text.
 
 Usage
 -----
 
-.. Example use case
-
 Example::
 
-   python cgat_script_template.py
+   python normalise_profiles.py -m sample.geneprofile.profiles.tsv.gz
+       > sample.normalisedprofile.tsv
 
 Type::
 
-   python cgat_script_template.py --help
+   python normalise_profiles.py --help
 
 for command line help.
 
@@ -33,12 +45,38 @@ Command line options
 '''
 
 import sys
+import itertools
+import numpy
 import CGAT.Experiment as E
-import os
-import re
 from CGAT import IOTools
-from CGAT import Fastq
-from CGAT import FastaIterator
+import ProfileMatrix
+
+
+def normaliseChunk(names, matrix):
+    '''normalise rows to their total, dropping rows that sum to zero.
+
+    Values are computed as float64, also for the float32 blocks of
+    binary matrices, so that they are written with the digits of
+    Python floats.
+    '''
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    totals = matrix.sum(axis=1)
+    keep = totals != 0
+    matrix = matrix[keep] / totals[keep, numpy.newaxis]
+    names = [name for name, k in zip(names, keep) if k]
+    return names, matrix
+
+
+def writeChunk(outfile, names, matrix, float_format):
+    '''write a block of rows with a single call to *outfile*.'''
+    if len(names) == 0:
+        return
+    row_format = "%s" + ("\t" + float_format) * matrix.shape[1] + "\n"
+    outfile.write("".join(
+        row_format % ((name,) + tuple(row))
+        for name, row in zip(names, matrix.tolist())))
+
+
 def main(argv=None):
     """script main.
     parses command line options in sys.argv, unless *argv* is given.
@@ -51,47 +89,71 @@ def main(argv=None):
     parser = E.OptionParser(version="%prog version: $Id$",
                             usage=globals()["__doc__"])
 
-    parser.add_option("-m","--profilematrix", dest="matrixfile", type="string",
+    parser.add_option("-m", "--profilematrix", dest="matrixfile",
+                      type="string",
                       help="name of profile file you want to convert")
 
-# add common options (-h/--help, ...) and parse command line
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      help="number of rows to process at a time")
+
+    parser.add_option("--float-format", dest="float_format",
+                      type="string",
+                      help="format for normalised values, by default "
+                      "as written by str()")
+
+    parser.add_option("--output-binary", dest="output_binary",
+                      type="string",
+                      help="write a binary matrix with this prefix "
+                      "instead of text to stdout")
+
+    parser.set_defaults(
+        matrixfile=None,
+        output_binary=None,
+        chunk_size=10000,
+        float_format="%s")
+
+    # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv)
-    #outf = IOTools.openFile("my_output", "w")
-    seen = 0
-    for line in IOTools.openFile(options.matrixfile):
-        #seen += 1
-        #E.debug(seen)
-        #if seen > 1000:
-            #break
-        line = line.strip()
-        fields = line.split("\t")
-        #print "before", len(fields)
-        for i, col in enumerate(fields):
-            if i == " ":
-                fields[i] = "0"
-            else: continue
-
-        #for i, col in enumerate(fields):
-            #if re.match('\s',col):
-                #fields[i] = "0"
-            #else: continue
-
-        try:
-            total = sum([float(col) for col in fields[1:]])
-        except ValueError:
-            
-            E.debug("Whole line was %s " % line) 
-            E.debug("Could not convert column %s" % col)
-	    raise
-
-        if total == 0:
-            continue
+
+    if ProfileMatrix.isBinary(options.matrixfile):
+        header = ProfileMatrix.load(options.matrixfile)[0]
+        chunks = ProfileMatrix.iterateChunks(options.matrixfile,
+                                             options.chunk_size)
+    else:
+        infile = IOTools.openFile(options.matrixfile)
+        first = infile.readline()
+        header = None
+        if first and ProfileMatrix.isHeader(first):
+            header = first.strip()
+        elif first:
+            infile = itertools.chain([first], infile)
+        chunks = ProfileMatrix.iterateTextChunks(infile,
+                                                 options.chunk_size)
+
+    if options.output_binary:
+        writer = ProfileMatrix.Writer(options.output_binary, header=header)
+    else:
+        writer = None
+        if header is not None:
+            options.stdout.write(header + "\n")
+
+    ninput, noutput = 0, 0
+    for names, matrix in chunks:
+        ninput += len(names)
+        names, matrix = normaliseChunk(names, matrix)
+        noutput += len(names)
+        if writer:
+            writer.write(names, matrix)
         else:
-            for i, col in enumerate(fields):
-                if i == 0: continue
-                fields[i] = float(col)/total
-        #print "after", len(fields)
-        options.stdout.write("\t".join(map(str,fields))+"\n")
+            writeChunk(options.stdout, names, matrix,
+                       options.float_format)
+
+    if writer:
+        writer.close()
+
+    E.info("ninput=%i, noutput=%i, nzero=%i" %
+           (ninput, noutput, ninput - noutput))
+
     # write footer and output benchmark information.
     E.Stop()
 
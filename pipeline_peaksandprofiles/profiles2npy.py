@@ -0,0 +1,107 @@
+'''
+profiles2npy.py - convert profile matrices between text and binary
+===================================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Convert a per-transcript profile matrix written by
+``bam2geneprofile.py --output-all-profiles`` (``.profiles.tsv.gz``)
+into the binary format of :mod:`ProfileMatrix`: a float32 ``.npy``
+matrix that can be memory mapped, plus a ``.rows.tsv.gz`` file with
+the row names.
+
+With ``--to-text`` a binary matrix is converted back to text.
+
+Usage
+-----
+
+Example::
+
+   python profiles2npy.py -m sample.geneprofile.profiles.tsv.gz
+          -P sample.geneprofile.profiles
+
+   python profiles2npy.py --to-text -m sample.geneprofile.profiles.npy
+          > sample.geneprofile.profiles.tsv
+
+Type::
+
+   python profiles2npy.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import CGAT.Experiment as E
+import ProfileMatrix
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-m", "--profilematrix", dest="matrixfile",
+                      type="string",
+                      help="profile matrix to convert")
+
+    parser.add_option("-P", "--output-prefix", dest="output_prefix",
+                      type="string",
+                      help="prefix for the binary output files")
+
+    parser.add_option("--to-text", dest="to_text", action="store_true",
+                      help="convert a binary matrix to text on stdout")
+
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      help="number of rows to convert at a time")
+
+    parser.set_defaults(
+        matrixfile=None,
+        output_prefix=None,
+        to_text=False,
+        chunk_size=10000)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    if options.to_text:
+        header = ProfileMatrix.load(options.matrixfile)[0]
+        if header is not None:
+            options.stdout.write(header + "\n")
+        nrows = 0
+        for names, matrix in ProfileMatrix.iterateChunks(
+                options.matrixfile, options.chunk_size):
+            options.stdout.write("".join(
+                "%s\t%s\n" % (name, "\t".join("%.7g" % x for x in row))
+                for name, row in zip(names, matrix.tolist())))
+            nrows += len(names)
+    else:
+        if not options.output_prefix:
+            raise ValueError("please specify an --output-prefix")
+        nrows = ProfileMatrix.fromText(options.matrixfile,
+                                       options.output_prefix,
+                                       chunk_size=options.chunk_size)
+
+    E.info("converted %i rows" % nrows)
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,415 @@
+'''
+simulate_chipseq.py - simulate a small ChIP-seq dataset
+========================================================
+
+:Author:
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Write a synthetic, reproducible ChIP-seq experiment into
+``--output-dir`` that the pipeline can run on:
+
+``contigs.tsv``
+   contig names and sizes.
+
+``geneset.gtf.gz``
+   ``--genes`` genes with one to three transcripts of one to six
+   exons each.
+
+``<tissue>-ChIP-<condition>-<replicate>.bwa.bam``
+   coordinate sorted and indexed ChIP samples. A fraction
+   ``--enrichment`` of the fragments comes from ``--peaks`` enriched
+   regions, half of them at transcription start sites, the rest is
+   uniform background.
+
+``<tissue>-Input-<condition>[-<replicate>].bwa.bam``
+   the matching controls, uniform background only. With
+   ``--input-per-sample`` there is one control per replicate,
+   otherwise one per condition (``job_inputpersample`` in the
+   pipeline).
+
+``peaks.bed``
+   the simulated peaks.
+
+``<ChIP sample>.treat_pileup.bdg``, ``<ChIP sample>.control_lambda.bdg``
+   with ``--bedgraphs``, fragment pileup and local control lambda
+   tracks in the format of ``macs2 callpeak -B``.
+
+Fragments are duplicated with probability ``--duplicate-rate`` and
+a fraction ``--low-mapq`` of the reads has a mapping quality below
+30, so that read filtering and duplicate removal have work to do.
+Paired-end reads carry the ``MC``, ``MQ`` and ``ms`` tags written by
+``samtools fixmate -m``.
+
+The same ``--seed`` always gives the same files.
+
+Usage
+-----
+
+Example::
+
+   python simulate_chipseq.py --output-dir=benchmark.dir/data
+       --reads=200000 --paired --duplicate-rate=0.1
+
+Type::
+
+   python simulate_chipseq.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import numpy
+import pysam
+import CGAT.Experiment as E
+from CGAT import IOTools
+
+
+def simulateGenes(rng, contigs, ngenes):
+    '''return a list of genes as (gene_id, contig, strand, transcripts),
+    where transcripts are lists of (start, end) exons, 0-based.'''
+    sizes = numpy.array([size for contig, size in contigs], dtype=float)
+    genes = []
+    for n in range(ngenes):
+        contig, size = contigs[rng.choice(len(contigs), p=sizes / sizes.sum())]
+        length = int(rng.uniform(2000, 50000))
+        start = int(rng.uniform(1000, max(1001, size - length - 1000)))
+        strand = "+" if rng.rand() < 0.5 else "-"
+        transcripts = []
+        for t in range(rng.randint(1, 4)):
+            nexons = rng.randint(1, 7)
+            bounds = numpy.sort(rng.choice(
+                numpy.arange(start + 1, start + length - 1),
+                size=2 * nexons - 2, replace=False))
+            bounds = [start] + list(bounds) + [start + length]
+            exons = [(int(bounds[2 * x]), int(bounds[2 * x + 1]))
+                     for x in range(nexons)]
+            transcripts.append([(s, e) for s, e in exons if e > s])
+        genes.append(("ENSGSIM%06i" % n, contig, strand, transcripts))
+    return genes
+
+
+def writeGTF(outfile, genes):
+    lines = []
+    for gene_id, contig, strand, transcripts in genes:
+        for t, exons in enumerate(transcripts):
+            for s, e in exons:
+                lines.append((contig, s, "\t".join((
+                    contig, "simulated", "exon", str(s + 1), str(e), ".",
+                    strand, ".",
+                    'gene_id "%s"; transcript_id "%s.%i"; gene_name "%s";'
+                    % (gene_id, gene_id, t, gene_id)))))
+    lines.sort()
+    with IOTools.openFile(outfile, "w") as outf:
+        for contig, start, line in lines:
+            outf.write(line + "\n")
+
+
+def simulatePeaks(rng, contigs, genes, npeaks):
+    '''return peaks as (contig, start, end, weight).'''
+    sizes = dict(contigs)
+    peaks = []
+    for n in range(npeaks):
+        width = int(rng.uniform(200, 2000))
+        if n % 2 == 0 and genes:
+            gene_id, contig, strand, transcripts = genes[rng.randint(len(genes))]
+            tss = transcripts[0][0][0] if strand == "+" \
+                else transcripts[0][-1][1]
+            start = tss - width // 2
+        else:
+            contig, size = contigs[rng.randint(len(contigs))]
+            start = int(rng.uniform(0, size - width))
+        start = max(0, min(start, sizes[contig] - width))
+        peaks.append((contig, start, start + width, rng.lognormal(0, 0.5)))
+    return peaks
+
+
+def simulateFragments(rng, contigs, peaks, nfragments, enrichment,
+                      fragment_length, duplicate_rate):
+    '''return arrays of contig index, start, end and strand of
+    fragments.'''
+    sizes = numpy.array([size for contig, size in contigs], dtype=float)
+    index = dict((contig, x) for x, (contig, size) in enumerate(contigs))
+
+    npeak = int(nfragments * enrichment) if peaks else 0
+    nbackground = nfragments - npeak
+
+    tid = rng.choice(len(contigs), size=nbackground, p=sizes / sizes.sum())
+    centre = (rng.rand(nbackground) * sizes[tid]).astype(numpy.int64)
+
+    if npeak:
+        weights = numpy.array([peak[3] for peak in peaks])
+        which = rng.choice(len(peaks), size=npeak, p=weights / weights.sum())
+        peak_tid = numpy.array([index[peaks[x][0]] for x in which])
+        peak_start = numpy.array([peaks[x][1] for x in which])
+        peak_end = numpy.array([peaks[x][2] for x in which])
+        peak_centre = peak_start + (
+            rng.rand(npeak) * (peak_end - peak_start)).astype(numpy.int64)
+        tid = numpy.concatenate([tid, peak_tid])
+        centre = numpy.concatenate([centre, peak_centre])
+
+    length = numpy.maximum(
+        50, rng.normal(fragment_length, fragment_length * 0.15,
+                       size=len(tid))).astype(numpy.int64)
+    start = numpy.maximum(0, centre - length // 2)
+    end = numpy.minimum(sizes[tid].astype(numpy.int64), start + length)
+    strand = rng.rand(len(tid)) < 0.5
+
+    duplicated = rng.rand(len(tid)) < duplicate_rate
+    ncopies = 1 + duplicated * rng.geometric(0.5, size=len(tid))
+    repeat = numpy.repeat(numpy.arange(len(tid)), ncopies)
+    return tid[repeat], start[repeat], end[repeat], strand[repeat]
+
+
+def writeBAM(filename, rng, contigs, fragments, read_length, paired,
+             low_mapq):
+    '''write fragments as coordinate sorted reads to *filename*.'''
+    tid, start, end, strand = fragments
+    header = {"HD": {"VN": "1.4", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": size} for contig, size in contigs]}
+    sequence = "ACGT" * (read_length // 4 + 1)
+    sequence = sequence[:read_length]
+    qualities = pysam.qualitystring_to_array("I" * read_length)
+    score = 40 * read_length
+    cigar = "%iM" % read_length
+    mapq = numpy.where(rng.rand(len(tid)) < low_mapq,
+                       rng.randint(0, 30, size=len(tid)), 60)
+
+    reads = []
+    for n in range(len(tid)):
+        t, s, e = int(tid[n]), int(start[n]), int(end[n])
+        length = min(read_length, e - s)
+        left, right = s, max(s, e - length)
+        name = "frag%09i" % n
+        if not paired:
+            reads.append((t, right if strand[n] else left, name, 0,
+                          bool(strand[n]), int(mapq[n])))
+            continue
+        # read 1 on the fragment's strand, read 2 on the other
+        first_reverse = bool(strand[n])
+        reads.append((t, right if first_reverse else left, name, 1,
+                      first_reverse, int(mapq[n]), left, right, e - s))
+        reads.append((t, left if first_reverse else right, name, 2,
+                      not first_reverse, int(mapq[n]), left, right, e - s))
+    reads.sort(key=lambda x: (x[0], x[1], x[2], x[3]))
+
+    with pysam.AlignmentFile(filename, "wb", header=header) as outf:
+        for read in reads:
+            segment = pysam.AlignedSegment()
+            segment.query_name = read[2]
+            segment.query_sequence = sequence
+            segment.query_qualities = qualities
+            segment.reference_id = read[0]
+            segment.reference_start = read[1]
+            segment.cigarstring = cigar
+            segment.mapping_quality = read[5]
+            flag = 16 if read[4] else 0
+            if read[3]:
+                left, right, tlen = read[6], read[7], read[8]
+                flag |= 1 | 2 | (64 if read[3] == 1 else 128)
+                flag |= 0 if read[4] else 32
+                segment.next_reference_id = read[0]
+                segment.next_reference_start = right if read[1] == left \
+                    else left
+                segment.template_length = tlen if read[1] == left else -tlen
+                segment.set_tag("MC", cigar)
+                segment.set_tag("MQ", read[5])
+                segment.set_tag("ms", score)
+            segment.flag = flag
+            outf.write(segment)
+    pysam.index(filename)
+    return len(reads)
+
+
+def writeBedGraph(filename, contigs, intervals):
+    '''write a bedGraph of the step function given for each contig as
+    (positions, values) with values[i] between positions[i] and
+    positions[i + 1].'''
+    with open(filename, "w") as outf:
+        for contig, size in contigs:
+            positions, values = intervals[contig]
+            for x in range(len(values)):
+                if positions[x + 1] > positions[x]:
+                    outf.write("%s\t%i\t%i\t%.5f\n" % (
+                        contig, positions[x], positions[x + 1], values[x]))
+
+
+def coverageSteps(starts, ends, size, scale=1.0):
+    '''return positions and values of the pileup of intervals.'''
+    delta = numpy.zeros(size + 1)
+    numpy.add.at(delta, starts, 1)
+    numpy.add.at(delta, ends, -1)
+    depth = numpy.cumsum(delta[:-1]) * scale
+    change = numpy.flatnonzero(numpy.diff(depth)) + 1
+    positions = numpy.concatenate([[0], change, [size]])
+    return positions, depth[positions[:-1]]
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-d", "--output-dir", dest="output_dir",
+                      type="string",
+                      help="directory to write the dataset to")
+
+    parser.add_option("--contigs", dest="contigs", type="string",
+                      help="comma separated contig:size pairs")
+
+    parser.add_option("--genes", dest="genes", type="int",
+                      help="number of genes")
+
+    parser.add_option("--peaks", dest="peaks", type="int",
+                      help="number of enriched regions")
+
+    parser.add_option("--reads", dest="reads", type="int",
+                      help="fragments per sample before duplication")
+
+    parser.add_option("--enrichment", dest="enrichment", type="float",
+                      help="fraction of ChIP fragments from peaks")
+
+    parser.add_option("--duplicate-rate", dest="duplicate_rate",
+                      type="float",
+                      help="probability that a fragment is duplicated")
+
+    parser.add_option("--low-mapq", dest="low_mapq", type="float",
+                      help="fraction of reads with mapping quality < 30")
+
+    parser.add_option("--paired", dest="paired", action="store_true",
+                      help="simulate paired-end reads")
+
+    parser.add_option("--read-length", dest="read_length", type="int",
+                      help="read length")
+
+    parser.add_option("--fragment-length", dest="fragment_length",
+                      type="int",
+                      help="mean fragment length")
+
+    parser.add_option("--tissue", dest="tissue", type="string",
+                      help="tissue part of the sample names")
+
+    parser.add_option("--conditions", dest="conditions", type="string",
+                      help="comma separated conditions")
+
+    parser.add_option("--replicates", dest="replicates", type="int",
+                      help="ChIP replicates per condition")
+
+    parser.add_option("--input-per-sample", dest="input_per_sample",
+                      action="store_true",
+                      help="one Input per ChIP replicate")
+
+    parser.add_option("--bedgraphs", dest="bedgraphs", action="store_true",
+                      help="write MACS2 style pileup and lambda tracks")
+
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="random seed")
+
+    parser.set_defaults(
+        output_dir=".",
+        contigs="chr1:2000000,chr2:1500000,chr3:1000000",
+        genes=300,
+        peaks=200,
+        reads=100000,
+        enrichment=0.3,
+        duplicate_rate=0.1,
+        low_mapq=0.05,
+        paired=False,
+        read_length=50,
+        fragment_length=200,
+        tissue="Sim",
+        conditions="A,B",
+        replicates=2,
+        input_per_sample=False,
+        bedgraphs=False,
+        seed=1)
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
+
+    rng = numpy.random.RandomState(options.seed)
+    contigs = [(x.split(":")[0], int(x.split(":")[1]))
+               for x in options.contigs.split(",")]
+    if not os.path.exists(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    def _path(filename):
+        return os.path.join(options.output_dir, filename)
+
+    IOTools.writeLines(_path("contigs.tsv"),
+                       [[contig, str(size)] for contig, size in contigs],
+                       header=None)
+
+    genes = simulateGenes(rng, contigs, options.genes)
+    writeGTF(_path("geneset.gtf.gz"), genes)
+
+    peaks = simulatePeaks(rng, contigs, genes, options.peaks)
+    IOTools.writeLines(_path("peaks.bed"),
+                       [[contig, str(start), str(end), "%.3f" % weight]
+                        for contig, start, end, weight in sorted(peaks)],
+                       header=None)
+
+    samples = []
+    for condition in options.conditions.split(","):
+        for replicate in range(1, options.replicates + 1):
+            samples.append(("%s-ChIP-%s-%i.bwa" % (
+                options.tissue, condition, replicate), options.enrichment))
+            if options.input_per_sample:
+                samples.append(("%s-Input-%s-%i.bwa" % (
+                    options.tissue, condition, replicate), 0.0))
+        if not options.input_per_sample:
+            samples.append(("%s-Input-%s.bwa" % (
+                options.tissue, condition), 0.0))
+
+    for sample, enrichment in samples:
+        fragments = simulateFragments(
+            rng, contigs, peaks if enrichment else [], options.reads,
+            enrichment, options.fragment_length, options.duplicate_rate)
+        nreads = writeBAM(_path(sample + ".bam"), rng, contigs, fragments,
+                          options.read_length, options.paired,
+                          options.low_mapq)
+        E.info("%s: %i reads" % (sample, nreads))
+
+        if options.bedgraphs and enrichment:
+            tid, start, end, strand = fragments
+            scale = 1e6 / len(tid)
+            pileup, control = {}, {}
+            for x, (contig, size) in enumerate(contigs):
+                on = tid == x
+                pileup[contig] = coverageSteps(start[on], end[on], size,
+                                               scale)
+                # local lambda from the background rate in 10kb windows
+                window = 10000
+                bins = numpy.arange(0, size + window, window)
+                counts = numpy.histogram(start[on], bins=bins)[0]
+                rate = numpy.maximum(
+                    counts * options.fragment_length / float(window),
+                    numpy.median(counts) * options.fragment_length /
+                    float(window)) * scale
+                control[contig] = (numpy.minimum(bins, size), rate)
+            writeBedGraph(_path(sample + ".treat_pileup.bdg"), contigs,
+                          pileup)
+            writeBedGraph(_path(sample + ".control_lambda.bdg"), contigs,
+                          control)
+
+    # write footer and output benchmark information.
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
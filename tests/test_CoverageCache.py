@@ -0,0 +1,105 @@
+'''tests for CoverageCache, comparing binned coverage and fragment
+counts with per-base computations.'''
+
+import os
+import sys
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pysam = pytest.importorskip("pysam")
+pytest.importorskip("CGAT.IOTools")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "pipeline_peaksandprofiles"))
+import CoverageCache  # noqa: E402
+
+CONTIGS = [("chr1", 1000), ("chr2", 500)]
+
+
+def writeBAM(filename, reads):
+    '''write a sorted, indexed BAM of *reads*, tuples of (name, contig
+    index, start, length, flag, mate start, template length).'''
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": x, "LN": y} for x, y in CONTIGS]}
+    with pysam.AlignmentFile(filename, "wb", header=header) as outf:
+        for name, tid, start, length, flag, mate, tlen in sorted(
+                reads, key=lambda x: (x[1], x[2])):
+            read = pysam.AlignedSegment()
+            read.query_name = name
+            read.flag = flag
+            read.reference_id = tid
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = [(0, length)]
+            read.query_sequence = "A" * length
+            read.query_qualities = pysam.qualitystring_to_array(
+                "I" * length)
+            if flag & 1:
+                read.next_reference_id = tid
+                read.next_reference_start = mate
+                read.template_length = tlen
+            outf.write(read)
+    pysam.index(filename)
+
+
+def depthBruteForce(fragments, length):
+    depth = numpy.zeros(length)
+    for start, end in fragments:
+        depth[start:end] += 1
+    return depth
+
+
+READS = [
+    # a proper pair covering [100, 300)
+    ("p1", 0, 100, 50, 99, 250, 200),
+    ("p1", 0, 250, 50, 147, 100, -200),
+    # single forward and reverse reads, extended to 100 bases
+    ("s1", 0, 400, 50, 0, 0, 0),
+    ("s2", 0, 600, 50, 16, 0, 0),
+    # a reverse read near the start of chr2, clipped at 0
+    ("s3", 1, 20, 50, 16, 0, 0),
+    # not counted
+    ("u1", 0, 700, 50, 256, 0, 0),
+]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    bamfile = str(tmp_path / "sample.bam")
+    writeBAM(bamfile, READS)
+    prefix = str(tmp_path / "coverage.dir" / "sample")
+    nfragments = CoverageCache.build(bamfile, prefix, binsize=10,
+                                     fragment_length=100)
+    assert nfragments == 4
+    return CoverageCache.load(prefix)
+
+
+def testBinCoverage():
+    rng = numpy.random.RandomState(42)
+    length, binsize = 1003, 10
+    starts = rng.randint(0, length - 1, 300)
+    ends = numpy.minimum(length, starts + rng.randint(1, 150, 300))
+    coverage = CoverageCache.binCoverage(starts, ends, length, binsize)
+    depth = depthBruteForce(zip(starts, ends), length)
+    expected = [depth[x:x + binsize].mean()
+                for x in range(0, length, binsize)]
+    assert numpy.allclose(coverage, expected, rtol=1e-5)
+
+
+def testCoverage(cache):
+    fragments = {"chr1": [(100, 300), (400, 500), (550, 650)],
+                 "chr2": [(0, 70)]}
+    for contig, length in CONTIGS:
+        depth = depthBruteForce(fragments[contig], length)
+        expected = depth.reshape(-1, 10).mean(axis=1)
+        assert numpy.allclose(cache.getCoverage(contig), expected)
+    assert cache.fragments == {"chr1": 3, "chr2": 1}
+
+
+def testCountFragments(cache):
+    # fragment centres are at 200, 450 and 600
+    counts = cache.countFragments("chr1", [0, 200, 450, 600, 0],
+                                  [200, 450, 600, 1000, 1000])
+    assert counts.tolist() == [0, 1, 1, 1, 3]
+    assert cache.countFragments("chrX", [0], [10]).tolist() == [0]
@@ -0,0 +1,130 @@
+'''tests for GenesetCache, comparing the vectorised interval sweeps
+with checks of every pair of windows.'''
+
+import os
+import sys
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pytest.importorskip("CGAT.IOTools")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import GenesetCache  # noqa: E402
+
+# gene, contig, start (1-based), end, strand
+GENES = [("g1", "chr1", 1001, 2000, "+"),
+         ("g2", "chr1", 3501, 4000, "-"),
+         ("g3", "chr1", 9001, 9500, "+"),
+         ("g4", "chr2", 101, 600, "-"),
+         ("g5", "chr2", 2601, 3000, "+"),
+         ("g6", "chr2", 20001, 21000, "+")]
+
+
+def writeGTF(filename, genes):
+    with open(filename, "w") as outf:
+        outf.write("#!genome-build test\n")
+        for gene, contig, start, end, strand in genes:
+            for exon_start, exon_end in ((start, start + 99),
+                                         (end - 99, end)):
+                outf.write("\t".join(map(str, [
+                    contig, "test", "exon", exon_start, exon_end, ".",
+                    strand, ".",
+                    'gene_id "%s"; transcript_id "%s.1";' % (gene, gene)]))
+                    + "\n")
+
+
+def mergeBruteForce(windows):
+    '''merge [start, end) windows one by one.'''
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][2] += 1
+        else:
+            merged.append([start, end, 1])
+    return merged
+
+
+# 12 contigs of 250 Mb with a pair of overlapping genes near the end
+# of each, so that positions on a single axis over all contigs exceed
+# the range of int32 from chr9 onwards
+LARGE_CONTIG = 250000000
+LARGE_GENES = [(gene, "chr%i" % n, start, start + 1000, "+")
+               for n in range(1, 13)
+               for gene, start in (("a%i" % n, LARGE_CONTIG - 10000),
+                                   ("b%i" % n, LARGE_CONTIG - 8500))]
+
+
+@pytest.fixture
+def geneset(tmp_path):
+    writeGTF(str(tmp_path / "genes.gtf"), GENES)
+    return GenesetCache.load(GenesetCache.build(str(tmp_path / "genes.gtf"),
+                                                str(tmp_path / "cache")))
+
+
+def testMergeWindows():
+    rng = numpy.random.RandomState(42)
+    start = rng.randint(0, 10000, 500)
+    end = start + rng.randint(1, 200, 500)
+    region_start, region_end, counts = GenesetCache.mergeWindows(start, end)
+    expected = mergeBruteForce(zip(start.tolist(), end.tolist()))
+    assert [list(x) for x in zip(region_start.tolist(), region_end.tolist(),
+                                 counts.tolist())] == expected
+
+
+def testBuildIsCached(tmp_path, geneset):
+    assert len(geneset) == 2 * len(GENES)
+    assert geneset.contigs == ["chr1", "chr2"]
+    assert GenesetCache.build(str(tmp_path / "genes.gtf"),
+                              str(tmp_path / "cache")) == geneset.path
+
+
+def testFindOverlappingGenes(geneset):
+    sizes = dict(geneset.getContigSizes())
+    mask = GenesetCache.findOverlappingGenes(geneset, sizes, 1000, 1000)
+
+    # extensions are the same on both sides, so strand does not matter
+    windows = [(contig, max(0, start - 1 - 1000),
+                min(sizes[contig], end + 1000), gene)
+               for gene, contig, start, end, strand in GENES]
+    shared = set()
+    for a in windows:
+        for b in windows:
+            if a is not b and a[0] == b[0] and a[1] <= b[2] and \
+               b[1] <= a[2]:
+                shared.add(a[3])
+    expected = [geneset.genes[x] in shared for x in geneset.gene]
+    assert mask.tolist() == expected
+    assert sorted(shared) == ["g1", "g2", "g4", "g5"]
+
+
+def testGetTargetRegions(geneset):
+    sizes = dict(geneset.getContigSizes())
+    keep = numpy.asarray(geneset.gene) != geneset.genes.index("g2")
+    regions = GenesetCache.getTargetRegions(geneset, keep, sizes, 500, 100)
+    assert regions == [("chr1", 500, 2100), ("chr1", 8500, 9500),
+                       ("chr2", 0, 1100), ("chr2", 2100, 3100),
+                       ("chr2", 19500, 21000)]
+
+
+@pytest.fixture
+def large_geneset(tmp_path):
+    writeGTF(str(tmp_path / "large.gtf"), LARGE_GENES)
+    return GenesetCache.load(GenesetCache.build(str(tmp_path / "large.gtf"),
+                                                str(tmp_path / "cache")))
+
+
+def testFindOverlappingGenesOnLargeContigs(large_geneset):
+    sizes = dict(("chr%i" % n, LARGE_CONTIG) for n in range(1, 13))
+    mask = GenesetCache.findOverlappingGenes(large_geneset, sizes, 500, 500)
+    assert mask.all()
+
+
+def testGetTargetRegionsOnLargeContigs(large_geneset):
+    sizes = dict(("chr%i" % n, LARGE_CONTIG) for n in range(1, 13))
+    keep = numpy.ones(len(large_geneset), dtype=bool)
+    regions = GenesetCache.getTargetRegions(large_geneset, keep, sizes,
+                                            500, 500)
+    assert regions == [("chr%i" % n, LARGE_CONTIG - 10501,
+                        LARGE_CONTIG - 7000) for n in range(1, 13)]
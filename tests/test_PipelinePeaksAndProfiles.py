@@ -0,0 +1,114 @@
+'''tests for the content based up-to-date decisions of
+PipelinePeaksAndProfiles.trackContent.'''
+
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("CGAT.Experiment")
+pytest.importorskip("CGATPipelines.Pipeline")
+pytest.importorskip("ruffus")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import PipelinePeaksAndProfiles as PipelinePeaks  # noqa: E402
+
+PARAMS = {"tracked_value": 1}
+
+
+def writeFile(filename, text, mtime=None):
+    with open(filename, "w") as outf:
+        outf.write(text)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+
+@pytest.fixture
+def tracked(tmp_path, monkeypatch):
+    '''return a task copying its input to its outputs, tracked by
+    content in a database under *tmp_path*.'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(PipelinePeaks.P.PARAMS, "contenthash_enabled", 1)
+    monkeypatch.setitem(PipelinePeaks.P.PARAMS, "contenthash_database",
+                        str(tmp_path / "contenthash.db"))
+
+    def copyinput(infile, outfiles):
+        value = PARAMS["tracked_value"]
+        for outfile in outfiles:
+            writeFile(outfile, open(infile).read() + str(value))
+
+    now = time.time()
+    writeFile("input.txt", "a\n", mtime=now - 100)
+    return PipelinePeaks.trackContent(copyinput)
+
+
+def testMissingOutputsAreRun(tracked):
+    assert tracked.isUptodate("input.txt", ["a.out", "b.out"])[0]
+
+
+def testUptodateByModificationTimeIsRecorded(tracked):
+    writeFile("a.out", "a\n1")
+    writeFile("b.out", "a\n1")
+    assert tracked.isUptodate("input.txt", ["a.out", "b.out"]) == \
+        (False, "up to date by modification time, recorded")
+    assert tracked.isUptodate("input.txt", ["a.out", "b.out"]) == \
+        (False, "content unchanged")
+
+
+def testNewerInputWithoutSignatureIsRun(tracked):
+    writeFile("a.out", "a\n1", mtime=time.time() - 200)
+    assert tracked.isUptodate("input.txt", "a.out")[0]
+
+
+def testTouchedInputIsNotRun(tracked):
+    tracked("input.txt", ["a.out"])
+    os.utime("input.txt", None)
+    assert not tracked.isUptodate("input.txt", ["a.out"])[0]
+
+
+def testChangedInputIsRun(tracked):
+    tracked("input.txt", ["a.out"])
+    writeFile("input.txt", "b\n")
+    needs_update, message = tracked.isUptodate("input.txt", ["a.out"])
+    assert needs_update
+    assert message == "changed: input input.txt"
+
+
+def testChangedParameterIsRun(tracked, monkeypatch):
+    tracked("input.txt", ["a.out"])
+    monkeypatch.setitem(PARAMS, "tracked_value", 2)
+    needs_update, message = tracked.isUptodate("input.txt", ["a.out"])
+    assert needs_update
+    assert message == "changed: param tracked_value"
+
+
+def testDeletedOutputOfSeveralIsRun(tracked):
+    tracked("input.txt", ["a.out", "b.out"])
+    assert not tracked.isUptodate("input.txt", ["a.out", "b.out"])[0]
+    os.unlink("b.out")
+    assert tracked.isUptodate("input.txt", ["a.out", "b.out"]) == \
+        (True, "missing output")
+
+
+def testWithdrawnMergeInputIsRun(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(PipelinePeaks.P.PARAMS, "merge_incremental", 1)
+    monkeypatch.setitem(PipelinePeaks.P.PARAMS, "contenthash_enabled", 0)
+
+    def mergetables(infiles, outfile):
+        pass
+
+    merged = PipelinePeaks.checkMergeState(
+        PipelinePeaks.trackContent(mergetables))
+    now = time.time()
+    writeFile("a.tsv", "a\n", mtime=now - 100)
+    writeFile("b.tsv", "b\n", mtime=now - 100)
+    writeFile("merged.tsv", "a\nb\n", mtime=now - 50)
+    writeFile("merged.tsv.state",
+              '{"files": [{"name": "a.tsv"}, {"name": "b.tsv"}]}')
+    assert not merged.isUptodate(["a.tsv", "b.tsv"], "merged.tsv")[0]
+    assert merged.isUptodate(["a.tsv"], "merged.tsv") == \
+        (True, "inputs added or removed")
+    os.utime("a.tsv", None)
+    assert merged.isUptodate(["a.tsv", "b.tsv"], "merged.tsv")[0]
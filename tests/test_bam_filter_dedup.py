@@ -0,0 +1,88 @@
+'''tests for bam_filter_dedup.py on a small BAM file with known
+duplicates.'''
+
+import os
+import sys
+
+import pytest
+
+pysam = pytest.importorskip("pysam")
+pytest.importorskip("CGAT.Experiment")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "pipeline_peaksandprofiles"))
+import bam_filter_dedup  # noqa: E402
+
+# name, flag, start, mate start, template length, mapping quality,
+# base quality
+READS = [
+    # a pair and a duplicate of it with lower base qualities
+    ("pair1", 99, 100, 300, 250, 60, "I"),
+    ("pair1", 147, 300, 100, -250, 60, "I"),
+    ("pair2", 99, 100, 300, 250, 60, "5"),
+    ("pair2", 147, 300, 100, -250, 60, "5"),
+    # same first mate, different second mate
+    ("pair3", 99, 100, 400, 350, 60, "I"),
+    ("pair3", 147, 400, 100, -350, 60, "I"),
+    # unpaired read at the 5' end of a pair
+    ("single1", 0, 100, -1, 0, 60, "I"),
+    # unpaired reads duplicating each other
+    ("single2", 16, 600, -1, 0, 60, "5"),
+    ("single3", 16, 600, -1, 0, 60, "I"),
+    # filtered by mapping quality and by flag
+    ("lowmapq", 0, 700, -1, 0, 10, "I"),
+    ("secondary", 256, 800, -1, 0, 60, "I"),
+]
+
+
+def writeBAM(filename, reads, length=50):
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": "chr1", "LN": 10000}],
+              "RG": [{"ID": "rg1", "LB": "lib1", "SM": "sample"}]}
+    with pysam.AlignmentFile(filename, "wb", header=header) as outf:
+        for name, flag, start, mate, tlen, mapq, quality in sorted(
+                reads, key=lambda x: x[2]):
+            read = pysam.AlignedSegment()
+            read.query_name = name
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = mapq
+            read.cigartuples = [(0, length)]
+            read.query_sequence = "A" * length
+            read.query_qualities = pysam.qualitystring_to_array(
+                quality * length)
+            if flag & 1:
+                read.next_reference_id = 0
+                read.next_reference_start = mate
+                read.template_length = tlen
+            read.set_tag("RG", "rg1")
+            outf.write(read)
+    pysam.index(filename)
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def testFilterDedup(tmp_path, threads):
+    infile = str(tmp_path / "sample.bam")
+    outfile = str(tmp_path / "sample.deduplicated.bam")
+    metrics = str(tmp_path / "sample.deduplicated.metrics")
+    writeBAM(infile, READS)
+    bam_filter_dedup.main(["bam_filter_dedup.py", "-b", infile,
+                           "-o", outfile, "--metrics-file=%s" % metrics,
+                           "--threads=%i" % threads])
+
+    with pysam.AlignmentFile(outfile) as inf:
+        names = [read.query_name for read in inf]
+    assert sorted(names) == ["pair1", "pair1", "pair3", "pair3",
+                             "single3"]
+    assert os.path.exists(outfile + ".bai")
+
+    with open(metrics) as inf:
+        lines = [line.rstrip("\n").split("\t") for line in inf
+                 if line.strip() and not line.startswith("#")]
+    row = dict(zip(lines[0], lines[1]))
+    assert row["LIBRARY"] == "lib1"
+    assert row["UNPAIRED_READS_EXAMINED"] == "3"
+    assert row["READ_PAIRS_EXAMINED"] == "3"
+    assert row["UNPAIRED_READ_DUPLICATES"] == "2"
+    assert row["READ_PAIR_DUPLICATES"] == "1"
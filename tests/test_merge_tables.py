@@ -0,0 +1,111 @@
+'''tests for merge_tables.py, comparing incremental updates with
+tables merged from scratch.'''
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+pytest.importorskip("CGAT.Experiment")
+
+SCRIPTSDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                          "pipeline_peaksandprofiles")
+sys.path.insert(0, SCRIPTSDIR)
+import merge_tables  # noqa: E402
+
+CAT = ["--regex-filename=(.+)-(.+)-(.+).tsv", "--cat",
+       "pulldown,condition,replicate"]
+
+JOIN = ["--use-file-prefix", "-c", "1", "-k", "2",
+        "--regex-filename=(.+).tsv"]
+
+
+def writeTable(filename, rows, header=("region", "counts")):
+    with open(filename, "w") as outf:
+        outf.write("\t".join(header) + "\n")
+        for row in rows:
+            outf.write("\t".join(map(str, row)) + "\n")
+
+
+def merge(options, filenames, outfile, incremental=False):
+    argv = ["merge_tables.py"] + options + ["--output-file=%s" % outfile]
+    if incremental:
+        argv.append("--incremental")
+    merge_tables.main(argv + filenames)
+    with open(outfile) as inf:
+        return inf.read()
+
+
+def writeSamples(names, nrows=3):
+    for n, name in enumerate(names):
+        writeTable(name, [("r%i" % x, n * 10 + x) for x in range(nrows)])
+    return list(names)
+
+
+@pytest.fixture
+def samples(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return writeSamples(["A-a-1.tsv", "A-b-1.tsv", "A-c-1.tsv"])
+
+
+@pytest.mark.parametrize("withdrawn", [0, 1, 2])
+def testCatRemove(samples, withdrawn):
+    merge(CAT, samples, "inc.tsv", incremental=True)
+    del samples[withdrawn]
+    result = merge(CAT, samples, "inc.tsv", incremental=True)
+    assert result == merge(CAT, samples, "full.tsv")
+    assert result.count("pulldown") == 1
+
+
+def testCatAddAndChange(samples):
+    merge(CAT, samples, "inc.tsv", incremental=True)
+    samples += writeSamples(["B-a-1.tsv"])
+    writeTable(samples[0], [("r0", 100)])
+    result = merge(CAT, samples, "inc.tsv", incremental=True)
+    # changed and new samples are appended after the retained ones
+    expected = merge(CAT, samples[1:3] + [samples[0], samples[3]],
+                     "full.tsv")
+    assert result == expected
+
+
+def testCatRepeatedUpdates(samples):
+    merge(CAT, samples, "inc.tsv", incremental=True)
+    for name in (samples[1], samples[0]):
+        samples.remove(name)
+        result = merge(CAT, samples, "inc.tsv", incremental=True)
+        assert result == merge(CAT, samples, "full.tsv")
+    samples += writeSamples(["B-a-1.tsv", "B-b-1.tsv"])
+    result = merge(CAT, samples, "inc.tsv", incremental=True)
+    assert result == merge(CAT, samples, "full.tsv")
+
+
+def testCatToPipe(samples):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.check_output(
+        [sys.executable, os.path.join(SCRIPTSDIR, "merge_tables.py")] +
+        CAT + samples, env=env)
+    assert output.decode("utf-8") == merge(CAT, samples, "full.tsv")
+    assert not os.path.exists("full.tsv.state")
+
+
+@pytest.mark.parametrize("withdrawn", [0, 1, 2])
+def testJoinRemove(samples, withdrawn):
+    merge(JOIN, samples, "inc.tsv", incremental=True)
+    del samples[withdrawn]
+    result = merge(JOIN, samples, "inc.tsv", incremental=True)
+    assert result == merge(JOIN, samples, "full.tsv")
+
+
+def testJoinAdd(samples):
+    merge(JOIN, samples, "inc.tsv", incremental=True)
+    samples += writeSamples(["B-a-1.tsv"])
+    result = merge(JOIN, samples, "inc.tsv", incremental=True)
+    assert result == merge(JOIN, samples, "full.tsv")
+
+
+def testChangedOptionsRebuild(samples):
+    merge(JOIN, samples, "inc.tsv", incremental=True)
+    options = ["-c", "1", "-k", "2", "--regex-filename=(.+).tsv"]
+    result = merge(options, samples, "inc.tsv", incremental=True)
+    assert result == merge(options, samples, "full.tsv")
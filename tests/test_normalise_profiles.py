@@ -0,0 +1,64 @@
+'''tests for normalise_profiles.py, comparing its output with that of
+the original line-by-line script.'''
+
+import os
+import sys
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+pytest.importorskip("CGAT.Experiment")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "pipeline_peaksandprofiles"))
+import normalise_profiles  # noqa: E402
+import ProfileMatrix  # noqa: E402
+
+ROWS = ["t1\t0\t1\t3\t0",
+        "t2\t0\t0\t0\t0",
+        "",
+        "t3\t7\t7\t7\t1",
+        "t4\t0.1\t0.2\t0.3\t0.4",
+        "t5\t1\t2\t3\t1000000",
+        ""]
+
+
+def normaliseBaseline(lines):
+    '''the normalisation of the original script.'''
+    output = []
+    for line in lines:
+        fields = line.strip().split("\t")
+        total = sum([float(col) for col in fields[1:]])
+        if total == 0:
+            continue
+        for i, col in enumerate(fields):
+            if i == 0:
+                continue
+            fields[i] = float(col) / total
+        output.append("\t".join(map(str, fields)) + "\n")
+    return "".join(output)
+
+
+def normalise(capsys, matrixfile, chunk_size=2):
+    capsys.readouterr()
+    normalise_profiles.main(["normalise_profiles.py", "-m", matrixfile,
+                             "--chunk-size=%i" % chunk_size])
+    return capsys.readouterr().out
+
+
+def testTextMatchesBaseline(tmp_path, capsys):
+    matrixfile = str(tmp_path / "sample.profiles.tsv")
+    with open(matrixfile, "w") as outf:
+        outf.write("\n".join(ROWS))
+    assert normalise(capsys, matrixfile) == normaliseBaseline(ROWS)
+
+
+def testBinaryMatchesBaseline(tmp_path, capsys):
+    # float32 represents these counts exactly
+    rows = [x for x in ROWS if not x.startswith("t4")]
+    matrixfile = str(tmp_path / "sample.profiles.tsv")
+    with open(matrixfile, "w") as outf:
+        outf.write("\n".join(rows))
+    prefix = str(tmp_path / "sample.profiles")
+    ProfileMatrix.fromText(matrixfile, prefix)
+    assert normalise(capsys, prefix + ".npy") == normaliseBaseline(rows)